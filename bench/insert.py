@@ -0,0 +1,21 @@
+"""bulk insert benchmark: row-at-a-time inserts through a Cursor, like a fixture load. Usage: python bench/insert.py [n_rows]"""
+
+import sys, time
+from pg13 import pgmock_dbapi2
+
+def main():
+  n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+  pool = pgmock_dbapi2.PgPoolMock()
+  with pool.withcur() as cursor:
+    cursor.execute('create table a (id int primary key, name text)')
+    cursor.execute('create table b (id int, name text)')
+    cursor.execute('create table c (id serial primary key, name text)')
+  for query in ('insert into a values (%s, %s)', 'insert into b values (%s, %s)', 'insert into c (name) values (%s)'):
+    start = time.perf_counter()
+    with pool.withcur() as cursor:
+      for i in range(n_rows):
+        cursor.execute(query, (i, 'name%i' % i)[-query.count('%s'):])
+    print('%6.3fs %7i rows  %s' % (time.perf_counter() - start, n_rows, query))
+
+if __name__ == '__main__':
+  main()
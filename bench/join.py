@@ -0,0 +1,24 @@
+"""join benchmark: equi-join of two tables through pgmock. Usage: python bench/join.py [n_rows]"""
+
+import sys, time
+from pg13 import pgmock, sqparse2
+
+def main():
+  n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+  tables = pgmock.TablesDict()
+  def run(stmt, vals=()):
+    return tables.apply_sql(sqparse2.parse(stmt), vals, None)
+  run('create table a (id int, name text)')
+  run('create table b (id int, a_id int, val int)')
+  tables['a'].rows = [[i, 'name%i' % i] for i in range(n_rows)]
+  tables['b'].rows = [[i, (i * 7) % n_rows, i % 10] for i in range(n_rows)]
+  for query in (
+    'select a.name, b.val from a join b on a.id = b.a_id',
+    'select a.name, b.val from a, b where a.id = b.a_id and b.val = 3',
+  ):
+    start = time.perf_counter()
+    rows = run(query)
+    print('%6.3fs %7i rows  %s' % (time.perf_counter() - start, len(rows), query))
+
+if __name__ == '__main__':
+  main()
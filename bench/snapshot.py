@@ -0,0 +1,26 @@
+"""snapshot benchmark: save / load / clone a database with one big indexed table. Usage: python bench/snapshot.py [n_rows]"""
+
+import os, sys, tempfile, time
+from pg13 import pgmock, pgmock_dbapi2
+
+def main():
+  n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+  pool = pgmock_dbapi2.PgPoolMock()
+  with pool.withcur() as cursor:
+    cursor.execute('create table big (id int primary key, payload text)')
+    cursor.execute('create index big_payload on big (payload)')
+  pool.tables['big'].rows = [[i, 'payload%i' % i] for i in range(n_rows)]
+  with tempfile.TemporaryDirectory() as tmp:
+    path = os.path.join(tmp, 'big.snap')
+    start = time.perf_counter()
+    pool.tables.save(path)
+    print('%6.3fs  save  %i bytes' % (time.perf_counter() - start, os.path.getsize(path)))
+    start = time.perf_counter()
+    pgmock.TablesDict.load(path)
+    print('%6.3fs  load' % (time.perf_counter() - start))
+  start = time.perf_counter()
+  pool.tables.clone()
+  print('%6.3fs  clone' % (time.perf_counter() - start))
+
+if __name__ == '__main__':
+  main()
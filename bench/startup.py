@@ -0,0 +1,40 @@
+"""startup benchmark: import-to-first-query latency for pgmock, cold (no parse table cache) vs warm.
+Each sample runs in a fresh interpreter. Usage: python bench/startup.py [n_samples]
+"""
+
+import os, subprocess, sys, tempfile, json
+
+PROBE = '''
+import time, json
+t0 = time.perf_counter()
+from pg13 import pgmock_dbapi2
+t1 = time.perf_counter()
+with pgmock_dbapi2.connect() as con, con.cursor() as cur:
+  cur.execute('create table t1 (a int, b text)')
+  cur.execute('insert into t1 values (%s, %s)', (1, 'one'))
+  cur.execute('select * from t1 where a = %s', (1,))
+  cur.fetchall()
+t2 = time.perf_counter()
+print(json.dumps({'import': t1 - t0, 'first_query': t2 - t1, 'total': t2 - t0}))
+'''
+
+def sample(cache_dir):
+  env = dict(os.environ, PG13_CACHE_DIR=cache_dir)
+  out = subprocess.run([sys.executable, '-c', PROBE], env=env, check=True, capture_output=True, text=True).stdout
+  return json.loads(out.strip().splitlines()[-1])
+
+def report(label, samples):
+  print('%-6s' % label, '  '.join(
+    '%s %6.1fms' % (key, 1000 * sorted(s[key] for s in samples)[len(samples) // 2])
+    for key in ('import', 'first_query', 'total')
+  ))
+
+def main():
+  n_samples = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+  with tempfile.TemporaryDirectory() as cache_dir:
+    report('cold', [sample('') for _ in range(n_samples)])
+    sample(cache_dir) # populate the cache
+    report('warm', [sample(cache_dir) for _ in range(n_samples)])
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,21 @@
+"""transaction overhead benchmark: small transactions against a database with one big table. Usage: python bench/transaction.py [n_rows]"""
+
+import sys, time
+from pg13 import pgmock_dbapi2
+
+def main():
+  n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+  pool = pgmock_dbapi2.PgPoolMock()
+  with pool.withcur() as cursor:
+    cursor.execute('create table big (id int primary key, payload text)')
+    cursor.execute('create table small (id int primary key, val int)')
+    cursor.execute('insert into small values (0, 0)')
+  pool.tables['big'].rows = [[i, 'payload%i' % i] for i in range(n_rows)]
+  for query in ('select * from small where id = %s', 'update small set val = val + 1 where id = %s', 'select * from big where id = %s'):
+    start = time.perf_counter()
+    for _ in range(100):
+      pool.select(query, (0,)) if query.startswith('select') else pool.commit(query, (0,))
+    print('%6.3fms per transaction  %s' % ((time.perf_counter() - start) * 10, query))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,145 @@
+"aggregate functions (count, sum, string_agg ..) as accumulators, and the hash grouping that feeds them. see sqex.iter_groups"
+
+import collections, functools, operator
+from . import misc, rowops, sqparse2, threevl, treepath
+
+def is_null(val):
+  "helper for aggregates. sql nulls and 3vl unknowns (i.e. the result of comparing to null)"
+  return val is None or val is threevl.UNKNOWN
+
+def agg_min(state, val):
+  return val if state is None or val < state else state
+
+def agg_max(state, val):
+  return val if state is None or val > state else state
+
+def agg_sum(state, val):
+  return val if state is None else state + val
+
+def agg_avg(state, val):
+  "state is [total, count]"
+  state[0] += val
+  state[1] += 1
+  return state
+
+def avg_final(state):
+  total, count = state
+  return total / count if count else None
+
+def agg_bool(oper, state, val):
+  return bool(val) if state is None else oper(state, bool(val))
+
+def agg_append(state, val):
+  state.append(val)
+  return state
+
+def agg_string(state, val, delim):
+  "state is a list of parts, delimiter first; string_agg drops the first delimiter"
+  state.extend((delim, val))
+  return state
+
+class Aggregate(collections.namedtuple('Aggregate', 'init step final nargs keep_nulls')):
+  """an aggregate function as an accumulator: state = init(), then state = step(state, *args) per input row, then final(state).
+  Rows whose first arg is null (see is_null) are skipped unless keep_nulls. Memory is one state per group, not one list of rows.
+  """
+
+# todo: every, json_agg, ordered aggregates (array_agg(x order by y))
+AGGREGATES = {
+  'count': Aggregate(int, lambda state, val: state + 1, None, 1, False),
+  'min': Aggregate(lambda: None, agg_min, None, 1, False),
+  'max': Aggregate(lambda: None, agg_max, None, 1, False),
+  'sum': Aggregate(lambda: None, agg_sum, None, 1, False),
+  'avg': Aggregate(lambda: [0, 0], agg_avg, avg_final, 1, False),
+  'bool_and': Aggregate(lambda: None, functools.partial(agg_bool, operator.and_), None, 1, False),
+  'bool_or': Aggregate(lambda: None, functools.partial(agg_bool, operator.or_), None, 1, False),
+  'array_agg': Aggregate(list, agg_append, lambda state: state or None, 1, True),
+  'string_agg': Aggregate(list, agg_string, lambda state: ''.join(state[1:]) if state else None, 2, False),
+}
+
+def consumes_rows(ex):
+  return isinstance(ex, sqparse2.CallX) and ex.f in AGGREGATES
+
+def distinct_aggregate(agg):
+  "the Aggregate for i.e. count(distinct a): agg, fed each distinct value once. the state is [seen values, agg's state]"
+  def step(state, val, *rest):
+    key = misc.hashable(val)
+    if key not in state[0]:
+      state[0].add(key)
+      state[1] = agg.step(state[1], val, *rest)
+    return state
+  final = agg.final or (lambda state: state)
+  return Aggregate(lambda: [set(), agg.init()], step, lambda state: final(state[1]), agg.nargs, agg.keep_nulls)
+
+def group_keys(ex):
+  "the group by expressions of a select as a list"
+  if ex.group is None:
+    return []
+  return list(ex.group.children) if isinstance(ex.group, sqparse2.CommaX) else [ex.group]
+
+def ungrouped_columns(exp, keys):
+  "column references (and *) in exp that aren't inside an aggregate or a group by expression. these aren't allowed in a grouped select"
+  def stop(item):
+    return item in keys or consumes_rows(item) or isinstance(item, (sqparse2.NameX, sqparse2.AttrX, sqparse2.AsterX))
+  items = [exp[path] for path in treepath.sub_slots(exp, stop, match=True, recurse_into_matches=False)]
+  return [item for item in items if item not in keys and not consumes_rows(item)]
+
+class GroupRow(tuple):
+  "a group's first composite row (for the group by columns) with the group's aggregate values in aggs. see group_rows"
+  def __new__(cls, c_row, aggs):
+    self = super().__new__(cls, c_row)
+    self.aggs = aggs
+    return self
+
+def feeder(agg, args):
+  "compiled step for one aggregate call: update(state, c_row) returns the new state. args are the call's compiled arguments"
+  step = agg.step
+  if len(args) != 1:
+    def update_n(state, c_row):
+      vals = [arg(c_row) for arg in args]
+      return state if is_null(vals[0]) and not agg.keep_nulls else step(state, *vals)
+    return update_n
+  arg, = args
+  if agg.keep_nulls:
+    return lambda state, c_row: step(state, arg(c_row))
+  def update(state, c_row):
+    val = arg(c_row)
+    return state if is_null(val) else step(state, val)
+  return update
+
+def accumulate(accumulators, states, c_row):
+  "feed one composite row to each (exp, Aggregate, update) in accumulators"
+  for i, (_, _, update) in enumerate(accumulators):
+    states[i] = update(states[i], c_row)
+
+def finish(accumulators, states):
+  "final aggregate values from accumulator states"
+  return [state if agg.final is None else agg.final(state) for (_, agg, _), state in zip(accumulators, states)]
+
+def group_rows(keys, compiler, composite_rows, tables, width):
+  """hash grouping in one pass: each row finds its group in a dict by key and steps the group's aggregate states,
+  so memory goes with the number of groups, not rows. Groups come out in the order they're first seen.
+  compiler.accumulators must already hold every aggregate in the select. Without keys there's one group, even for no rows.
+  """
+  key = compiler.compile(keys[0] if len(keys) == 1 else tuple(keys))
+  accumulators = compiler.accumulators
+  updates = [(i, update) for i, (_, _, update) in enumerate(accumulators)]
+  groups = {}
+  if not keys:
+    groups[()] = GroupRow((), [agg.init() for _, agg, _ in accumulators])
+  for c_row in composite_rows:
+    k = key(c_row)
+    try:
+      group = groups.get(k)
+    except TypeError: # arrays and json
+      k = misc.hashable(k)
+      group = groups.get(k)
+    if group is None:
+      group = groups[k] = GroupRow(c_row, [agg.init() for _, agg, _ in accumulators])
+      if len(groups) % rowops.COLLECT_CHUNK == 0:
+        tables.check_rows(len(groups), width)
+    states = group.aggs
+    for i, update in updates:
+      states[i] = update(states[i], c_row)
+  for group in groups.values():
+    group.aggs[:] = finish(accumulators, group.aggs)
+  return list(groups.values())
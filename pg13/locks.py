@@ -0,0 +1,108 @@
+"locks for pgmock: table locks for autocommit statements and row locks for transactions (see pgmock.TablesDict)"
+
+import contextlib, threading, time
+from . import table
+
+class SerializationError(table.PgExecError):
+  "commit found a conflicting commit by another transaction; the transaction has been rolled back and can be retried"
+
+class DeadlockDetected(SerializationError):
+  "waiting for the lock would deadlock. the statement has been undone"
+
+class LockNotAvailable(table.PgExecError):
+  "waited longer than TablesDict.lock_timeout for a row lock. the statement has been undone"
+
+class ReadWriteLock:
+  "many readers or one writer. waiting writers block new readers so a stream of readers can't starve them"
+  def __init__(self):
+    self.cond = threading.Condition()
+    self.readers = 0
+    self.writer = False
+    self.waiting_writers = 0
+
+  @contextlib.contextmanager
+  def read(self):
+    with self.cond:
+      while self.writer or self.waiting_writers:
+        self.cond.wait()
+      self.readers += 1
+    try:
+      yield
+    finally:
+      with self.cond:
+        self.readers -= 1
+        self.cond.notify_all()
+
+  @contextlib.contextmanager
+  def write(self):
+    with self.cond:
+      self.waiting_writers += 1
+      while self.writer or self.readers:
+        self.cond.wait()
+      self.waiting_writers -= 1
+      self.writer = True
+    try:
+      yield
+    finally:
+      with self.cond:
+        self.writer = False
+        self.cond.notify_all()
+
+class LockManager:
+  """row locks for SELECT .. FOR UPDATE / FOR SHARE and for rows transactions write. Held until the owner's transaction ends.
+  A resource is (table_name, key), key being the row's pkey_index key. modes are 'share' and 'exclusive'.
+  """
+  def __init__(self):
+    self.cond = threading.Condition()
+    self.holders = {} # {resource: {owner: mode}}
+    self.owned = {} # {owner: set of resources}
+    self.waiting = {} # {owner: (resource, mode)}, for deadlock detection
+
+  def blockers(self, owner, resource, mode):
+    "owners holding resource in a mode that conflicts with mode"
+    return [other for other, held in self.holders.get(resource, {}).items() if other is not owner and 'exclusive' in (mode, held)]
+
+  def deadlocked(self, owner):
+    "whether owner's wait closes a cycle in the wait-for graph"
+    todo, seen = self.blockers(owner, *self.waiting[owner]), set()
+    while todo:
+      other = todo.pop()
+      if other is owner:
+        return True
+      if other not in seen and other in self.waiting:
+        seen.add(other)
+        todo.extend(self.blockers(other, *self.waiting[other]))
+    return False
+
+  def acquire(self, owner, resources, mode, timeout=None):
+    "lock resources (an iterable) for owner. timeout is in seconds, None to wait for as long as it takes"
+    deadline = None if timeout is None else time.monotonic() + timeout
+    with self.cond:
+      owned = self.owned.setdefault(owner, set())
+      for resource in resources:
+        holders = self.holders.setdefault(resource, {})
+        held = holders.get(owner)
+        if held in ('exclusive', mode):
+          continue
+        while len(holders) > (held is not None) and self.blockers(owner, resource, mode):
+          self.waiting[owner] = (resource, mode)
+          try:
+            if self.deadlocked(owner):
+              raise DeadlockDetected('deadlock_detected', resource)
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+              raise LockNotAvailable('lock_timeout', resource)
+            self.cond.wait(remaining)
+          finally:
+            del self.waiting[owner]
+          holders = self.holders.setdefault(resource, {}) # release_all can delete it while this waits
+        holders[owner] = mode
+        owned.add(resource)
+
+  def release_all(self, owner):
+    with self.cond:
+      for resource in self.owned.pop(owner, ()):
+        del self.holders[resource][owner]
+        if not self.holders[resource]:
+          del self.holders[resource]
+      self.cond.notify_all()
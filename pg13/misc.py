@@ -22,6 +22,16 @@ def key_from_pair(pair):
   "helper for multimap"
   return pair[0]
 
+def hashable(val):
+  "helper for Index and hash grouping. arrays and json values come in as lists and dicts; this turns them into something hashable"
+  if isinstance(val, (list, tuple)):
+    return tuple(map(hashable, val))
+  elif isinstance(val, dict):
+    return tuple(sorted((k, hashable(v)) for k, v in val.items()))
+  elif isinstance(val, set):
+    return frozenset(val)
+  return val
+
 def multimap(kv_pairs):
   # note: sort is on just key, not k + v, because sorting on both would require sortable value type
   return {
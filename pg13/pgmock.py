@@ -2,17 +2,14 @@
 
 # todo: type checking of literals based on column. flag-based (i.e. not all DBs do this) cast strings to unicode.
 
-import contextlib, threading, copy
-from . import sqparse2, sqex, table
+import collections, contextlib, os, sys, threading, warnings, weakref
+from . import locks, sqparse2, sqex, storage, table
 
-class TablesDict:
-  "dictionary wrapper that knows about transactions"
-  # todo: bite the bullet and rename this Database
-  def __init__(self):
-    self.lock = threading.Lock()
-    self.levels = [{}]
-    self.transaction = False
-    self.transaction_owner = None
+class View:
+  "stack of {name: Table} dicts plus the sequences the statement can see. statements use the top level"
+  def __init__(self, level, sequences):
+    self.levels = [level]
+    self.sequences = sequences
 
   def __getitem__(self, k):
     return self.levels[-1][k]
@@ -41,6 +38,9 @@ class TablesDict:
   def items(self):
     return list(self.levels[-1].items())
 
+  def check_rows(self, count, width):
+    "called by rowops.collect as it builds a list of count rows of width columns / tables. Transaction raises MemoryLimitExceeded if they won't fit"
+
   @contextlib.contextmanager
   def tempkeys(self):
     """Add a new level to make new keys temporary. Used instead of copy in sqex.
@@ -53,39 +53,426 @@ class TablesDict:
     finally:
       self.levels.pop()
 
-  def trans_start(self, lockref):
-    self.lock.acquire()
-    if self.transaction:
-      raise RuntimeError('in transaction after acquiring lock')
-    self.levels.append(copy.deepcopy(self.levels[0])) # i.e. copy all the tables, too
-    self.transaction = True
-    self.transaction_owner = lockref
-
-  def trans_commit(self):
-    if not self.transaction:
-      raise RuntimeError('commit not in transaction')
-    self.levels = [self.levels[1]]
-    self.transaction = False
-    self.lock.release()
-
-  def trans_rollback(self):
-    if not self.transaction:
-      raise RuntimeError('commit not in transaction')
-    self.levels = [self.levels[0]]
-    self.transaction = False
-    self.lock.release()
+# the lock errors are part of pgmock's interface (i.e. pgmock.SerializationError)
+SerializationError, DeadlockDetected, LockNotAvailable = locks.SerializationError, locks.DeadlockDetected, locks.LockNotAvailable
 
-  @contextlib.contextmanager
-  def lock_db(self, lockref, is_start):
-    if self.transaction and self.transaction_owner is lockref:
-      # note: this case is relying on the fact that if the above is true, our thread did it,
-      #   therefore the lock can't be released on our watch.
-      yield
-    elif is_start:
-      yield # apply_sql will call trans_start() on its own, block there if necessary
+class MemoryLimitExceeded(table.PgExecError):
+  "the statement would take the database over TablesDict.memory_hard_limit. it has been undone"
+
+class MemoryLimitWarning(UserWarning):
+  "a write left the database over TablesDict.memory_soft_limit"
+
+class ResultStream:
+  """iterator over a select's output rows, produced as they're pulled (see Transaction.execute with stream).
+  The rows are the ones the statement saw when it ran: an in-place write to one of the tables (names) it reads drains it first
+    (reads the rest into memory, see TablesDict.in_place_write), and so does its own transaction before running a statement
+    that could change its tables. Writes to other tables don't touch it.
+  drain can run on the writer's thread, so pulling rows takes self.lock. An error computing the rows during a drain is
+    raised to the reader when it gets to that row.
+  """
+  def __init__(self, db, rows, names):
+    self.db, self.rows, self.names = db, rows, names
+    self.buffer = collections.deque() # from drain
+    self.error = None # from drain
+    self.lock = threading.RLock()
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    with self.lock:
+      if self.rows is None:
+        if self.buffer:
+          return self.buffer.popleft()
+        if self.error is not None:
+          error, self.error = self.error, None
+          raise error
+        raise StopIteration
+      try:
+        return next(self.rows)
+      except BaseException: # the end, or an error computing the row
+        self.close()
+        raise
+
+  def drain(self):
+    "read the rest of the rows now"
+    with self.lock:
+      if self.rows is not None:
+        try:
+          self.buffer.extend(self.rows)
+        except Exception as err: # pylint: disable=broad-except
+          self.error = err
+        finally:
+          self.close()
+
+  def close(self):
+    with self.lock:
+      if self.rows is not None:
+        self.rows = None
+        self.db.close_stream(self)
+
+  def __del__(self):
+    self.close()
+
+MEMORY_VIEW = 'pg13_memory_usage' # system view with a row per table, see Transaction.memory_view
+MEMORY_VIEW_COLS = sqparse2.parse('create table ' + MEMORY_VIEW + ' (table_name text, row_count int, bytes int)').cols
+COMPOSITE_ROW_BYTES = sys.getsizeof(()) # plus table.POINTER_BYTES per table, for check_rows
+
+class Transaction(View): # pylint: disable=too-many-instance-attributes
+  """one connection's transaction. Statements run against this (it's the tables_dict that sqex and Table get).
+  Writes are optimistic: the first write to a table copies it (see writable).
+    At commit, TablesDict.publish checks the write set against what other transactions committed since the copy
+    (by pkey for tables that have one, otherwise by table). Conflicts raise SerializationError; disjoint changes to one table are merged.
+  Rows a statement writes are then locked (TablesDict.locks) until the transaction ends, and SELECT .. FOR UPDATE / FOR SHARE locks
+    the rows it returns. So a transaction that locks rows before writing them waits for other writers instead of failing at commit.
+  isolation:
+    'read committed' (default): until the first write, each statement sees the latest commit. after that the snapshot stays put.
+    'repeatable read': one snapshot for the whole transaction.
+    'serializable': repeatable read, plus commit fails if a table the transaction read was changed by a commit since its snapshot.
+  implicit transactions wrap a single statement that ran outside a transaction and commit straight away.
+    If no other transaction is open their writes change tables in place (copying would make bulk autocommit inserts quadratic),
+    with the tables locked against other implicit statements (TablesDict.lock_tables). Otherwise they copy, because open transactions'
+    snapshots can share the tables, and wait for row locks like an explicit transaction.
+  """
+  WRITES = (sqparse2.InsertX, sqparse2.UpdateX, sqparse2.DeleteX, sqparse2.CreateX, sqparse2.DropX, sqparse2.IndexX, sqparse2.CreateSequenceX, sqparse2.DropSequenceX)
+  READS = (sqparse2.SelectX, sqparse2.SetOpX)
+  DDL = (sqparse2.CreateX, sqparse2.DropX, sqparse2.IndexX, sqparse2.CreateSequenceX, sqparse2.DropSequenceX)
+  ISOLATION_LEVELS = ('read committed', 'repeatable read', 'serializable')
+
+  def __init__(self, db, owner, implicit, isolation='read committed'):
+    if isolation not in self.ISOLATION_LEVELS:
+      raise ValueError('unk_isolation_level', isolation)
+    super().__init__(None, None)
+    self.db, self.owner, self.implicit, self.isolation = db, owner, implicit, isolation
+    self.lock = threading.RLock() # for connections shared between threads; one statement at a time
+    self.streams = weakref.WeakSet() # open ResultStreams, see drain_streams
+    self.reset()
+    self.refresh()
+
+  def reset(self):
+    "forget the transaction's changes"
+    self.writing = False
+    self.in_place = False
+    self.copied = set() # names of tables this transaction has its own copy of, or is logging changes to (see writable)
+    self.ddl_tables = set() # names of tables that create / drop touched; these conflict at the table level
+    self.index_tables = set() # names of tables create index touched. these conflict at the table level too, but the WAL only logs their index specs (see storage.wal_changes)
+    self.reads = set() # names of tables statements looked up, for serializable
+    self.undo = [] # table.UndoEntry list, for savepoints, failed statements and the write set
+    self.savepoints = [] # [(name, len(self.undo) at the savepoint), ...]
+
+  def __getitem__(self, k):
+    self.reads.add(k)
+    try:
+      return self.levels[-1][k]
+    except KeyError:
+      if k != MEMORY_VIEW:
+        raise
+      return self.memory_view()
+
+  def memory_usage(self):
+    "rough bytes used by the tables this transaction sees (see table.Table.memory_usage)"
+    return sum(table_.memory_usage() for table_ in self.levels[-1].values())
+
+  def memory_view(self):
+    "helper for __getitem__. the MEMORY_VIEW table, built for each lookup"
+    view = table.Table(MEMORY_VIEW, MEMORY_VIEW_COLS, [])
+    view.rows = [[name, len(table_.rows), table_.memory_usage()] for name, table_ in sorted(self.levels[-1].items())]
+    return view
+
+  def check_memory(self, before):
+    "helper for execute. enforce the db's memory limits on a write that started with before bytes (None if there are no limits)"
+    if before is None:
+      return
+    used = self.memory_usage()
+    if self.db.memory_hard_limit is not None and used > self.db.memory_hard_limit and used > before:
+      raise MemoryLimitExceeded('memory_hard_limit', used, self.db.memory_hard_limit)
+    if self.db.memory_soft_limit is not None and used > self.db.memory_soft_limit and used > before:
+      warnings.warn(MemoryLimitWarning('memory_soft_limit', used, self.db.memory_soft_limit), stacklevel=2)
+
+  def check_rows(self, count, width):
+    if self.db.memory_hard_limit is None:
+      return
+    size = count * (COMPOSITE_ROW_BYTES + table.POINTER_BYTES * width)
+    if self.memory_usage() + size > self.db.memory_hard_limit:
+      raise MemoryLimitExceeded('result_too_big', count, size, self.db.memory_hard_limit)
+
+  def memory_before(self, ex):
+    "helper for execute. usage before a write if the db has memory limits, else None (see check_memory)"
+    if isinstance(ex, self.WRITES) and (self.db.memory_hard_limit is not None or self.db.memory_soft_limit is not None):
+      return self.memory_usage()
+    return None
+
+  def refresh(self):
+    "take a new snapshot of the committed tables"
+    # note: seq is read before committed and publish() writes them in the other order, so base_seq is never newer than the snapshot
+    self.base_seq = self.db.seq
+    self.levels = [dict(self.db.committed)]
+    self.base_sequences = self.db.committed_sequences
+    self.sequences = dict(self.base_sequences)
+
+  def execute(self, ex, stream=False):
+    "run a bound statement (not start / commit / rollback). with stream, a select returns a ResultStream instead of a list"
+    with self.lock:
+      prev, self.db.local.txn = getattr(self.db.local, 'txn', None), self
+      try:
+        if not isinstance(ex, self.READS):
+          self.drain_streams()
+        if self.implicit and isinstance(ex, self.WRITES):
+          return self.execute_implicit(ex)
+        if not self.writing and self.isolation == 'read committed':
+          self.refresh()
+        if isinstance(ex, sqparse2.SelectX) and ex.lock:
+          return self.select_for(ex)
+        if stream and isinstance(ex, self.READS):
+          return self.stream_select(ex)
+        # a read committed transaction's first write can start over on a new snapshot if it had to wait for another writer's rows
+        retry = not self.writing and self.isolation == 'read committed' and isinstance(ex, self.WRITES)
+        self.writing = self.writing or isinstance(ex, self.WRITES)
+        mark = len(self.undo)
+        before = self.memory_before(ex)
+        try:
+          while True:
+            with self.table_locks(ex):
+              ret = self.run_statement(ex)
+              self.check_memory(before)
+            resources = self.lock_rows(self.undo[mark:], 'exclusive') # note: outside lock_tables because this can wait
+            if not (retry and self.db.changed_since(self.base_seq, resources)):
+              return ret
+            self.undo_to(mark)
+            self.copied, self.ddl_tables, self.index_tables = set(), set(), set()
+            self.refresh()
+        except Exception:
+          self.undo_to(mark) # a failed statement doesn't leave half its changes behind
+          raise
+      finally:
+        self.db.local.txn = prev
+
+  def stream_select(self, ex):
+    "helper for execute. see ResultStream"
+    with self.table_locks(ex): # registered before these are released, so an in-place write that waited for them drains it
+      rows = sqex.iter_select(sqex.replace_subqueries(ex, self, table.Table), self, table.Table)
+      ret = ResultStream(self.db, rows, self.db.families(sqex.statement_tables(ex)))
+      self.db.open_stream(ret)
+    self.streams.add(ret)
+    return ret
+
+  def drain_streams(self):
+    "helper for execute. writes (and rollback to savepoint) change this transaction's tables in place, so open streams read ahead first"
+    for result in list(self.streams):
+      result.drain()
+
+  def execute_implicit(self, ex):
+    "helper for execute. implicit transactions' writes, see class docstring"
+    names, writes = sqex.statement_tables(ex), self.target_tables(ex)
+    while True:
+      with self.db.lock_tables(names, writes), self.db.in_place_write(writes) as in_place:
+        self.reset()
+        self.refresh()
+        self.writing, self.in_place = True, in_place
+        before = self.memory_before(ex)
+        try:
+          ret = self.run_statement(ex)
+          self.check_memory(before)
+          if self.in_place:
+            self.db.publish(self, self.write_keys(), check=False)
+            return ret
+        except Exception:
+          self.undo_to(0)
+          raise
+        finally:
+          self.stop_logging()
+      try:
+        self.lock_rows(self.undo, 'exclusive')
+        self.finish(True)
+        return ret
+      except SerializationError as err:
+        if isinstance(err, DeadlockDetected):
+          raise
+        # another transaction committed one of the rows while this waited for its lock. try again with its changes
+      finally:
+        self.db.locks.release_all(self)
+
+  @staticmethod
+  def target_tables(ex):
+    "helper for execute_implicit. names of the tables a write statement changes"
+    if isinstance(ex, (sqparse2.InsertX, sqparse2.DeleteX)):
+      return {ex.table}
+    elif isinstance(ex, sqparse2.UpdateX):
+      return set(ex.tables)
+    elif isinstance(ex, sqparse2.CreateX):
+      return set(ex.inherits or ()) # i.e. the parent's child_tables
+    elif isinstance(ex, sqparse2.DropX):
+      return {ex.name}
+    elif isinstance(ex, sqparse2.IndexX):
+      return {ex.table}
     else:
-      with self.lock:
-        yield
+      return set()
+
+  def select_for(self, ex):
+    "helper for execute. SELECT .. FOR UPDATE / FOR SHARE"
+    mode = 'exclusive' if ex.lock == 'update' else 'share'
+    try:
+      while True:
+        with self.table_locks(ex):
+          rows = sqex.selected_rows(sqex.replace_subqueries(ex, self, table.Table), self, table.Table)
+          resources = [(name, self[name].pkey_index.row_key(row)) for name, row in rows]
+        self.db.locks.acquire(self, resources, mode, self.db.lock_timeout)
+        if self.implicit:
+          self.refresh() # it doesn't keep the locks, so there's no need to check they cover what it reads
+          break
+        stale = self.db.changed_since(self.base_seq, resources)
+        if stale is None:
+          break
+        if self.writing or self.isolation != 'read committed':
+          raise SerializationError('could_not_serialize', stale)
+        self.refresh() # i.e. a transaction that had the lock changed the rows. look again
+      with self.table_locks(ex):
+        return self.run_statement(ex)
+    finally:
+      if self.implicit:
+        self.db.locks.release_all(self)
+
+  def table_locks(self, ex):
+    """TablesDict.lock_tables for a statement that doesn't change committed tables in place.
+    Only implicit transactions need it: an open transaction and an in-place write can't overlap (see TablesDict.in_place_write).
+    """
+    return self.db.lock_tables(sqex.statement_tables(ex)) if self.implicit else contextlib.nullcontext()
+
+  def lock_rows(self, entries, mode):
+    "lock the rows in some of self.undo. returns the resources (see LockManager)"
+    resources = [(entry.table.name, entry.table.pkey_index.row_key(row)) for entry in entries for row in self.changed_rows(entry)]
+    if resources:
+      self.db.locks.acquire(self, resources, mode, self.db.lock_timeout)
+    return resources
+
+  def stop_logging(self):
+    for name in self.copied:
+      if name in self.levels[0]:
+        self.levels[0][name].log = None # these can be written outside this transaction now
+
+  def finish(self, commit):
+    "helper for TablesDict.trans_commit / trans_rollback"
+    with self.lock:
+      try:
+        if commit and self.writing:
+          writes = self.write_keys()
+          with (self.db.lock_tables(writes) if self.implicit else contextlib.nullcontext()):
+            self.db.publish(self, writes, check=True)
+      finally:
+        self.stop_logging()
+        self.writing = False
+        self.db.locks.release_all(self)
+
+  @staticmethod
+  def changed_rows(entry):
+    "the rows (all versions) that an UndoEntry changed"
+    if entry.op == 'delete':
+      return [row for _, row in entry.changes]
+    elif entry.op == 'insert':
+      return entry.changes
+    elif entry.op == 'update': # row is the latest version, old covers the versions in between
+      return [row for pair in entry.changes for row in pair]
+    else:
+      return []
+
+  def write_keys(self):
+    """the write set, {table_name: set of pkey keys}, from the undo log. None instead of a set means the whole table,
+    which is the case for tables without a pkey, DDL and tables in an inheritance family.
+    """
+    keys = {name: None for name in self.ddl_tables | self.index_tables}
+    for entry in self.undo:
+      if entry.op == 'ddl':
+        continue
+      table_ = entry.table
+      if not table_.pkey or table_.parent_table or table_.child_tables:
+        for name in (self.family(table_.name) if table_.name in self else [table_.name]):
+          keys[name] = None
+        continue
+      if keys.get(table_.name, ()) is None:
+        continue
+      keys.setdefault(table_.name, set()).update(map(table_.pkey_index.row_key, self.changed_rows(entry)))
+    return keys
+
+  def family(self, name):
+    "names of the tables connected to name by inheritance, including name"
+    names, todo = set(), [self[name]]
+    while todo:
+      table_ = todo.pop()
+      if table_.name not in names:
+        names.add(table_.name)
+        todo.extend(table_.child_tables)
+        if table_.parent_table:
+          todo.append(table_.parent_table)
+    return names
+
+  def writable(self, name):
+    """the table for a statement that's about to modify it.
+    The first write copies the table so the committed level doesn't change (copy-on-write).
+      The rest of the inheritance family gets copied along with it so parent / child links stay inside one level.
+    Implicit transactions can write in place (see class docstring).
+    """
+    if name in self.copied:
+      return self[name]
+    if self.in_place and not self[name].shared:
+      self[name].log = self.undo
+      self.copied.add(name)
+      return self[name]
+    family = self.family(name)
+    copies = {fname: self[fname].copy() for fname in family}
+    for copy_ in copies.values():
+      copy_.parent_table = copy_.parent_table and copies[copy_.parent_table.name]
+      copy_.child_tables = [copies[child.name] for child in copy_.child_tables]
+    for copy_ in copies.values():
+      copy_.log = self.undo
+      # the table can come from another database (see TablesDict.clone); its serial columns use this one's sequences
+      copy_.serials = {col: self.sequences.get(seq.name, seq) for col, seq in copy_.serials.items()}
+    self.update(copies)
+    self.copied |= family
+    return copies[name]
+
+  def ddl_snapshot(self):
+    "undo entry for create / drop statements. these are rare, so it's simplest to remember everything they can change"
+    level = self.levels[-1]
+    tables = [(t, list(t.child_tables), t.parent_table, dict(t.indexes)) for t in level.values()]
+    return table.UndoEntry('ddl', None, (dict(level), set(self.copied), dict(self.sequences), tables))
+
+  def undo_to(self, mark):
+    "undo this transaction's changes back to len(self.undo) == mark"
+    while len(self.undo) > mark:
+      entry = self.undo.pop()
+      if entry.op == 'ddl':
+        level, copied, sequences, tables = entry.changes
+        self.levels[-1].clear()
+        self.levels[-1].update(level)
+        self.copied, self.sequences = copied, sequences
+        for table_, child_tables, parent_table, indexes in tables:
+          table_.child_tables, table_.parent_table, table_.indexes = child_tables, parent_table, indexes
+      else:
+        entry.table.undo(entry)
+
+  def savepoint(self, name):
+    if self.implicit:
+      raise RuntimeError('savepoint not in transaction')
+    self.savepoints.append((name, len(self.undo)))
+
+  def find_savepoint(self, name):
+    "index into self.savepoints of the newest savepoint called name"
+    if self.implicit:
+      raise RuntimeError('savepoint not in transaction')
+    for i in reversed(range(len(self.savepoints))):
+      if self.savepoints[i][0] == name:
+        return i
+    raise KeyError(name)
+
+  def rollback_to(self, name):
+    "undo back to the savepoint. the savepoint stays, later ones go away"
+    i = self.find_savepoint(name)
+    self.undo_to(self.savepoints[i][1])
+    del self.savepoints[i + 1:]
+
+  def release(self, name):
+    "forget the savepoint and the ones after it; their changes stay"
+    del self.savepoints[self.find_savepoint(name):]
 
   def cascade_delete(self, name):
     "this fails under diamond inheritance"
@@ -94,36 +481,84 @@ class TablesDict:
     del self[name]
 
   def create(self, ex):
-    "helper for apply_sql in CreateX case"
+    "helper for run_statement in CreateX case"
     if ex.name in self:
       if ex.nexists:
         return
       raise ValueError('table_exists', ex.name)
+    pkey = ex.pkey # note: don't write this back to ex, it can be a shared StatementTemplate tree
     if any(c.pkey for c in ex.cols):
-      if ex.pkey:
+      if pkey:
         raise sqparse2.SQLSyntaxError("don't mix table-level and column-level pkeys", ex)
       # todo(spec): is multi pkey permitted when defined per column?
-      ex.pkey = sqparse2.PKeyX([c.name for c in ex.cols if c.pkey])
+      pkey = sqparse2.PKeyX([c.name for c in ex.cols if c.pkey])
+    self.copied.add(ex.name) # new tables belong to the transaction already
+    self.ddl_tables.add(ex.name)
     if ex.inherits:
       # todo: what if child table specifies constraints etc? this needs work.
       if len(ex.inherits) > 1:
         raise NotImplementedError('todo: multi-table inherit')
-      parent = self[ex.inherits[0]] = copy.deepcopy(self[ex.inherits[0]]) # copy so rollback works
+      parent = self.writable(ex.inherits[0])
+      self.ddl_tables.add(parent.name)
       child = self[ex.name] = table.Table(ex.name, parent.fields, parent.pkey)
       parent.child_tables.append(child)
       child.parent_table = parent
+      child.serials = dict(parent.serials) # children share the parent's sequences, like a copied default would
+      child.log = self.undo
     else:
-      self[ex.name] = table.Table(ex.name, ex.cols, ex.pkey.fields if ex.pkey else [])
+      table_ = self[ex.name] = table.Table(ex.name, ex.cols, pkey.fields if pkey else [])
+      table_.log = self.undo
+      for col in ex.cols:
+        if col.coltp.type.lower() == 'serial':
+          # note: postgres serials start at 1. these start at 0 to match what the max()+1 default used to do.
+          seq = table_.serials[col.name] = table.Sequence(ex.name + '_' + col.name + '_seq', start=0)
+          self.sequences[seq.name] = seq
+
+  def create_sequence(self, ex):
+    "helper for run_statement in CreateSequenceX case"
+    if ex.name in self.sequences:
+      if ex.nexists:
+        return
+      raise ValueError('sequence_exists', ex.name)
+    increment = 1 if ex.increment is None else ex.increment
+    start = ex.start if ex.start is not None else 1 if increment > 0 else -1
+    self.sequences[ex.name] = table.Sequence(ex.name, start, increment)
+
+  def drop_sequence(self, ex):
+    "helper for run_statement in DropSequenceX case"
+    if ex.name not in self.sequences:
+      if ex.ifexists:
+        return
+      raise KeyError(ex.name)
+    del self.sequences[ex.name]
+
+  def create_index(self, ex):
+    "helper for run_statement in IndexX case"
+    if ex.table is None:
+      return # i.e. an expression index. the statement is accepted but there's no index to build.
+    table_ = self.writable(ex.table)
+    self.index_tables.add(ex.table)
+    name = ex.name or ex.table + '_' + '_'.join(ex.cols) + '_idx'
+    if name in table_.indexes:
+      if ex.nexists:
+        return
+      raise ValueError('index_exists', name)
+    table_.create_index(name, ex.cols, ex.unique)
 
   def drop(self, ex):
-    "helper for apply_sql in DropX case"
+    "helper for run_statement in DropX case"
     # todo: factor out inheritance logic (for readability)
     if ex.name not in self:
       if ex.ifexists:
         return
       raise KeyError(ex.name)
-    table_ = self[ex.name]
+    table_ = self.writable(ex.name)
+    self.ddl_tables.update(self.family(ex.name))
     parent = table_.parent_table
+    if not parent: # children share the parent's serial sequences
+      for seq in table_.serials.values():
+        if self.sequences.get(seq.name) is seq:
+          del self.sequences[seq.name]
     if table_.child_tables:
       if not ex.cascade:
         raise table.IntegrityError('delete_parent_without_cascade', ex.name)
@@ -132,38 +567,390 @@ class TablesDict:
     if parent:
       parent.child_tables.remove(table_)
 
-  # pylint: disable=inconsistent-return-statements
-  def apply_sql(self, ex, values, lockref):
+  # pylint: disable=inconsistent-return-statements,too-many-branches
+  def run_statement(self, ex):
+    "helper for execute"
+    if self.writing and isinstance(ex, self.DDL):
+      self.undo.append(self.ddl_snapshot())
+    ex = sqex.replace_subqueries(ex, self, table.Table)
+    if isinstance(ex, self.READS):
+      return sqex.run_select(ex, self, table.Table)
+    elif isinstance(ex, sqparse2.InsertX):
+      return self.writable(ex.table).insert(ex.cols, ex.values, ex.ret, self)
+    elif isinstance(ex, sqparse2.UpdateX):
+      if len(ex.tables) != 1:
+        raise NotImplementedError('multi-table update')
+      return self.writable(ex.tables[0]).update(ex.assigns, ex.where, ex.ret, self)
+    elif isinstance(ex, sqparse2.CreateX):
+      self.create(ex)
+    elif isinstance(ex, sqparse2.IndexX):
+      self.create_index(ex)
+    elif isinstance(ex, sqparse2.CreateSequenceX):
+      self.create_sequence(ex)
+    elif isinstance(ex, sqparse2.DropSequenceX):
+      self.drop_sequence(ex)
+    elif isinstance(ex, sqparse2.DeleteX):
+      return self.writable(ex.table).delete(ex.where, self)
+    elif isinstance(ex, sqparse2.SavepointX):
+      self.savepoint(ex.name)
+    elif isinstance(ex, sqparse2.RollbackToX):
+      self.rollback_to(ex.name)
+    elif isinstance(ex, sqparse2.ReleaseX):
+      self.release(ex.name)
+    elif isinstance(ex, sqparse2.DropX):
+      self.drop(ex)
+    else:
+      raise TypeError(type(ex)) # pragma: no cover
+
+class TablesDict: # pylint: disable=too-many-instance-attributes
+  """the database: the committed tables plus the open transactions, keyed by owner (see apply_sql).
+  Indexing it directly (i.e. tables_dict['t1'] in tests) gives the current thread's open transaction if it has one, else the committed tables.
+  """
+  # todo: bite the bullet and rename this Database
+  def __init__(self):
+    self.committed = {} # {name: Table}. replaced (not modified) when a transaction commits, so readers can hold on to it
+    self.committed_sequences = {} # {name: table.Sequence}
+    self.seq = 0 # bumped by every commit that writes
+    self.history = {} # {table_name: [(seq, keys), ...]} the write sets of recent commits (see Transaction.write_keys)
+    self.commit_lock = threading.Lock()
+    self.table_locks = {} # {name: ReadWriteLock}, see lock_tables
+    self.in_place_cond = threading.Condition()
+    self.in_place_writers = 0 # see in_place_write
+    self.streams = weakref.WeakSet() # open ResultStreams, see in_place_write
+    self.locks = locks.LockManager()
+    self.lock_timeout = None # seconds to wait for a row lock before LockNotAvailable. None waits for as long as it takes
+    self.transactions = {} # {owner: Transaction}
+    self.local = threading.local()
+    self.isolation = 'read committed' # default for trans_start
+    self.wal = None # a WriteAheadLog for databases from open()
+    self.wal_dir = None
+    self.wal_sequences = {} # {name: (start, increment, value)} as of the last WAL record
+    self.checkpoint_every = None
+    self.wal_commits = 0 # since the last checkpoint
+    self.checkpoint_lock = threading.Lock()
+    self.memory_soft_limit = None # bytes (see table.Table.memory_usage). writes that leave the db over it warn (MemoryLimitWarning)
+    self.memory_hard_limit = None # bytes. writes and joins that would go over it fail with MemoryLimitExceeded
+
+  def view(self):
+    "what direct indexing sees; see class docstring"
+    txn = getattr(self.local, 'txn', None)
+    if txn is not None:
+      return txn
+    if not hasattr(self.local, 'view'):
+      self.local.view = View(None, None)
+    if len(self.local.view.levels) == 1: # i.e. not inside tempkeys()
+      self.local.view.levels[0], self.local.view.sequences = self.committed, self.committed_sequences
+    return self.local.view
+
+  def __getitem__(self, k):
+    return self.view()[k]
+
+  def __setitem__(self, key, val):
+    self.view()[key] = val
+
+  def __contains__(self, key):
+    return key in self.view()
+
+  def __delitem__(self, key):
+    del self.view()[key]
+
+  def update(self, *args, **kwargs):
+    self.view().update(*args, **kwargs)
+
+  def __iter__(self):
+    return iter(self.view())
+
+  def keys(self):
+    return self.view().keys()
+
+  def values(self):
+    return self.view().values()
+
+  def items(self):
+    return self.view().items()
+
+  def tempkeys(self):
+    return self.view().tempkeys()
+
+  def check_rows(self, count, width):
+    return self.view().check_rows(count, width)
+
+  @property
+  def sequences(self):
+    return self.view().sequences
+
+  @contextlib.contextmanager
+  def lock_tables(self, reads, writes=()):
+    """lock tables (names) for the length of an implicit transaction's statement. Only in-place writes need writes;
+    everything else reads either copies or tables nobody changes in place. Inheritance families are locked together.
+    Locks are taken in sorted order so statements can't deadlock on each other.
+    """
+    writes = self.families(writes)
+    with contextlib.ExitStack() as stack:
+      for name in sorted(self.families(reads) | writes):
+        lock = self.table_locks.get(name) or self.table_locks.setdefault(name, locks.ReadWriteLock())
+        stack.enter_context(lock.write() if name in writes else lock.read())
+      yield
+
+  @contextlib.contextmanager
+  def in_place_write(self, writes):
+    """yields whether an implicit transaction's write (to the tables named in writes) can change committed tables in place,
+    i.e. whether no transaction is open. trans_start waits for in-place writes to finish, so open transactions' snapshots
+    never see one half done. Open ResultStreams that read one of the tables are drained first; the caller holds the
+    tables' write locks (see lock_tables), so no new stream can start on them in the meantime.
+    """
+    names = self.families(writes)
+    with self.in_place_cond:
+      in_place = not self.transactions
+      self.in_place_writers += in_place
+      streams = [stream for stream in self.streams if stream.names & names] if in_place else []
+    try:
+      for stream in streams:
+        stream.drain()
+      yield in_place
+    finally:
+      if in_place:
+        with self.in_place_cond:
+          self.in_place_writers -= 1
+          self.in_place_cond.notify_all()
+
+  def open_stream(self, stream):
+    "for Transaction.stream_select. see in_place_write"
+    with self.in_place_cond:
+      self.streams.add(stream)
+
+  def close_stream(self, stream):
+    with self.in_place_cond:
+      self.streams.discard(stream)
+
+  def families(self, names):
+    "helper for lock_tables. names plus the tables connected to them by inheritance"
+    ret, todo, committed = set(), list(names), self.committed
+    while todo:
+      name = todo.pop()
+      if name in ret:
+        continue
+      ret.add(name)
+      table_ = committed.get(name)
+      if table_ is not None:
+        todo.extend(child.name for child in table_.child_tables)
+        if table_.parent_table:
+          todo.append(table_.parent_table.name)
+    return ret
+
+  def changed_since(self, seq, resources):
+    "name of a table where a commit newer than seq wrote one of the resources (see LockManager), or None"
+    with self.commit_lock:
+      for name, key in resources:
+        for other_seq, keys in self.history.get(name, ()):
+          if other_seq > seq and (keys is None or key in keys):
+            return name
+    return None
+
+  def publish(self, txn, writes, check):
+    """helper for Transaction. make txn's writes (see Transaction.write_keys) the committed state.
+    With check, first look for commits since txn's snapshot; see Transaction.
+    """
+    with self.commit_lock:
+      level = txn.levels[0]
+      merged = {}
+      for name, keys in (writes.items() if check else ()):
+        newer = [other for seq, other in self.history.get(name, ()) if seq > txn.base_seq]
+        if not newer:
+          continue
+        if keys is None or any(other is None or other & keys for other in newer) or name not in self.committed or name not in level:
+          raise SerializationError('could_not_serialize', name)
+        merged[name] = self.committed[name].merge(level[name], keys)
+      if check and txn.isolation == 'serializable':
+        for name in txn.reads:
+          if any(seq > txn.base_seq for seq, _ in self.history.get(name, ())):
+            raise SerializationError('could_not_serialize', name)
+      committed = dict(self.committed)
+      for name in writes:
+        if name in level:
+          committed[name] = merged.get(name, level[name])
+        else:
+          committed.pop(name, None)
+      sequences = dict(self.committed_sequences)
+      for name in set(txn.base_sequences) - set(txn.sequences):
+        sequences.pop(name, None)
+      sequences.update((name, seq) for name, seq in txn.sequences.items() if name not in txn.base_sequences)
+      self.committed_sequences = sequences
+      self.committed = committed
+      self.seq += 1
+      for name, keys in writes.items():
+        self.history.setdefault(name, []).append((self.seq, keys))
+      self.prune_history()
+      number = self.log_commit(txn, committed) if self.wal is not None else None
+    if number is not None:
+      self.wal.sync_to(number)
+
+  def log_commit(self, txn, committed):
+    "helper for publish. append the commit to the WAL; returns the record number or None if nothing changed"
+    sequences = {name: (seq.start, seq.increment, seq.value) for name, seq in self.committed_sequences.items()}
+    changed = {name: state for name, state in sequences.items() if self.wal_sequences.get(name) != state}
+    changed.update((name, None) for name in self.wal_sequences if name not in sequences)
+    record = {'tables': storage.wal_changes(txn.undo, txn.ddl_tables, txn.index_tables, committed), 'sequences': changed}
+    if not record['tables'] and not changed:
+      return None
+    self.wal_sequences = sequences
+    self.wal_commits += 1
+    return self.wal.append(record)
+
+  @classmethod
+  def open(cls, directory, sync='always', sync_interval=0.05, checkpoint_every=1000):
+    """a durable database in directory (created if it doesn't exist): the last checkpoint's snapshot with the WAL replayed on top.
+    Commits are logged to the WAL (see WriteAheadLog for sync and sync_interval). Every checkpoint_every logged commits,
+      the committing thread writes a new snapshot and starts an empty WAL (see checkpoint).
+    """
+    os.makedirs(directory, exist_ok=True)
+    snapshot, wal, old = storage.wal_paths(directory)
+    ret = cls.load(snapshot) if os.path.exists(snapshot) else cls()
+    replayed = False
+    for path in (old, wal): # old is there if the process died during a checkpoint
+      if os.path.exists(path):
+        for record in storage.WriteAheadLog.read(path):
+          storage.replay(ret.committed, ret.committed_sequences, record)
+          replayed = True
+    if replayed:
+      storage.write_snapshot(snapshot + '.tmp', ret.committed, *storage.snapshot_state(ret.committed, ret.committed_sequences))
+      os.replace(snapshot + '.tmp', snapshot)
+    for path in (old, wal):
+      if os.path.exists(path):
+        os.remove(path)
+    ret.wal_dir, ret.checkpoint_every = directory, checkpoint_every
+    ret.wal_sequences = {name: (seq.start, seq.increment, seq.value) for name, seq in ret.committed_sequences.items()}
+    ret.wal = storage.WriteAheadLog(wal, sync, sync_interval)
+    return ret
+
+  def checkpoint(self):
+    """write the committed state as the snapshot and empty the WAL, so open doesn't have as much to replay.
+    Every commit has to end up in exactly one of the snapshot and the new WAL. So the log rotates under commit_lock, and
+      the tables are pickled before the table locks are released; in-place writes change tables without copying them.
+    """
+    snapshot, _, old = storage.wal_paths(self.wal_dir)
+    with self.checkpoint_lock:
+      while True:
+        names = self.families(self.committed)
+        with self.lock_tables(names):
+          with self.commit_lock:
+            if not names.issuperset(self.committed):
+              continue # a table was created since; lock it too
+            committed, sequences = self.committed, self.committed_sequences
+            self.wal.rotate(old)
+            self.wal_commits = 0
+          state = storage.snapshot_state(committed, sequences)
+        break
+      storage.write_snapshot(snapshot + '.tmp', committed, *state)
+      os.replace(snapshot + '.tmp', snapshot)
+      os.remove(old)
+
+  def maybe_checkpoint(self):
+    if self.wal is not None and self.wal_commits >= self.checkpoint_every:
+      self.checkpoint()
+
+  def close(self):
+    "close the WAL, if there is one"
+    if self.wal is not None:
+      self.wal.close()
+      self.wal = None
+
+  def prune_history(self):
+    "helper for publish. forget commits that no open transaction's snapshot is older than"
+    oldest = min((txn.base_seq for txn in list(self.transactions.values())), default=self.seq)
+    for name in list(self.history):
+      self.history[name] = [entry for entry in self.history[name] if entry[0] > oldest]
+      if not self.history[name]:
+        del self.history[name]
+
+  def clone(self):
+    """a new database with the committed tables, i.e. for starting each test from one loaded template.
+    The tables aren't copied: both databases share them until one writes to a table, which copies it (see Table.shared).
+    So a clone costs the number of tables, not rows. Sequences are copied because they aren't transactional.
+    """
+    ret = TablesDict()
+    with self.commit_lock:
+      committed, sequences = self.committed, self.committed_sequences
+    with self.lock_tables(committed): # i.e. not halfway through an autocommit write
+      for table_ in committed.values():
+        table_.shared = True
+    ret.committed = dict(committed)
+    ret.committed_sequences = {name: seq.copy() for name, seq in sequences.items()}
+    ret.isolation, ret.lock_timeout = self.isolation, self.lock_timeout
+    return ret
+
+  def memory_usage(self):
+    """{table name: (row count, rough bytes)} for the committed tables. tables shared with clones (see clone) count in each database.
+    sizes are kept up to date as rows change, so this is cheap. SQL can see the same thing (for its transaction) in MEMORY_VIEW
+    """
+    with self.commit_lock:
+      committed = self.committed
+    return {name: (len(table_.rows), table_.memory_usage()) for name, table_ in committed.items()}
+
+  def save(self, path):
+    "write the committed tables and sequences to a snapshot file (see storage.write_snapshot). See load."
+    with self.commit_lock:
+      committed, sequences = self.committed, self.committed_sequences
+    with self.lock_tables(committed): # i.e. not halfway through an autocommit write
+      state = storage.snapshot_state(committed, sequences)
+    storage.write_snapshot(path, committed, *state)
+
+  @classmethod
+  def load(cls, path):
+    """a new TablesDict from a file written by save. Statements aren't parsed or run; tables and indexes are restored directly.
+    The file is memory-mapped and read-only, so loading a big snapshot doesn't read it into a bytes object first.
+    """
+    ret = cls()
+    ret.committed, ret.committed_sequences = storage.read_snapshot(path)
+    return ret
+
+  def trans_start(self, lockref, isolation=None):
+    if lockref in self.transactions:
+      raise RuntimeError('already_in_transaction', lockref)
+    with self.in_place_cond:
+      while self.in_place_writers:
+        self.in_place_cond.wait()
+      self.transactions[lockref] = self.local.txn = Transaction(self, lockref, False, isolation or self.isolation)
+
+  def end_transaction(self, lockref, commit):
+    if lockref not in self.transactions:
+      raise RuntimeError(('commit' if commit else 'rollback') + ' not in transaction')
+    txn = self.transactions[lockref]
+    try:
+      txn.finish(commit)
+    finally:
+      del self.transactions[lockref] # after finish so prune_history keeps what txn's commit checks
+      if getattr(self.local, 'txn', None) is txn:
+        self.local.txn = None
+
+  def trans_commit(self, lockref=None):
+    self.end_transaction(lockref, True)
+    self.maybe_checkpoint()
+
+  def trans_rollback(self, lockref=None):
+    self.end_transaction(lockref, False)
+
+  def apply_sql(self, ex, values, lockref, stream=False):
     """call the stmt in tree with values subbed on the tables in t_d.
-    ex is a parsed statement returned by parse_expression.
+    ex is a parsed statement returned by sqparse2.parse, or a sqparse2.StatementTemplate (which isn't modified).
     values is the tuple of %s replacements.
     lockref can be anything as long as it stays the same; it's used for assigning tranaction ownership.
       (safest is to make it a pgmock_dbapi2.Connection, because that will rollback on close)
+    stream makes selects return a ResultStream (rows computed as they're read) instead of a list.
     """
-    sqex.depth_first_sub(ex, values)
-    with self.lock_db(lockref, isinstance(ex, sqparse2.StartX)):
-      sqex.replace_subqueries(ex, self, table.Table)
-      if isinstance(ex, sqparse2.SelectX):
-        return sqex.run_select(ex, self, table.Table)
-      elif isinstance(ex, sqparse2.InsertX):
-        return self[ex.table].insert(ex.cols, ex.values, ex.ret, self)
-      elif isinstance(ex, sqparse2.UpdateX):
-        if len(ex.tables) != 1:
-          raise NotImplementedError('multi-table update')
-        return self[ex.tables[0]].update(ex.assigns, ex.where, ex.ret, self)
-      elif isinstance(ex, sqparse2.CreateX):
-        self.create(ex)
-      elif isinstance(ex, sqparse2.IndexX):
-        pass
-      elif isinstance(ex, sqparse2.DeleteX):
-        return self[ex.table].delete(ex.where, self)
-      elif isinstance(ex, sqparse2.StartX):
-        self.trans_start(lockref)
-      elif isinstance(ex, sqparse2.CommitX):
-        self.trans_commit()
-      elif isinstance(ex, sqparse2.RollbackX):
-        self.trans_rollback()
-      elif isinstance(ex, sqparse2.DropX):
-        self.drop(ex)
-      else:
-        raise TypeError(type(ex)) # pragma: no cover
+    if isinstance(ex, sqparse2.StatementTemplate):
+      ex = ex.bind(values)
+    else:
+      sqex.depth_first_sub(ex, values)
+    if isinstance(ex, sqparse2.StartX):
+      return self.trans_start(lockref)
+    elif isinstance(ex, sqparse2.CommitX):
+      return self.trans_commit(lockref)
+    elif isinstance(ex, sqparse2.RollbackX):
+      return self.trans_rollback(lockref)
+    txn = self.transactions.get(lockref)
+    if txn is not None:
+      return txn.execute(ex, stream)
+    ret = Transaction(self, lockref, True).execute(ex, stream)
+    self.maybe_checkpoint()
+    return ret
@@ -1,27 +1,120 @@
 "dbapi2 interface to pgmock"
 
-import functools, contextlib, collections
+import functools, contextlib, collections, itertools, threading, time
 from . import pgmock, sqparse2, pg
 # pylint: disable=arguments-differ
 
 # globals
 # pylint: disable=invalid-name
 apilevel = '2.0'
-threadsafety = 1 # 1 means module-level. I think pgmock with transaction locking as-is is fully threadsafe, so write tests and bump this to 3.
+threadsafety = 3 # threads can share connections too. statements on one connection run one at a time; see pgmock.Transaction
 paramstyle = 'format'
 
 # global dictionary of databases (necessary so different connections can access the same DB)
 DATABASES = {}
 NEXT_DB_ID = 0
-
-def add_db():
+# Databases that a Connection or PgPoolMock created for itself (db_id=None) are dropped when the last Connection / PgPoolMock
+#   using them closes. Ones from add_db / load_db / open_db stay until drop_db, or until evict_idle if IDLE_TIMEOUT is set.
+HOLDERS = collections.Counter() # {db_id: open Connections + PgPoolMocks}
+OWNED = set() # db_ids to drop when their holders go to 0
+LAST_USED = {} # {db_id: time.monotonic() of the last acquire / release}
+IDLE_TIMEOUT = None # seconds. when set, add_db evicts databases that nothing has held for this long (see evict_idle)
+DB_LOCK = threading.RLock() # reentrant: Connection.__del__ -> release_db can run from gc while this thread holds it
+
+def register_db(db):
+  "helper for add_db, load_db and open_db. gives a ready-made pgmock.TablesDict a db_id, so a failed load never leaves a db behind"
   # pylint: disable=global-statement
   global NEXT_DB_ID
-  db_id, NEXT_DB_ID = NEXT_DB_ID, NEXT_DB_ID + 1
-  DATABASES[db_id] = pgmock.TablesDict()
+  if IDLE_TIMEOUT is not None:
+    evict_idle(IDLE_TIMEOUT)
+  with DB_LOCK:
+    db_id, NEXT_DB_ID = NEXT_DB_ID, NEXT_DB_ID + 1
+    DATABASES[db_id] = db
+    LAST_USED[db_id] = time.monotonic()
+  return db_id
+
+def add_db(template=None):
+  "template is the db_id of a database to start from (see pgmock.TablesDict.clone). without one the new database is empty"
+  db_id = register_db(pgmock.TablesDict() if template is None else DATABASES[template].clone())
   print('created db %i' % db_id)
   return db_id
 
+def load_db(path):
+  "add a database from a pgmock.TablesDict.save snapshot file. returns its db_id"
+  return register_db(pgmock.TablesDict.load(path))
+
+def open_db(directory, **kwargs):
+  "add a durable database (see pgmock.TablesDict.open; kwargs go there). returns its db_id"
+  return register_db(pgmock.TablesDict.open(directory, **kwargs))
+
+def acquire_db(db_id, owned=False):
+  "helper for Connection and PgPoolMock. count a holder of db_id (see HOLDERS). owned means drop it when the holders go to 0"
+  with DB_LOCK:
+    if db_id not in DATABASES:
+      raise OperationalError('unk_db', db_id)
+    HOLDERS[db_id] += 1
+    LAST_USED[db_id] = time.monotonic()
+    if owned:
+      OWNED.add(db_id)
+    return DATABASES[db_id]
+
+def release_db(db_id):
+  "undo acquire_db"
+  with DB_LOCK:
+    HOLDERS[db_id] -= 1
+    LAST_USED[db_id] = time.monotonic()
+    if HOLDERS[db_id] > 0:
+      return
+    del HOLDERS[db_id]
+    if db_id not in OWNED:
+      return
+  drop_db(db_id)
+
+def drop_db(db_id, force=False):
+  """remove a database (closing its WAL if it has one), like DROP DATABASE. raises OperationalError if Connections or
+  PgPoolMocks are using it, unless force, in which case they keep working on it until they close but nothing new can connect.
+  Dropping an already-dropped db_id is a no-op.
+  """
+  with DB_LOCK:
+    if HOLDERS[db_id] and not force:
+      raise OperationalError('db_in_use', db_id, HOLDERS[db_id])
+    db = DATABASES.pop(db_id, None)
+    OWNED.discard(db_id)
+    LAST_USED.pop(db_id, None)
+  if db is not None:
+    db.close()
+
+def evict_idle(max_idle):
+  "drop the databases that no Connection or PgPoolMock has used for max_idle seconds. returns their db_ids"
+  cutoff = time.monotonic() - max_idle
+  with DB_LOCK:
+    idle = [db_id for db_id, used in LAST_USED.items() if used < cutoff and not HOLDERS[db_id]]
+  for db_id in idle:
+    try:
+      drop_db(db_id)
+    except OperationalError:
+      pass # a connection grabbed it in the meantime
+  return idle
+
+def memory_report():
+  """{db_id: {'tables': {name: (rows, bytes)}, 'bytes': total, 'holders': n, 'idle': seconds since last use}}.
+  Sizes are rough (see table.value_size) and take a walk over every row, so this is for diagnostics, not for polling.
+  """
+  with DB_LOCK:
+    dbs = dict(DATABASES)
+    holders, used = dict(HOLDERS), dict(LAST_USED)
+  now = time.monotonic()
+  ret = {}
+  for db_id, db in dbs.items():
+    tables = db.memory_usage()
+    ret[db_id] = {
+      'tables': tables,
+      'bytes': sum(size for _, size in tables.values()),
+      'holders': holders.get(db_id, 0),
+      'idle': 0. if holders.get(db_id) else now - used.get(db_id, now),
+    }
+  return ret
+
 # todo: catch pgmock errors and raise these
 class Error(Exception):
   pass
@@ -131,19 +224,22 @@ class Cursor(pg.Cursor):
   def __init__(self, connection):
     self.connection = connection
     self.arraysize = 1
-    self.rows = None
+    self.rows = None # iterator over the rows that haven't been fetched
+    self.stream = None # pgmock.ResultStream for a select's rows
     self.rownumber = None
     self.lastx = None
+    self._rowcount = -1
     # todo: self.lastrowid. SQLAlchemy uses it.
   @property
   def rowcount(self):
-    return -1 if self.rows is None else len(self.rows)
+    "-1 for selects, whose rows are computed as they're fetched"
+    return self._rowcount
   @property
   def description(self):
     "this is only a property so it can raise; make it an attr once it works"
     if self.lastx is None:
       return None
-    if not isinstance(self.lastx, (sqparse2.SelectX, sqparse2.UpdateX, sqparse2.InsertX)):
+    if not isinstance(self.lastx, (sqparse2.SelectX, sqparse2.SetOpX, sqparse2.UpdateX, sqparse2.InsertX)):
       return None
     if isinstance(self.lastx, (sqparse2.UpdateX, sqparse2.InsertX)) and self.lastx.ret is None:
       return None
@@ -151,32 +247,53 @@ class Cursor(pg.Cursor):
     if isinstance(self.lastx, (sqparse2.UpdateX, sqparse2.InsertX)):
       raise NotImplementedError('todo: Cursor.description for non-select')
     else: # select case
-      return [description_from_colx(self.connection, self.lastx, colx) for colx in self.lastx.cols.children]
+      selectx = self.lastx
+      while isinstance(selectx, sqparse2.SetOpX):
+        selectx = selectx.left # set operations are named after their first select
+      return [description_from_colx(self.connection, selectx, colx) for colx in selectx.cols.children]
   def callproc(self, procname, parameters=None):
     raise NotImplementedError("pgmock doesn't support stored procs yet")
   def __del__(self):
     self.close()
   def close(self):
-    pass # for now pgmock doesn't have cursor resources to close
+    "stop reading the current result, if any (see pgmock.ResultStream)"
+    if self.stream is not None:
+      self.stream.close()
+    self.rows = self.stream = None
   def execute(self, operation, parameters=None):
-    ex = self.lastx = sqparse2.parse(operation)
+    self.close()
+    template = sqparse2.parse_template(operation)
+    self.lastx = template.ex
     if not self.connection.transaction_open and not self.connection.autocommit:
       self.connection.begin()
-    self.rows = self.connection.db.apply_sql(ex, parameters or (), self.connection)
+    ret = self.connection.db.apply_sql(template, parameters or (), self.connection, stream=True)
+    if isinstance(ret, pgmock.ResultStream):
+      # the first row is computed now, so errors in simple queries come from execute like they would with a real db
+      self.stream, self._rowcount = ret, -1
+      self.rows = itertools.chain(list(itertools.islice(ret, 1)), ret)
+    else:
+      self.rows, self._rowcount = (None, -1) if ret is None else (iter(ret), len(ret))
     self.rownumber = 0 # always?
   def executemany(self, operation, seq_of_parameters):
     for param in seq_of_parameters:
       self.execute(operation, param)
   def fetchone(self):
-    ret = self.rows[self.rownumber]
-    self.rownumber += 1
+    "the next row, or None at the end"
+    if self.rows is None:
+      raise Error('no query to fetch')
+    ret = next(self.rows, None)
+    self.rownumber += ret is not None
     return ret
   def fetchmany(self, size=None):
-    raise NotImplementedError # hoping nobody cares about this one
+    if self.rows is None:
+      raise Error('no query to fetch')
+    ret = list(itertools.islice(self.rows, self.arraysize if size is None else size))
+    self.rownumber += len(ret)
+    return ret
   def fetchall(self):
     if self.rows is None:
       raise Error('no query to fetch')
-    ret, self.rows = self.rows, None
+    ret, self.rows = list(self.rows), None
     return ret
   def nextset(self):
     raise NotImplementedError('are we supporting multi result sets?')
@@ -191,8 +308,10 @@ class Cursor(pg.Cursor):
   def scroll(self, value, mode='relative'):
     raise NotImplementedError
   def __iter__(self):
-    rownum, self.rownumber = self.rownumber, None
-    return iter(self.rows[rownum:])
+    if self.rows is None:
+      raise Error('no query to fetch')
+    self.rownumber = None
+    return self.rows
 
 def open_only(f):
   "decorator -- raises an error if the function is called with self.closed == True"
@@ -206,13 +325,15 @@ def open_only(f):
 class Connection:
   # todo: does this need autocommit and begin()?
   def __init__(self, db_id=None):
-    "pass None as db_id to create a new pgmock database"
-    self.closed = False
+    "pass None as db_id to create a new pgmock database, which is dropped when the connection closes"
+    self.closed = True # until acquire_db succeeds, so __del__ doesn't release
     self.db_id = add_db() if db_id is None else db_id
-    self.db = DATABASES[self.db_id]
+    self.db = acquire_db(self.db_id, owned=db_id is None)
+    self.closed = False
     print('connected db %i' % self.db_id)
     self._autocommit = False
     self.transaction_open = False
+    self.isolation_level = None # None for the db's default. else one of pgmock.Transaction.ISOLATION_LEVELS
 
   @property
   def autocommit(self):
@@ -229,6 +350,7 @@ class Connection:
     if self.transaction_open:
       self.rollback()
     self.closed = True
+    release_db(self.db_id)
     self.db_id = None
     self.db = None
 
@@ -240,22 +362,24 @@ class Connection:
   def begin(self):
     if self.transaction_open:
       raise OperationalError("can't begin() with transaction_open")
-    self.db.trans_start(self)
+    self.db.trans_start(self, self.isolation_level)
     self.transaction_open = True
 
   @open_only
   def commit(self):
     if not self.transaction_open:
       raise OperationalError("can't commit without transaction_open")
-    self.db.trans_commit()
-    self.transaction_open = False
+    try:
+      self.db.trans_commit(self)
+    finally:
+      self.transaction_open = False # a commit that fails (i.e. pgmock.SerializationError) rolls back
     print('commit')
 
   @open_only
   def rollback(self):
     if not self.transaction_open:
       raise OperationalError("can't rollback without transaction_open")
-    self.db.trans_rollback()
+    self.db.trans_rollback(self)
     self.transaction_open = False
     print('rollback')
 
@@ -283,9 +407,13 @@ def call_cur(f):
   return f2
 
 class PgPoolMock(pg.Pool): # only inherits so isinstance tests pass
-  def __init__(self):
+  def __init__(self, template=None):
+    "template is a db_id to clone, see add_db. the pool's database is dropped when the pool is closed or garbage collected"
     # pylint: disable=super-init-not-called
-    self.db_id = add_db()
+    self.db_id = None
+    db_id = add_db(template)
+    acquire_db(db_id, owned=True)
+    self.db_id = db_id
   @property
   def tables(self):
     return DATABASES[self.db_id]
@@ -304,7 +432,12 @@ class PgPoolMock(pg.Pool): # only inherits so isinstance tests pass
     cursor.execute(qstring, vals)
     return cursor.fetchall()[0]
   def close(self):
-    pass # todo: is this closeall?
+    "release the database (dropping it, unless a Connection still has it open)"
+    if self.db_id is not None:
+      release_db(self.db_id)
+      self.db_id = None
+  def __del__(self):
+    self.close()
   @contextlib.contextmanager
   def __call__(self):
     with Connection(self.db_id) as con:
@@ -0,0 +1,131 @@
+"row iterator building blocks for sqex's select plans: joins, filters, dedupe, collecting and sort keys. these don't know about expressions; sqex compiles those first"
+
+import collections, itertools
+from . import misc
+
+def hash_key(vals):
+  "helper for hash_join. vals is a list of join values; returns a hashable key, or None if any value is null (null never equals anything)"
+  if any(val is None for val in vals):
+    return None
+  return tuple(tuple(val) if isinstance(val, list) else val for val in vals)
+
+def hash_join(partials, rows, left_key, right_key):
+  """join composite rows (partials, tuples; any iterable) to rows of the next table (a list) where left_key(partial) == right_key(row).
+  The hash table is built on rows up front and partials are streamed through it, so output order is the same as the
+    nested loop (i.e. itertools.product) order. Raises TypeError for unhashable keys in rows.
+  """
+  buckets = collections.defaultdict(list)
+  for row in rows:
+    key = right_key(row)
+    if key is not None:
+      buckets[key].append(row)
+  return probe(partials, buckets, left_key)
+
+def probe(partials, buckets, left_key):
+  "helper for hash_join"
+  for partial in partials:
+    try:
+      matches = buckets.get(left_key(partial), ())
+    except TypeError:
+      continue # unhashable (i.e. a dict). every key in buckets hashed, so nothing there is equal to it
+    for row in matches:
+      yield partial + (row,)
+
+def nested_loop(partials, rows):
+  "helper for iter_rows. every partial with every row"
+  for partial in partials:
+    for row in rows:
+      yield partial + (row,)
+
+def join_key(funcs):
+  "helper for select_rows"
+  return lambda row: hash_key([func(row) for func in funcs])
+
+def filter_rows(rows, preds):
+  "helper for iter_rows. iterator over the rows that pass all the predicates"
+  for pred in preds:
+    rows = filter(pred, rows)
+  return iter(rows)
+
+def row_key(row):
+  "hashable key for an output row, for distinct and set operations. rows with arrays or json in them go through misc.hashable"
+  key = tuple(row)
+  try:
+    hash(key)
+  except TypeError:
+    return misc.hashable(key)
+  return key
+
+def distinct_rows(rows):
+  "the first of each set of equal rows, streaming. memory is a key per distinct row"
+  seen = set()
+  for row in rows:
+    key = row_key(row)
+    if key not in seen:
+      seen.add(key)
+      yield row
+
+def filter_distinct(rows, keys, keep):
+  "helper for iter_setop. intersect (keep=True) and except: the distinct rows whose keys are / aren't in keys"
+  seen = set()
+  for row in rows:
+    key = row_key(row)
+    if (key in keys) == keep and key not in seen:
+      seen.add(key)
+      yield row
+
+def filter_all(rows, counts, keep):
+  "helper for iter_setop. intersect all (keep=True) and except all: each right-side row in counts matches one left-side row"
+  for row in rows:
+    key = row_key(row)
+    if counts[key] > 0:
+      counts[key] -= 1
+      if keep:
+        yield row
+    elif not keep:
+      yield row
+
+COLLECT_CHUNK = 4096
+
+def collect(rows, tables, width):
+  "list(rows), for the stages that need all of them. tables.check_rows sees the list grow, so a runaway join fails before it eats the memory"
+  ret = []
+  for chunk in iter(lambda: list(itertools.islice(rows, COLLECT_CHUNK)), []):
+    ret.extend(chunk)
+    tables.check_rows(len(ret), width)
+  return ret
+
+class Descending:
+  "sort key wrapper that reverses the order of values that can't be negated (i.e. text). see Compiler.compile_order"
+  __slots__ = ('val',)
+  def __init__(self, val):
+    self.val = val
+  def __lt__(self, other):
+    return other.val < self.val
+  def __eq__(self, other):
+    return self.val == other.val
+
+def sort_key(items):
+  """items is [(expr, desc, nulls_first), ...] with compiled exprs. returns a key function for sorts, so they evaluate each row's key once.
+  The key is a flat tuple with two slots per item: a rank that puts nulls first (0) or last (2) around values (1), then the value,
+    negated or wrapped in Descending for desc. Nulls only ever get compared to other nulls, and None == None.
+  """
+  items = [(expr, desc, 0 if nulls_first else 2) for expr, desc, nulls_first in items]
+  if len(items) == 1 and not items[0][1]:
+    (expr, _, null_rank), = items
+    def asc_key(row):
+      val = expr(row)
+      return (null_rank, None) if val is None else (1, val)
+    return asc_key
+  def key_tuple(row):
+    key = []
+    for expr, desc, null_rank in items:
+      val = expr(row)
+      if val is None:
+        key += (null_rank, None)
+      elif desc:
+        key += (1, -val if type(val) in (int, float) else Descending(val))
+      else:
+        key += (1, val)
+    return tuple(key)
+  return key_tuple
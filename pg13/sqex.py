@@ -1,8 +1,8 @@
 "expression evaluation helpers for pgmock. has duck-dependencies on pgmock's Table class, needs redesign."
 # todo: most of the heavy lifting happens here. profile and identify candidates for Cython port.
 
-import itertools, collections
-from . import sqparse2, threevl, misc, treepath
+import itertools, collections, functools, heapq, operator
+from . import aggregates, sqparse2, threevl, misc, rowops, treepath
 
 # todo: derive errors below from something pg13-specific
 class ColumnNameError(Exception):
@@ -11,46 +11,66 @@ class TableNameError(Exception):
   "expression referencing unk table"
 
 # todo doc: explain why it's not necessary to do these checks on the whereclause
-def consumes_rows(ex):
-  return isinstance(ex, sqparse2.CallX) and ex.f in ('min', 'max', 'count')
 def returns_rows(ex):
   return isinstance(ex, sqparse2.CallX) and ex.f in ('unnest', )
 def contains(expr, field):
   return bool(treepath.sub_slots(expr, field, match=True))
 
-# pylint: disable=too-many-return-statements, too-many-branches
+def op_divide(left, right):
+  raise NotImplementedError('todo: spec about int/float division')
+
+def op_in(left, right):
+  return (tuple(left) in right) if isinstance(left, list) and isinstance(right[0], tuple) else (left in right)
+
+def op_is(left, right):
+  if right is not None:
+    raise NotImplementedError('can null be on either side? what if neither value is null?')
+  return left is None
+
+def op_is_not(left, right):
+  return not op_is(left, right)
+
+def op_contains(left, right):
+  # todo: support a TextSearchDoc that will overload a lot of these operators
+  if not all(isinstance(x, list) for x in (left, right)):
+    raise TypeError('non-array-args', '@>', left, right)
+  return set(left) >= set(right)
+
+def op_concat(left, right):
+  if not all(isinstance(x, list) for x in (left, right)):
+    raise TypeError('non-array-args', '||', left, right)
+  return left+right
+
+def op_textmatch(left, right):
+  if not all(isinstance(x, set) for x in (left, right)):
+    raise TypeError('non_set_args', '@@', type(left), type(right))
+  return bool(left & right)
+
+# todo: does arithmetic require threevl?
+OPERATORS = {
+  '=': threevl.ThreeVL.comparison('='),
+  '!=': threevl.ThreeVL.comparison('!='),
+  '>': threevl.ThreeVL.comparison('>'),
+  '<': threevl.ThreeVL.comparison('<'),
+  '+': operator.add,
+  '-': operator.sub,
+  '*': operator.mul,
+  '/': op_divide,
+  'in': op_in,
+  'and': functools.partial(threevl.ThreeVL.andor, 'and'),
+  'or': functools.partial(threevl.ThreeVL.andor, 'or'),
+  'is': op_is,
+  'is not': op_is_not,
+  '@>': op_contains,
+  '||': op_concat,
+  '@@': op_textmatch,
+}
+
 def evalop(oper, left, right):
   "this takes evaluated left and right (i.e. values not expressions)"
-  if oper in ('=', ' != ', '>', '<'):
-    return threevl.ThreeVL.compare(oper, left, right)
-  elif oper in ('+', '-', '*', '/'):
-    # todo: does arithmetic require threevl?
-    if oper == '/':
-      raise NotImplementedError('todo: spec about int/float division')
-    return (left + right) if oper == '+' else (left - right) if oper == '-' else (left * right) if oper == '*' else (left/right)
-  elif oper == 'in':
-    return (tuple(left) in right) if isinstance(left, list) and isinstance(right[0], tuple) else (left in right)
-  elif oper in ('and', 'or'):
-    return threevl.ThreeVL.andor(oper, left, right)
-  elif oper in ('is not', 'is'):
-    if right is not None:
-      raise NotImplementedError('can null be on either side? what if neither value is null?')
-    return (left is not None) if (oper == 'is not') else (left is None)
-  elif oper == '@>':
-    # todo: support a TextSearchDoc that will overload a lot of these operators
-    if not all(isinstance(x, list) for x in (left, right)):
-      raise TypeError('non-array-args', oper, left, right)
-    return set(left) >= set(right)
-  elif oper == '||':
-    if not all(isinstance(x, list) for x in (left, right)):
-      raise TypeError('non-array-args', oper, left, right)
-    return left+right
-  elif oper == '@@':
-    if not all(isinstance(x, set) for x in (left, right)):
-      raise TypeError('non_set_args', oper, type(left), type(right))
-    return bool(left & right)
-  else:
+  if oper not in OPERATORS:
     raise NotImplementedError(oper, left, right) # pragma: no cover
+  return OPERATORS[oper](left, right)
 
 def uniqify(list_):
   "inefficient on long lists; short lists only. preserves order."
@@ -71,6 +91,7 @@ def infer_columns(selectx, tables_dict):
   todo: I think there's common logic here and inside NameIndexer that can be merged.
   todo: this is a beast
   """
+  # pylint: disable=too-many-branches
   # todo: support CTEs -- with all this plumbing, might as well
   table2fields = {}
   table_order = []
@@ -228,11 +249,148 @@ def decompose_select(selectx):
     where.append(selectx.where)
   return nix, where
 
-def eval_where(where_list, composite_row, nix, tables_dict):
-  "join-friendly whereclause evaluator. composite_row is a list or tuple of row lists. where_list is the thing from decompose_select."
+def compile_where(where_list, nix, tables_dict):
+  "join-friendly whereclause compiler. returns a predicate that takes a composite row. where_list is the thing from decompose_select."
   # todo: do I need to use 3vl instead of all() to merge where_list?
-  evaluator = Evaluator(composite_row, nix, tables_dict)
-  return all(evaluator.eval(w) for w in where_list)
+  compiler = Compiler(nix, tables_dict)
+  preds = [compiler.compile(w) for w in where_list]
+  if len(preds) == 1:
+    return preds[0]
+  return lambda c_row: all(pred(c_row) for pred in preds)
+
+def eval_where(where_list, composite_row, nix, tables_dict):
+  "one-off version of compile_where. composite_row is a list or tuple of row lists."
+  return bool(compile_where(where_list, nix, tables_dict)(composite_row)) if where_list else True
+
+EquiJoin = collections.namedtuple('EquiJoin', 'term left_table left right_table right')
+
+def and_terms(where_list):
+  "split the top-level ANDs in every expression of where_list (i.e. from decompose_select) into a flat list of terms"
+  def test_and(exp):
+    return isinstance(exp, sqparse2.BinX) and exp.op.op == 'and'
+  def binx_splitter(exp):
+    return [exp.left, exp.right]
+  return [term for wherex in where_list for term in treepath.flatten_tree(test_and, binx_splitter, wherex)]
+
+def term_tables(exp, nix, tables):
+  "set of table indexes (i.e. positions in nix.table_order) read by exp"
+  paths = treepath.sub_slots(exp, lambda x: isinstance(x, (sqparse2.NameX, sqparse2.AttrX)), match=True, recurse_into_matches=False)
+  return {nix.index_tuple(tables, exp[path], False)[0] for path in paths}
+
+def equijoin(term, nix, tables):
+  "return EquiJoin if term is 'x = y' where x and y each read one table (and they're different tables), otherwise None"
+  if not (isinstance(term, sqparse2.BinX) and term.op.op == '='):
+    return None
+  left, right = term_tables(term.left, nix, tables), term_tables(term.right, nix, tables)
+  if len(left) != 1 or len(right) != 1 or left == right:
+    return None
+  (left,), (right,) = left, right
+  if left > right:
+    return EquiJoin(term, right, term.right, left, term.left)
+  return EquiJoin(term, left, term.left, right, term.right)
+
+def index_lookups(terms, nix, tables, tindex):
+  """helper for scan. finds 'col = constant' and 'col in constant' terms on table tindex.
+  returns {column_index: [value, ...]} (i.e. the values the column can have for a row to pass)
+  Only literals and bound parameters count as constants (see is_constant); the terms get evaluated again per row when
+    they filter, so a function like nextval() would run twice.
+  """
+  lookups = {}
+  for term in terms:
+    if not (isinstance(term, sqparse2.BinX) and term.op.op in ('=', 'in')):
+      continue
+    sides = [(term.left, term.right), (term.right, term.left)] if term.op.op == '=' else [(term.left, term.right)]
+    for col, other in sides:
+      if not isinstance(col, (sqparse2.NameX, sqparse2.AttrX)) or not is_constant(other):
+        continue
+      index = nix.index_tuple(tables, col, False)
+      if len(index) != 2 or index[0] != tindex:
+        continue
+      value = Compiler(nix, tables).compile(other)(())
+      if term.op.op == '=':
+        vals = [value]
+      elif isinstance(value, (list, tuple)) and None not in value:
+        vals = list(value)
+      else:
+        break
+      lookups[index[1]] = [val for val in lookups[index[1]] if val in vals] if index[1] in lookups else vals
+      break
+  return lookups
+
+def scan(table_, terms, nix, tables, tindex):
+  """iterator over the rows of table_ (the table at tindex in nix.table_order) that pass all the terms, which only read table_.
+  The lookups and compiling happen now; rows are filtered as they're pulled.
+  When some of the terms pin down every column of one of the table's indexes (see index_lookups), the rows come from the index
+    instead of a full scan. Index rows are in insertion order per key, so order can differ from a full scan.
+  """
+  rows = table_.rows
+  lookups = index_lookups(terms, nix, tables, tindex)
+  index = table_.find_index(set(lookups)) if lookups else None
+  if index is not None:
+    rows = index.get(itertools.product(*(lookups[col] for col in index.col_indexes)))
+  compiler = Compiler(nix, tables, tindex)
+  return rowops.filter_rows(rows, [compiler.compile(term) for term in terms])
+
+def select_rows(nix, tables, where):
+  "list version of iter_rows"
+  return list(iter_rows(nix, tables, where))
+
+def place_terms(where, nix, tables, compiler):
+  """helper for iter_rows. sorts the where list's AND-ed terms by the table they run at: ({table_index: [term, ...]} single-table terms,
+  {table_index: [EquiJoin, ...]} keyed by the later table in the join, {table_index: [term, ...]} keyed by the last table the term reads).
+  Terms that don't read any table run here; returns None if one of them is false.
+  """
+  single, equis, multi = (collections.defaultdict(list) for _ in range(3))
+  for term in and_terms(where):
+    read = term_tables(term, nix, tables)
+    if not read:
+      if not compiler.compile(term)(()):
+        return None
+    elif len(read) == 1:
+      tindex, = read
+      single[tindex].append(term)
+    else:
+      equi = equijoin(term, nix, tables)
+      if equi:
+        equis[equi.right_table].append(equi)
+      else:
+        multi[max(read)].append(term)
+  return single, equis, multi
+
+def iter_rows(nix, tables, where):
+  """iterator over the composite rows (tuples of rows in nix.table_order) for the from-list that pass the where list (from decompose_select).
+  The where list is split into AND-ed terms and each term runs as early as it can:
+    1. terms that don't read any table run once, up front
+    2. terms that read one table filter that table's rows before any joining
+    3. tables are joined left to right. 'x = y' terms between the next table and the ones already joined run as hash joins
+    4. other multi-table terms filter the joined rows as soon as all the tables they read have been joined
+  Everything that needs tables (name resolution, compiling, index lookups) happens before this returns. After that rows are pulled
+    through the stages one at a time: only the joined tables' filtered rows (2.) are held in memory, never the product.
+  """
+  compiler = Compiler(nix, tables)
+  placed = place_terms(where, nix, tables, compiler)
+  if placed is None:
+    return iter(())
+  single, equis, multi = placed
+  partials = iter([()])
+  for tindex, tname in enumerate(nix.table_order):
+    rows = scan(tables[tname], single[tindex], nix, tables, tindex)
+    if tindex:
+      rows = list(rows) # read once per partial, or hashed
+    join_terms = list(multi[tindex])
+    conds = equis[tindex]
+    if conds:
+      keys = rowops.join_key([compiler.compile(equi.left) for equi in conds]), rowops.join_key([Compiler(nix, tables, tindex).compile(equi.right) for equi in conds])
+      try:
+        partials = rowops.hash_join(partials, rows, *keys)
+      except TypeError:
+        join_terms.extend(equi.term for equi in conds) # unhashable values (i.e. dicts); fall back to nested loop
+        conds = None
+    if not conds:
+      partials = rowops.nested_loop(partials, rows)
+    if join_terms:
+      partials = rowops.filter_rows(partials, [compiler.compile(term) for term in join_terms])
+  return partials
 
 def flatten_scalar(whatever):
   "warning: there's a systematic way to do this and I'm doing it blindly. In particular, this will screw up arrays."
@@ -246,198 +404,584 @@ def flatten_scalar(whatever):
     return flat1
 
 def replace_subqueries(ex, tables, table_ctor):
-  "this mutates passed in ex (any BaseX), replacing nested selects with their (flattened) output"
+  """return ex (any BaseX) with nested selects replaced by their (flattened) output.
+  exists (..) and x in (select ..) run their subquery once: they become a Literal (the list of values for in, so Compiler.compile_in
+    hashes it), or a SemiJoinX when the subquery refers to the outer query (see correlation).
+  ex itself isn't modified (it can be a shared StatementTemplate tree); the nodes above each subquery are copied instead.
+  """
   # http://www.postgresql.org/docs/9.1/static/sql-expressions.html#SQL-SYNTAX-SCALAR-SUBQUERIES
   # see here for subquery conditions that *do* use multi-rows. ug. http://www.postgresql.org/docs/9.1/static/functions-subquery.html
-  if isinstance(ex, sqparse2.SelectX):
-    old_tables, ex.tables = ex.tables, [] # we *don't* recurse into tables because selects in here get transformed into tables
-  for path in treepath.sub_slots(ex, lambda x: isinstance(x, sqparse2.SelectX)):
-    ex[path] = sqparse2.Literal(flatten_scalar(run_select(ex[path], tables, table_ctor)))
-  if isinstance(ex, sqparse2.SelectX):
-    ex.tables = old_tables
-  return ex # but it was modified in place, too
+  if isinstance(ex, sqparse2.SetOpX):
+    return ex # each side gets its own replace_subqueries when it runs (see operand_rows)
+  subqueries = (sqparse2.SelectX, sqparse2.SetOpX, sqparse2.ExistsX)
+  paths = treepath.sub_slots(ex, lambda x: isinstance(x, subqueries), recurse_into_matches=False)
+  for path in paths:
+    if isinstance(ex, sqparse2.SelectX) and isinstance(path[0], tuple) and path[0][0] == 'tables':
+      continue # we *don't* recurse into tables because selects in here get transformed into tables
+    item, parent = ex[path], ex[path[:-1]]
+    if isinstance(item, sqparse2.ExistsX):
+      ex = treepath.copy_path(ex, path, subquery_exists(item.select, tables, table_ctor))
+    elif isinstance(parent, sqparse2.BinX) and parent.op.op in ('in', 'not in') and path[-1] == 'right':
+      ex = treepath.copy_path(ex, path[:-1], subquery_in(parent, item, tables, table_ctor))
+    else:
+      ex = treepath.copy_path(ex, path, sqparse2.Literal(flatten_scalar(run_select(item, tables, table_ctor))))
+  return ex
+
+def column_refs(exp):
+  "the NameX and AttrX column references in exp"
+  return [exp[path] for path in treepath.sub_slots(exp, lambda x: isinstance(x, (sqparse2.NameX, sqparse2.AttrX)), match=True, recurse_into_matches=False)]
+
+def correlation(selectx, tables, table_ctor):
+  """helper for replace_subqueries. splits a subquery's where clause into its own terms and equality terms that pair
+  one of its expressions with one from the outer query (i.e. u.b = t.a). returns (own terms, inner keys, outer exprs).
+  Names resolve in the subquery first, like sql scoping. Other kinds of reference to the outer query aren't supported.
+  """
+  if isinstance(selectx, sqparse2.SetOpX):
+    return None, [], []
+  nix = NameIndexer.ctor_fromlist(selectx.tables)
+  nix.resolve_aonly(tables, table_ctor)
+  def own(ref):
+    try:
+      nix.index_tuple(tables, ref, False)
+    except TableNameError:
+      return False
+    except ColumnNameError as err:
+      return err.args[0] != 'no_such_column'
+    return True
+  def kind(exp):
+    refs = [own(ref) for ref in column_refs(exp)]
+    return 'inner' if all(refs) else 'outer' if not any(refs) else 'mixed'
+  terms, inner_keys, outer_exprs = [], [], []
+  for term in and_terms([selectx.where] if selectx.where is not None else []):
+    if kind(term) == 'inner':
+      terms.append(term)
+    elif isinstance(term, sqparse2.BinX) and term.op.op == '=' and {kind(term.left), kind(term.right)} == {'inner', 'outer'}:
+      inner, outer = (term.left, term.right) if kind(term.left) == 'inner' else (term.right, term.left)
+      inner_keys.append(inner)
+      outer_exprs.append(outer)
+    else:
+      raise NotImplementedError('correlated_subquery_term', term)
+  aggregated = selectx.group is not None or selectx.having is not None or aggregate_only(selectx)
+  if outer_exprs and (aggregated or selectx.limit is not None or selectx.offset is not None):
+    raise NotImplementedError('todo: correlated subquery with aggregates or limit', selectx)
+  return terms, inner_keys, outer_exprs
+
+def semi_join(selectx, correlated, tables, table_ctor):
+  """helper for replace_subqueries. correlated is (terms, inner_keys, outer_exprs) as from correlation.
+  runs the subquery once for the set of its inner_keys (minus the ones with nulls, which match nothing)
+  """
+  terms, inner_keys, outer_exprs = correlated
+  where = functools.reduce(lambda left, right: sqparse2.BinX(sqparse2.OpX('and'), left, right), terms) if terms else None
+  keys_select = sqparse2.SelectX(sqparse2.CommaX(inner_keys), selectx.tables, where, None, None, None, None)
+  rows = iter_select(replace_subqueries(keys_select, tables, table_ctor), tables, table_ctor)
+  return sqparse2.SemiJoinX(outer_exprs, {rowops.row_key(row) for row in rows if None not in row})
+
+def subquery_exists(selectx, tables, table_ctor):
+  "helper for replace_subqueries. an uncorrelated exists only reads the subquery's first row"
+  terms, inner_keys, outer_exprs = correlation(selectx, tables, table_ctor)
+  if not outer_exprs:
+    return sqparse2.Literal(next(operand_rows(selectx, tables, table_ctor), None) is not None)
+  return semi_join(selectx, (terms, inner_keys, outer_exprs), tables, table_ctor)
+
+def subquery_in(binx, selectx, tables, table_ctor):
+  """helper for replace_subqueries. binx is x [not] in (select ..); the subquery becomes the list of its values (a tuple per row for
+  several columns), or binx becomes a SemiJoinX on its columns plus the correlation keys.
+  todo: the SemiJoinX is false, not null, when x is null or the subquery has nulls.
+  """
+  left = binx.left
+  terms, inner_keys, outer_exprs = correlation(selectx, tables, table_ctor)
+  if not outer_exprs:
+    rows = operand_rows(selectx, tables, table_ctor)
+    return sqparse2.BinX(binx.op, left, sqparse2.Literal([row[0] if len(row) == 1 else tuple(row) for row in rows]))
+  lefts = left.children if isinstance(left, sqparse2.CommaX) else [left]
+  cols = selectx.cols.children
+  if len(cols) != len(lefts) or any(starlike(col) for col in cols):
+    raise NotImplementedError('in_subquery_columns', left, selectx.cols)
+  semi = semi_join(selectx, (terms, list(cols) + inner_keys, lefts + outer_exprs), tables, table_ctor)
+  return sqparse2.UnX(sqparse2.OpX('not'), semi) if binx.op.op == 'not in' else semi
 
 def unnest_helper(cols, row):
   wrapped = [val if contains(col, returns_rows) else [val] for col, val in zip(cols.children, row)]
-  return list(map(list, itertools.product(*wrapped)))
+  return map(list, itertools.product(*wrapped))
+
+def aggregate_only(ex):
+  "true for a select with aggregates or having but no group by. it has one output row, which iter_select returns as the row's values"
+  return not aggregates.group_keys(ex) and (ex.having is not None or contains(ex.cols, aggregates.consumes_rows))
 
-def collapse_group_expr(groupx, cols, ret_row):
-  "collapses columns matching the group expression. I'm sure this is buggy; look at a real DB's imp of this."
-  for i, col in enumerate(cols.children):
-    if col == groupx:
-      ret_row[i] = ret_row[i][0]
-  return ret_row
+def iter_groups(ex, nix, tables, composite_rows):
+  "helper for iter_select: group by, aggregates and having. order by, limit and offset apply to the groups"
+  keys = aggregates.group_keys(ex)
+  if contains(ex.cols, returns_rows):
+    raise NotImplementedError('todo: unnest with grouping')
+  if any(contains(key, aggregates.consumes_rows) for key in keys):
+    raise sqparse2.SQLSyntaxError('aggregate_in_group_by', ex.group)
+  for clause in list(ex.cols.children) + [ex.having] + list(ex.order or ()):
+    badcols = [] if clause is None else aggregates.ungrouped_columns(clause, keys)
+    if badcols and not keys:
+      raise sqparse2.SQLSyntaxError('not_all_aggregate', badcols) # is this the way real PG works? aim at giving PG error codes
+    elif badcols:
+      raise ValueError('illegal_cols_in_group', badcols)
+  compiler = Compiler(nix, tables)
+  start, stop = row_range(ex, compiler)
+  compiler.accumulators = []
+  cols = compiler.compile(ex.cols)
+  having = None if ex.having is None else compiler.compile(ex.having)
+  order = None if ex.order is None else compiler.compile_order(ex.order)
+  groups = aggregates.group_rows(keys, compiler, composite_rows, tables, len(nix.table_order))
+  if having is not None:
+    groups = [group for group in groups if having(group)]
+  if not keys:
+    if not groups or start > 0 or stop == 0:
+      return iter(())
+    return iter(cols(groups[0])) # note: the one output row stands in for the whole result, as it always has
+  if order is not None:
+    groups.sort(key=order)
+  ret = map(cols, groups)
+  if ex.distinct:
+    ret = rowops.distinct_rows(ret)
+  return itertools.islice(ret, start, stop)
 
 def run_select(ex, tables, table_ctor):
+  "the output rows of a select, as a list"
+  return rowops.collect(iter_select(ex, tables, table_ctor), tables, len(ex.cols.children))
+
+def iter_select(ex, tables, table_ctor):
+  """iterator over the output rows of a select. Name resolution and compiling happen before this returns, as does anything that needs
+  every row (order by, group by, aggregates). Otherwise rows are scanned, joined and projected as they're pulled (see iter_rows),
+    and a limit stops the pulling. order by with a limit keeps a heap of offset + limit rows instead of sorting everything.
+    group by and aggregates keep one accumulator per group (see group_rows). distinct dedupes as rows go by, keeping their keys.
+  """
+  if isinstance(ex, sqparse2.SetOpX):
+    return iter_setop(ex, tables, table_ctor)
   nix, where = decompose_select(ex)
   nix.resolve_aonly(tables, table_ctor)
   with tables.tempkeys():
     # so aliases are temporary. todo doc: why am I doing this here *and* in index_tuple?
     tables.update(nix.aonly)
-    composite_rows = [c_row for c_row in itertools.product(*(tables[t].rows for t in nix.table_order)) if eval_where(where, c_row, nix, tables)]
-    if ex.order: # note: order comes before limit / offset
-      composite_rows.sort(key=lambda c_row: Evaluator(c_row, nix, tables).eval(ex.order))
-    if ex.limit or ex.offset: # pragma: no cover
-      print(ex.limit, ex.offset)
-      raise NotImplementedError('notimp: limit, offset, group')
-    if ex.group:
-      # todo: non-aggregate expressions are allowed if they consume only the group expression
-      # todo: does the group expression have to be a NameX? for now it can be any expression. check specs.
-      # todo: this block shares logic with other parts of the function. needs refactor.
-      badcols = [col for col in ex.cols.children if not col == ex.group and not contains(col, consumes_rows)]
-      if badcols:
-        raise ValueError('illegal_cols_in_group', badcols)
-      if contains(ex.cols, returns_rows):
-        raise NotImplementedError('todo: unnest with grouping')
-      groups = collections.OrderedDict()
-      for row in composite_rows:
-        k = Evaluator(row, nix, tables).eval(ex.group)
-        if k not in groups:
-          groups[k] = []
-        groups[k].append(row)
-      return [collapse_group_expr(ex.group, ex.cols, Evaluator(g_rows, nix, tables).eval(ex.cols)) for g_rows in list(groups.values())]
-    if contains(ex.cols, consumes_rows):
-      if not all(contains(col, consumes_rows) for col in ex.cols.children):
-        # todo: this isn't good enough. what about nesting cases like max(min(whatever))
-        raise sqparse2.SQLSyntaxError('not_all_aggregate') # is this the way real PG works? aim at giving PG error codes
-      return Evaluator(composite_rows, nix, tables).eval(ex.cols)
+    compiler = Compiler(nix, tables)
+    composite_rows = iter_rows(nix, tables, where)
+    width = len(nix.table_order)
+    if aggregates.group_keys(ex) or aggregate_only(ex):
+      return iter_groups(ex, nix, tables, composite_rows)
+    start, stop = row_range(ex, compiler)
+    one_to_one = not contains(ex.cols, returns_rows) and not ex.distinct
+    if ex.order and stop is not None and one_to_one:
+      # top-N: a heap of the first stop rows instead of sorting all of them. nsmallest is stable like sort
+      composite_rows = heapq.nsmallest(stop, composite_rows, key=compiler.compile_order(ex.order))
+    elif ex.order: # note: order comes before limit / offset
+      composite_rows = rowops.collect(composite_rows, tables, width)
+      composite_rows.sort(key=compiler.compile_order(ex.order))
+    cols = compiler.compile(ex.cols)
+    ret = map(cols, composite_rows)
+    if contains(ex.cols, returns_rows):
+      ret = itertools.chain.from_iterable(unnest_helper(ex.cols, row) for row in ret)
+    if ex.distinct:
+      ret = rowops.distinct_rows(ret)
+    # islice stops pulling (so scanning and joining stop too) once it has stop rows
+    return itertools.islice(ret, start, stop) if start or stop is not None else ret
+
+def operand_rows(ex, tables, table_ctor):
+  "helper for iter_setop. rows of one side of a set operation. (unlike run_select, an aggregate_only select's row is a row)"
+  if isinstance(ex, sqparse2.SetOpX):
+    return iter_setop(ex, tables, table_ctor)
+  rows = iter_select(replace_subqueries(ex, tables, table_ctor), tables, table_ctor)
+  if aggregate_only(ex):
+    row = list(rows)
+    return iter([row] if row else [])
+  return rows
+
+def output_column(exp, cols):
+  "helper for iter_setop. order by in a set operation refers to an output column by name or (1-based) position. returns its index"
+  if any(starlike(col) for col in cols.children):
+    raise NotImplementedError('todo: order by in a set operation with *')
+  if isinstance(exp, sqparse2.Literal) and isinstance(exp.val, int) and 0 < exp.val <= len(cols.children):
+    return exp.val - 1
+  if isinstance(exp, sqparse2.NameX):
+    for i, col in enumerate(cols.children):
+      if isinstance(col, sqparse2.AliasX) and col.alias == exp.name or col == exp:
+        return i
+      if isinstance(col, sqparse2.AttrX) and col.attr == exp:
+        return i
+  raise ColumnNameError('order_by_not_output_column', exp)
+
+def iter_setop(ex, tables, table_ctor):
+  """iterator over the rows of a SetOpX. union all streams one side then the other and union streams through distinct_rows.
+  intersect and except read the right side into a set of row keys first (a Counter for the all versions), then stream the left.
+  """
+  width = len(ex.cols.children)
+  left = operand_rows(ex.left, tables, table_ctor)
+  right = operand_rows(ex.right, tables, table_ctor)
+  if ex.op == 'union':
+    ret = itertools.chain(left, right)
+    if not ex.all:
+      ret = rowops.distinct_rows(ret)
+  elif ex.all:
+    ret = rowops.filter_all(left, collections.Counter(map(rowops.row_key, right)), ex.op == 'intersect')
+  else:
+    ret = rowops.filter_distinct(left, set(map(rowops.row_key, right)), ex.op == 'intersect')
+  start, stop = row_range(ex, Compiler(None, tables))
+  if ex.order:
+    key = rowops.sort_key([(operator.itemgetter(output_column(sortx.expr, ex.cols)), sortx.desc, sortx.nulls_first) for sortx in ex.order])
+    if stop is not None:
+      ret = heapq.nsmallest(stop, ret, key=key)
     else:
-      ret = [Evaluator(r, nix, tables).eval(ex.cols) for r in composite_rows]
-      return sum((unnest_helper(ex.cols, row) for row in ret), []) if contains(ex.cols, returns_rows) else ret
+      ret = rowops.collect(ret, tables, width)
+      ret.sort(key=key)
+  return itertools.islice(ret, start, stop) if start or stop is not None else iter(ret)
+
+def row_range(ex, compiler):
+  "helper for iter_select. (start, stop) output rows for a select's offset and limit; stop is None without a limit (or with limit null)"
+  def bound(name, exp):
+    val = None if exp is None else compiler.compile(exp)(())
+    if val is not None and (not isinstance(val, int) or isinstance(val, bool)):
+      raise TypeError(name + '_not_int', val)
+    if val is not None and val < 0:
+      raise ValueError('negative_' + name, val)
+    return val
+  offset, limit = bound('offset', ex.offset) or 0, bound('limit', ex.limit)
+  return offset, (None if limit is None else offset + limit)
+
+def selected_rows(ex, tables, table_ctor):
+  """for SELECT .. FOR UPDATE / FOR SHARE: [(table_name, row), ...] for the table rows that make up the select's output.
+  Subquery tables in the from-list aren't included. ex shouldn't have nested selects in expressions (see replace_subqueries).
+  """
+  nix, where = decompose_select(ex)
+  nix.resolve_aonly(tables, table_ctor)
+  with tables.tempkeys():
+    tables.update(nix.aonly)
+    return [
+      (name, row)
+      for composite_row in select_rows(nix, tables, where)
+      for name, row in zip(nix.table_order, composite_row)
+      if name not in nix.aonly
+    ]
+
+def statement_tables(ex):
+  "names of the tables a statement reads or writes, including in subqueries. (names that aren't tables, i.e. aliased subqueries, can be in here too)"
+  names = set()
+  selects = [ex[path] for path in treepath.sub_slots(ex, lambda x: isinstance(x, sqparse2.SelectX))]
+  for selectx in selects + ([ex] if isinstance(ex, sqparse2.SelectX) else []):
+    names.update(NameIndexer.ctor_fromlist(selectx.tables).table_order)
+  if isinstance(ex, (sqparse2.InsertX, sqparse2.DeleteX)):
+    names.add(ex.table)
+  elif isinstance(ex, sqparse2.UpdateX):
+    names.update(ex.tables)
+  elif isinstance(ex, sqparse2.CreateX):
+    names.add(ex.name)
+    names.update(ex.inherits or ())
+  elif isinstance(ex, sqparse2.DropX):
+    names.add(ex.name)
+  elif isinstance(ex, sqparse2.IndexX) and ex.table is not None:
+    names.add(ex.table)
+  return names
+
+def is_constant(exp):
+  "true for expressions that don't need a row to evaluate (no columns or function calls), i.e. the list in x in (1, 2, 3)"
+  return not contains(exp, lambda x: isinstance(x, (sqparse2.NameX, sqparse2.AttrX, sqparse2.AsterX, sqparse2.CallX, sqparse2.SelectX, sqparse2.SetOpX, sqparse2.ExistsX, sqparse2.SemiJoinX)))
 
 def starlike(tok):
   "weird things happen to cardinality when working with * in comma-lists. this detects when to do that."
   # todo: is '* as name' a thing?
   return isinstance(tok, sqparse2.AsterX) or isinstance(tok, sqparse2.AttrX) and isinstance(tok.attr, sqparse2.AsterX)
 
-class Evaluator:
+def constant(val):
+  "compiled form of a literal"
+  return lambda c_row: val
+
+class Compiler:
+  """turns a (bound) BaseX tree into a python callable that takes a composite row, once per statement.
+  Column references are resolved to (table_index, column_index) accessors and operators to functions at compile time,
+    so evaluating the result is just nested function calls.
+  A composite row is a list/tuple of rows from all the query's tables, ordered by nix.table_order.
+    If table_index is given, the compiled callables take a bare row from that table instead (i.e. for single-table scans).
+  Aggregates (see consumes_rows) compile to callables that take a list of composite rows. If accumulators is a list, they instead
+    register (exp, Aggregate, update) there (see feeder) and compile to a lookup into a GroupRow (see group_rows).
+  """
   # todo: use intermediate types: Scalar, Row, RowList, Table.
   #   Row and Table might be able to bundle into RowList. RowList should know the type and names of its columns.
   #   This will solve a lot of cardinality confusion.
-  def __init__(self, c_row, nix, tables):
-    "c_row is a composite row, i.e. a list/tuple of rows from all the query's tables, ordered by nix.table_order"
-    self.c_row, self.nix, self.tables = c_row, nix, tables
+  def __init__(self, nix, tables, table_index=None):
+    self.nix, self.tables, self.table_index = nix, tables, table_index
+    self.accumulators = None
 
-  def eval_agg_call(self, exp):
-    "helper for eval_callx; evaluator for CallX that consume multiple rows"
-    if not isinstance(self.c_row, list):
-      raise TypeError('aggregate function expected a list of rows')
-    if len(exp.args.children) != 1:
-      raise ValueError('aggregate function expected a single value', exp.args)
-    arg, = exp.args.children # intentional: error if len != 1
-    vals = [Evaluator(c_r, self.nix, self.tables).eval(arg) for c_r in self.c_row]
-    if not vals:
-      return None
-    if exp.f == 'min':
-      return min(vals)
-    elif exp.f == 'max':
-      return max(vals)
-    elif exp.f == 'count':
-      return len(vals)
-    else:
-      raise NotImplementedError('unk_func', exp.f) # pragma: no cover
+  def compile_column(self, exp):
+    "NameX or AttrX to an accessor"
+    index = self.nix.index_tuple(self.tables, exp, False)
+    if self.table_index is not None:
+      if index[0] != self.table_index:
+        raise ValueError('column_outside_table', exp, self.table_index)
+      if len(index) == 1:
+        return lambda row: row
+      col = index[1]
+      return lambda row: row[col]
+    if len(index) == 1:
+      tindex, = index
+      return lambda c_row: c_row[tindex]
+    tindex, col = index
+    return lambda c_row: c_row[tindex][col]
+
+  def compile_agg_call(self, exp):
+    "helper for compile_callx; CallX that consume multiple rows (see AGGREGATES)"
+    agg = aggregates.AGGREGATES[exp.f]
+    if exp.distinct:
+      agg = aggregates.distinct_aggregate(agg)
+    if len(exp.args.children) != agg.nargs:
+      raise ValueError('aggregate_nargs', exp.f, agg.nargs, exp.args)
+    if any(contains(arg, aggregates.consumes_rows) for arg in exp.args.children):
+      raise sqparse2.SQLSyntaxError('nested_aggregate', exp)
+    # count(*) counts rows; it doesn't need to build them
+    args = [constant(True) if starlike(arg) else self.compile(arg) for arg in exp.args.children]
+    if self.accumulators is not None:
+      index = next((i for i, (other, _, _) in enumerate(self.accumulators) if other == exp), None)
+      if index is None:
+        index = len(self.accumulators)
+        self.accumulators.append((exp, agg, aggregates.feeder(agg, args)))
+      return lambda g_row: g_row.aggs[index]
+    def call(c_rows):
+      if not isinstance(c_rows, list):
+        raise TypeError('aggregate function expected a list of rows')
+      accumulators = [(exp, agg, aggregates.feeder(agg, args))]
+      states = [agg.init()]
+      for c_row in c_rows:
+        aggregates.accumulate(accumulators, states, c_row)
+      return aggregates.finish(accumulators, states)[0]
+    return call
 
-  def eval_nonagg_call(self, exp):
-    "helper for eval_callx; evaluator for CallX that consume a single value"
+  def compile_nonagg_call(self, exp):
+    "helper for compile_callx; CallX that consume a single value"
     # todo: get more concrete about argument counts
-    args = self.eval(exp.args)
+    if exp.distinct:
+      raise sqparse2.SQLSyntaxError('distinct_not_aggregate', exp.f)
+    if exp.f in ('nextval', 'currval', 'setval'):
+      return self.compile_sequence_call(exp)
     if exp.f == 'coalesce':
-      left, right = args # todo: does coalesce take more than 2 args?
-      return right if left is None else left
-    elif exp.f == 'unnest':
-      return self.eval(exp.args)[0] # note: run_select does some work in this case too
+      items = [self.compile(arg) for arg in exp.args.children]
+      def coalesce(c_row):
+        # arguments after the first non-null one aren't evaluated
+        for item in items:
+          val = item(c_row)
+          if val is not None:
+            return val
+        return None
+      return coalesce
+    args = self.compile(exp.args)
+    if exp.f == 'unnest':
+      return lambda c_row: args(c_row)[0] # note: run_select does some work in this case too
     elif exp.f in ('to_tsquery', 'to_tsvector'):
-      return set(self.eval(exp.args.children[0]).split())
+      first = self.compile(exp.args.children[0])
+      return lambda c_row: set(first(c_row).split())
     else:
       raise NotImplementedError('unk_function', exp.f) # pragma: no cover
 
-  def eval_callx(self, exp):
+  def compile_sequence_call(self, exp):
+    "helper for compile_nonagg_call. the sequence is looked up when the call runs, not at compile time"
+    if exp.f == 'setval' and len(exp.args.children) == 3 and isinstance(exp.args.children[2], sqparse2.NameX):
+      # todo: true / false should be literals in the grammar
+      is_called = {'true': True, 'false': False}[exp.args.children[2].name.lower()]
+      args = self.compile(sqparse2.CommaX(exp.args.children[:2]))
+    else:
+      is_called = True
+      args = self.compile(exp.args)
+    def sequence_call(c_row):
+      name, *rest = args(c_row)
+      if name not in self.tables.sequences:
+        raise KeyError(name)
+      seq = self.tables.sequences[name]
+      if exp.f == 'setval':
+        return seq.setval(*rest) if len(rest) == 2 else seq.setval(rest[0], is_called)
+      return getattr(seq, exp.f)()
+    return sequence_call
+
+  def compile_order(self, sortxs):
+    "order by items (SortX) to a sort key function (see sort_key)"
+    return rowops.sort_key([(self.compile(sortx.expr), sortx.desc, sortx.nulls_first) for sortx in sortxs])
+
+  def compile_callx(self, exp):
     "dispatch for CallX"
     # below: this isn't contains(exp, consumes_row) -- it's just checking the current expression
-    return (self.eval_agg_call if consumes_rows(exp) else self.eval_nonagg_call)(exp)
+    return (self.compile_agg_call if aggregates.consumes_rows(exp) else self.compile_nonagg_call)(exp)
 
-  def eval_unx(self, exp):
+  def compile_andor(self, exp):
+    "helper for compile. and / or skip the right side when the left side decides the result (false for and, true for or)"
+    left, right = self.compile(exp.left), self.compile(exp.right)
+    andor = OPERATORS[exp.op.op]
+    if exp.op.op == 'and':
+      def and_(c_row):
+        val = left(c_row)
+        return False if val is False or val is threevl.FALSE else andor(val, right(c_row))
+      return and_
+    def or_(c_row):
+      val = left(c_row)
+      return True if val is True or val is threevl.TRUE else andor(val, right(c_row))
+    return or_
+
+  def compile_in(self, exp):
+    """helper for compile. x [not] in (constant list) builds a set once here and probes it per row. Like postgres, the result is null
+    (not false) if x is null, or if nothing matches and the list has a null. Anything else falls back to op_in per row.
+    """
+    left, right = self.compile(exp.left), self.compile(exp.right)
+    values = right(None) if is_constant(exp.right) else None
+    if isinstance(values, (list, tuple)):
+      in_set = self.compile_in_set(left, values)
+    else:
+      def in_set(c_row):
+        return op_in(left(c_row), right(c_row))
+    if exp.op.op == 'not in':
+      return lambda c_row: threevl.ThreeVL.nein(in_set(c_row))
+    return in_set
+
+  @staticmethod
+  def compile_in_set(left, values):
+    "helper for compile_in. a null can only turn a miss into null, so on a miss this scans the (usually empty) list of keys with nulls"
+    keys = {misc.hashable(val) for val in values}
+    null_keys = [key for key in keys if key is None or (isinstance(key, tuple) and None in key)]
+    def in_set(c_row):
+      val = left(c_row)
+      if val is None:
+        return threevl.UNKNOWN
+      try:
+        if val in keys:
+          return True
+      except TypeError: # row constructors, i.e. (a, b) in ((1, 2), (3, 4)), arrays and json
+        val = misc.hashable(val)
+        if val in keys and not (isinstance(val, tuple) and None in val):
+          return True
+      if isinstance(val, tuple):
+        candidates = keys if None in val else null_keys
+        maybe = any(isinstance(key, tuple) and len(key) == len(val) and all(x is None or y is None or x == y for x, y in zip(val, key)) for key in candidates)
+      else:
+        maybe = None in null_keys
+      return threevl.UNKNOWN if maybe else False
+    return in_set
+
+  def compile_semijoin(self, exp):
+    "helper for compile. see SemiJoinX; outer values with nulls in them match nothing"
+    exprs, keys = [self.compile(expr) for expr in exp.exprs], exp.keys
+    def semi_joined(c_row):
+      key = tuple(expr(c_row) for expr in exprs)
+      if None in key:
+        return False
+      try:
+        return key in keys
+      except TypeError:
+        return misc.hashable(key) in keys
+    return semi_joined
+
+  def compile_unx(self, exp):
     "unary expressions"
-    inner = self.eval(exp.val)
+    inner = self.compile(exp.val)
     if exp.op.op == '+':
       return inner
     elif exp.op.op == '-':
-      return -inner # pylint: disable=invalid-unary-operand-type
+      return lambda c_row: -inner(c_row) # pylint: disable=invalid-unary-operand-type
     elif exp.op.op == 'not':
-      return threevl.ThreeVL.nein(inner)
+      return lambda c_row: threevl.ThreeVL.nein(inner(c_row))
     else:
       raise NotImplementedError('unk_op', exp.op) # pragma: no cover
 
-  def eval(self, exp):
-    "main dispatch for expression evaluation"
+  def compile_commax(self, exp):
+    "CommaX (and ReturnX) children to a row-building callable"
+    # todo: think about getting rid of CommaX everywhere; it complicates syntax tree navigation.
+    #   a lot of things that are CommaX now should become weval.Row.
+    children = [(self.compile(child), starlike(child)) for child in exp.children]
+    def commax(c_row):
+      ret = []
+      for child, star in children:
+        (ret.extend if star else ret.append)(child(c_row))
+      return ret
+    return commax
+
+  def compile_casex(self, exp):
+    cases = [(self.compile(case.when), self.compile(case.then)) for case in exp.cases]
+    elsex = self.compile(exp.elsex)
+    def casex(c_row):
+      for when, then in cases:
+        if when(c_row):
+          return then(c_row)
+      return elsex(c_row)
+    return casex
+
+  def compile_returnx(self, exp):
+    # todo: I think ReturnX is *always* CommaX now; revisit this
+    # warning: not sure what I'm doing here with cardinality tweak on CommaX
+    inner = self.compile(exp.expr)
+    if isinstance(exp.expr, (sqparse2.CommaX, sqparse2.AsterX)):
+      return lambda c_row: [inner(c_row)]
+    return lambda c_row: [[inner(c_row)]] # todo: update parser so this is always * or a commalist
+
+  def compile(self, exp):
+    "main dispatch for expression compilation"
     # todo: this needs an AST-assert that all BaseX descendants are being handled
-    if isinstance(exp, sqparse2.BinX):
-      return evalop(exp.op.op, *list(map(self.eval, (exp.left, exp.right))))
+    # pylint: disable=too-many-return-statements,too-many-branches
+    if isinstance(exp, sqparse2.BinX) and exp.op.op in ('and', 'or'):
+      return self.compile_andor(exp)
+    elif isinstance(exp, sqparse2.BinX) and exp.op.op in ('in', 'not in'):
+      return self.compile_in(exp)
+    elif isinstance(exp, sqparse2.BinX):
+      oper = OPERATORS.get(exp.op.op)
+      if oper is None:
+        raise NotImplementedError(exp.op.op) # pragma: no cover
+      left, right = self.compile(exp.left), self.compile(exp.right)
+      return lambda c_row: oper(left(c_row), right(c_row))
     elif isinstance(exp, sqparse2.UnX):
-      return self.eval_unx(exp)
-    elif isinstance(exp, sqparse2.NameX):
-      return self.nix.rowget(self.tables, self.c_row, exp)
+      return self.compile_unx(exp)
+    elif isinstance(exp, (sqparse2.NameX, sqparse2.AttrX)):
+      return self.compile_column(exp)
     elif isinstance(exp, sqparse2.AsterX):
-      return sum(self.c_row, []) # todo doc: how does this get disassembled by caller?
+      if self.table_index is not None:
+        return list
+      return lambda c_row: list(itertools.chain.from_iterable(c_row)) # todo doc: how does this get disassembled by caller?
     elif isinstance(exp, sqparse2.ArrayLit):
-      return list(map(self.eval, exp.vals))
-    elif isinstance(exp, (sqparse2.Literal, sqparse2.ArrayLit)):
-      return exp.toliteral()
+      vals = [self.compile(val) for val in exp.vals]
+      return lambda c_row: [val(c_row) for val in vals]
+    elif isinstance(exp, sqparse2.Literal):
+      return constant(exp.toliteral())
     elif isinstance(exp, sqparse2.CommaX):
-      # todo: think about getting rid of CommaX everywhere; it complicates syntax tree navigation.
-      #   a lot of things that are CommaX now should become weval.Row.
-      ret = []
-      for child in exp.children:
-        (ret.extend if starlike(child) else ret.append)(self.eval(child))
-      return ret
+      return self.compile_commax(exp)
     elif isinstance(exp, sqparse2.CallX):
-      return self.eval_callx(exp)
-    elif isinstance(exp, sqparse2.SelectX):
+      return self.compile_callx(exp)
+    elif isinstance(exp, sqparse2.SemiJoinX):
+      return self.compile_semijoin(exp)
+    elif isinstance(exp, (sqparse2.SelectX, sqparse2.SetOpX, sqparse2.ExistsX)):
       raise NotImplementedError('subqueries should have been evaluated earlier') # todo: specific error class
-    elif isinstance(exp, sqparse2.AttrX):
-      return self.nix.rowget(self.tables, self.c_row, exp)
     elif isinstance(exp, sqparse2.CaseX):
-      for case in exp.cases:
-        if self.eval(case.when):
-          return self.eval(case.then)
-      return self.eval(exp.elsex)
+      return self.compile_casex(exp)
     elif isinstance(exp, sqparse2.CastX):
       if exp.to_type.type.lower() in ('text', 'varchar'):
-        return str(self.eval(exp.expr))
+        inner = self.compile(exp.expr)
+        return lambda c_row: str(inner(c_row))
       else:
         raise NotImplementedError('unhandled_cast_type', exp.to_type)
-    elif isinstance(exp, (int, str, float, type(None))):
-      return exp # I think Table.insert is creating this in expand_row
-    # todo: why tuple, list, dict below? throw some asserts in here and see where these are coming from.
-    elif isinstance(exp, tuple):
-      return tuple(map(self.eval, exp))
-    elif isinstance(exp, list):
-      return list(map(self.eval, exp))
-    elif isinstance(exp, dict):
-      return exp
+    elif isinstance(exp, (int, str, float, type(None), dict)):
+      return constant(exp) # I think Table.insert is creating this in expand_row
+    # todo: why tuple, list below? throw some asserts in here and see where these are coming from.
+    elif isinstance(exp, (tuple, list)):
+      items = [self.compile(item) for item in exp]
+      type_ = type(exp)
+      return lambda c_row: type_(item(c_row) for item in items)
     elif isinstance(exp, sqparse2.NullX):
-      return None
+      return constant(None)
     elif isinstance(exp, sqparse2.ReturnX):
-      # todo: I think ReturnX is *always* CommaX now; revisit this
-      ret = self.eval(exp.expr)
-      print("warning: not sure what I'm doing here with cardinality tweak on CommaX")
-      return [ret] if isinstance(exp.expr, (sqparse2.CommaX, sqparse2.AsterX)) else [[ret]] # todo: update parser so this is always * or a commalist
+      return self.compile_returnx(exp)
     elif isinstance(exp, sqparse2.AliasX):
-      return self.eval(exp.name) # todo: rename AliasX 'name' to 'expr'
+      return self.compile(exp.name) # todo: rename AliasX 'name' to 'expr'
     else:
       raise NotImplementedError(type(exp), exp) # pragma: no cover
 
+class Evaluator:
+  "one-off evaluation of an expression against a composite row. Compiler is the fast path for anything that runs per-row."
+  def __init__(self, c_row, nix, tables):
+    "c_row is a composite row, i.e. a list/tuple of rows from all the query's tables, ordered by nix.table_order"
+    self.c_row, self.nix, self.tables = c_row, nix, tables
+
+  def eval(self, exp):
+    return Compiler(self.nix, self.tables).compile(exp)(self.c_row)
+
 def depth_first_sub(expr, values):
   "replace SubLit with literals in expr. (expr is mutated)."
   arr = treepath.sub_slots(expr, lambda elt: elt is sqparse2.SubLit)
   if len(arr) != len(values):
     raise ValueError('len', len(arr), len(values))
   for path, val in zip(arr, values):
-    # todo: does ArrayLit get us anything? tree traversal?
-    if isinstance(val, (str, int, float, type(None), dict)):
-      expr[path] = sqparse2.Literal(val)
-    elif isinstance(val, (list, tuple)):
-      expr[path] = sqparse2.ArrayLit(val)
-    else:
-      raise TypeError('unk_sub_type', type(val), val) # pragma: no cover
+    expr[path] = sqparse2.sub_literal(val)
   return expr
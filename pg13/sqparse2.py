@@ -7,8 +7,8 @@
 # differences vs real SQL:
 # 1. sql probably allows 'table' as a table name. I think I'm stricter about keywords (and I don't allow quoting columns)
 
-import itertools
-import ply.lex, ply.yacc
+import copy, itertools, functools, hashlib, os, pickle, re, tempfile
+import ply, ply.lex, ply.yacc
 from . import treepath
 
 # errors
@@ -77,7 +77,7 @@ class JoinX(BaseX):
   ATTRS = ('a', 'b', 'on_stmt', 'jointype')
 
 class OpX(BaseX):
-  PRIORITY = ('or', 'and', 'not', '>', '<', '@>', '@@', '||', '!=', '=', 'is not', 'is', 'in', '*', '/', '+', '-')
+  PRIORITY = ('or', 'and', 'not', '>', '<', '@>', '@@', '||', '!=', '=', 'is not', 'is', 'in', 'not in', '*', '/', '+', '-')
   ATTRS = ('op',)
   def __init__(self, op):
     self.op = op
@@ -107,7 +107,10 @@ class CommaX(BaseX):
     raise NotImplementedError("don't iterate CommaX directly -- loop on x.children")
 
 class CallX(BaseX):
-  ATTRS = ('f', 'args') # args is not VARLEN; it's a commax because it's passed to sqex.Evaluator I think
+  ATTRS = ('f', 'args', 'distinct') # args is not VARLEN; it's a commax because it's passed to sqex.Evaluator I think
+  def __init__(self, f, args, distinct=False):
+    "distinct is for aggregates, i.e. count(distinct a)"
+    super().__init__(f, args, distinct)
 
 class WhenX(BaseX):
   ATTRS = ('when', 'then')
@@ -125,12 +128,45 @@ class TypeX(BaseX):
 class CastX(BaseX):
   ATTRS = ('expr', 'to_type')
 
+class SortX(BaseX):
+  "one order by item. nulls_first is resolved at parse time (postgres puts nulls last for asc, first for desc unless told otherwise)"
+  ATTRS = ('expr', 'desc', 'nulls_first')
+
+class ExistsX(BaseX):
+  "exists (select ..). sqex.replace_subqueries turns it into a Literal or a SemiJoinX before anything compiles it"
+  ATTRS = ('select',)
+
+class SemiJoinX(BaseX):
+  """made by sqex.replace_subqueries from exists / in (select ..) subqueries that refer to the outer query, not by the parser.
+  true when the values of exprs (outer expressions) are one of the tuples in keys, a set built from the subquery once per statement.
+  """
+  ATTRS = ('exprs', 'keys')
+  VARLEN = ('exprs',)
+
 class CommandX(BaseX):
   "base class for top-level commands. probably won't ever be used."
 
 class SelectX(CommandX):
-  ATTRS = ('cols', 'tables', 'where', 'group', 'order', 'limit', 'offset')
-  VARLEN = ('tables',)
+  ATTRS = ('cols', 'tables', 'where', 'group', 'order', 'limit', 'offset', 'lock', 'having', 'distinct')
+  VARLEN = ('tables', 'order')
+  def __init__(self, cols, tables, where, group, order, limit, offset, lock=None, having=None, distinct=False): # pylint: disable=too-many-positional-arguments
+    """lock is None, 'update' or 'share' for the FOR UPDATE / FOR SHARE clause.
+    group is one expression, or a CommaX for several group by keys. having is the HAVING expression (or None).
+    order is None or a list of SortX. distinct is true for SELECT DISTINCT.
+    """
+    super().__init__(cols, tables, where, group, order, limit, offset, lock, having, distinct)
+
+class SetOpX(CommandX):
+  """union / intersect / except (op) of two selects; left can be another SetOpX. all keeps duplicate rows.
+  order, limit and offset apply to the combined rows. see set_operation.
+  """
+  ATTRS = ('op', 'all', 'left', 'right', 'order', 'limit', 'offset')
+  VARLEN = ('order',)
+
+  @property
+  def cols(self):
+    "the output columns are the first select's"
+    return self.left.cols # pylint: disable=no-member
 
 class ColX(BaseX):
   ATTRS = ('name', 'coltp', 'isarray', 'not_null', 'default', 'pkey')
@@ -168,7 +204,23 @@ class UpdateX(CommandX):
   VARLEN = ('tables', 'assigns')
 
 class IndexX(CommandX):
-  ATTRS = ('string',)
+  "table is None when the index is something pgmock can't build (i.e. an expression index); apply_sql ignores those"
+  ATTRS = ('string', 'unique', 'nexists', 'name', 'table', 'cols')
+
+class CreateSequenceX(CommandX):
+  ATTRS = ('nexists', 'name', 'start', 'increment')
+
+class DropSequenceX(CommandX):
+  ATTRS = ('ifexists', 'name')
+
+class SavepointX(CommandX):
+  ATTRS = ('name',)
+
+class RollbackToX(CommandX):
+  ATTRS = ('name',)
+
+class ReleaseX(CommandX):
+  ATTRS = ('name',)
 
 class DeleteX(CommandX):
   ATTRS = ('table', 'where', 'returnx')
@@ -201,7 +253,7 @@ def un_priority(op, val):
   else:
     return UnX(op, val)
 
-KEYWORDS = {w: 'kw_' + w for w in 'array case when then else end as join on from where order by limit offset select is not and or in null default primary key if exists create table insert into values returning update set delete group inherits check constraint start transaction commit rollback left right full inner outer using drop cascade cast'.split()}
+KEYWORDS = {w: 'kw_' + w for w in 'array case when then else end as join on from where order by limit offset select is not and or in null default primary key if exists create table insert into values returning update set delete group inherits check constraint start transaction commit rollback left right full inner outer using drop cascade cast for having distinct all union intersect except'.split()}
 class SqlGrammar:
   # todo: adhere more closely to the spec. http://www.postgresql.org/docs/9.1/static/sql-syntax-lexical.html
   t_STRLIT = "'((?<=\\\\)'|[^'])+'"
@@ -259,6 +311,9 @@ class SqlGrammar:
   def p_isnot(self, t):
     "isnot : kw_is kw_not"
     t[0] = 'is not'
+  def p_notin(self, t):
+    "notin : kw_not kw_in"
+    t[0] = 'not in'
   def p_boolop(self, t):
     "boolop : kw_and \n | kw_or \n | kw_in"
     t[0] = t[1]
@@ -273,7 +328,7 @@ class SqlGrammar:
     # the second expression should be some kind of type spec. use it in createx and 'x cast y' also
     t[0] = CastX(t[3], t[5])
   def p_binop(self, t):
-    "binop : ARITH \n | CMP \n | boolop \n | isnot \n | '=' \n | '-' \n | '*' \n | kw_is"
+    "binop : ARITH \n | CMP \n | boolop \n | isnot \n | notin \n | '=' \n | '-' \n | '*' \n | kw_is"
     t[0] = OpX(t[1])
   def p_x_boolx(self, t):
     """expression : unop expression
@@ -332,8 +387,8 @@ class SqlGrammar:
       raise NotImplementedError('unk_len', len(t)) # pragma: no cover
 
   def p_call(self, t):
-    "expression : NAME '(' commalist ')'"
-    t[0] = CallX(t[1], t[3])
+    "expression : NAME '(' commalist ')' \n | NAME '(' kw_distinct commalist ')'"
+    t[0] = CallX(t[1], t[3]) if len(t) == 5 else CallX(t[1], t[4], True)
 
   def p_attr(self, t):
     """attr : NAME '.' NAME
@@ -416,8 +471,28 @@ class SqlGrammar:
     "wherex : kw_where expression \n | "
     t[0] = t[2] if len(t) == 3 else None
   def p_order(self, t):
-    "order : kw_order kw_by expression \n | "
+    "order : kw_order kw_by sortlist \n | "
     t[0] = t[3] if len(t) == 4 else None
+  def p_sortlist(self, t):
+    "sortlist : sortlist ',' sortx \n | sortx"
+    t[0] = [t[1]] if len(t) == 2 else t[1] + [t[3]]
+  def p_sortx(self, t):
+    """sortx : expression
+             | expression NAME
+             | expression NAME NAME
+             | expression NAME NAME NAME
+    """
+    # asc / desc / nulls / first / last are NAMEs rather than keywords so they still work as column names (see p_lockx)
+    words = [word.lower() for word in t[2:]]
+    desc = bool(words) and words[0] == 'desc'
+    if words and words[0] in ('asc', 'desc'):
+      words = words[1:]
+    if words in (['nulls', 'first'], ['nulls', 'last']):
+      t[0] = SortX(t[1], desc, words[1] == 'first')
+    elif not words:
+      t[0] = SortX(t[1], desc, desc)
+    else:
+      raise SQLSyntaxError('bad_order_by', t[2:])
   def p_limit(self, t):
     "limit : kw_limit expression \n | "
     t[0] = t[2] if len(t) == 3 else None
@@ -425,13 +500,40 @@ class SqlGrammar:
     "offset : kw_offset expression \n | "
     t[0] = t[2] if len(t) == 3 else None
   def p_group(self, t):
-    "group : kw_group kw_by expression \n | "
-    t[0] = t[3] if len(t) == 4 else None
+    "group : kw_group kw_by commalist \n | "
+    if len(t) == 1:
+      t[0] = None
+    else:
+      t[0] = t[3].children[0] if len(t[3].children) == 1 else t[3]
+  def p_having(self, t):
+    "having : kw_having expression \n | "
+    t[0] = t[2] if len(t) == 3 else None
+  def p_lockx(self, t):
+    "lockx : kw_for kw_update \n | kw_for NAME \n | "
+    if len(t) == 1:
+      t[0] = None
+    elif t[2].lower() not in ('update', 'share'):
+      raise SQLSyntaxError('unk_lock_mode', t[2])
+    else:
+      t[0] = t[2].lower()
+  def p_setquantifier(self, t):
+    "setquantifier : kw_distinct \n | kw_all \n | "
+    t[0] = t[1].lower() if len(t) == 2 else None
   def p_selectx(self, t):
-    "selectx : kw_select commalist fromlist wherex group order limit offset"
-    t[0] = SelectX(*t[2:])
+    "selectx : kw_select setquantifier commalist fromlist wherex group having order limit offset lockx"
+    quantifier, cols, tables, where, group, having, order, limit, offset, lock = t[2:]
+    t[0] = SelectX(cols, tables, where, group, order, limit, offset, lock, having, quantifier == 'distinct')
+  def p_setop(self, t):
+    "setop : kw_union \n | kw_intersect \n | kw_except"
+    t[0] = t[1].lower()
+  def p_setx(self, t):
+    "setx : selectx setop setquantifier selectx \n | setx setop setquantifier selectx"
+    t[0] = set_operation(t[2], t[3] == 'all', t[1], t[4])
+  def p_exists(self, t):
+    "expression : kw_exists '(' selectx ')' \n | kw_exists '(' setx ')'"
+    t[0] = ExistsX(t[3])
   def p_extra_x(self, t):
-    "expression : selectx \n | aliasx"
+    "expression : selectx \n | aliasx \n | setx"
     t[0] = t[1] # expressions that also need to be separately addressable
   def p_isarray(self, t):
     "is_array : '[' ']' \n | "
@@ -548,10 +650,79 @@ class SqlGrammar:
   def p_error(self, t):
     raise SQLSyntaxError(t)
 
-LEXER = ply.lex.lex(module=SqlGrammar())
+def grammar_hash():
+  "hash of everything in SqlGrammar that goes into the LALR tables (plus the ply version). Keys the on-disk table cache."
+  parts = [ply.__version__, ply.yacc.__tabversion__, repr(SqlGrammar.tokens), repr(SqlGrammar.precedence)]
+  parts.extend(name + ' ' + str(func.__doc__) for name, func in sorted(vars(SqlGrammar).items()) if name.startswith('p_'))
+  return hashlib.sha1('\n'.join(parts).encode()).hexdigest()
+
+def table_cache_path():
+  """where the pickled parse tables live. Set PG13_CACHE_DIR to move the cache, or to an empty string to disable it.
+  Returns None when disabled.
+  """
+  cache_dir = os.environ.get('PG13_CACHE_DIR')
+  if cache_dir is None:
+    cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'pg13')
+  if not cache_dir:
+    return None
+  return os.path.join(cache_dir, 'sqparse2-' + grammar_hash()[:16] + '.pickle')
+
+def build_parser(cache_path):
+  """build the yacc parser, loading the tables from cache_path if it's there and writing them there if not.
+  The write goes through a temp file + rename so concurrent processes (i.e. pytest-xdist workers) never see a partial file.
+  """
+  if cache_path is None:
+    return ply.yacc.yacc(module=SqlGrammar(), debug=0, write_tables=0)
+  if os.path.exists(cache_path):
+    try:
+      return ply.yacc.yacc(module=SqlGrammar(), debug=0, write_tables=0, picklefile=cache_path)
+    except (EOFError, pickle.UnpicklingError, OSError):
+      pass # unreadable cache file; rebuild below
+  try:
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    handle, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path), suffix='.tmp')
+    os.close(handle)
+  except OSError:
+    return ply.yacc.yacc(module=SqlGrammar(), debug=0, write_tables=0) # read-only home or similar; run uncached
+  try:
+    os.remove(tmp_path) # ply treats an existing picklefile as a table to read
+    parser = ply.yacc.yacc(module=SqlGrammar(), debug=0, write_tables=0, picklefile=tmp_path)
+    if os.path.exists(tmp_path):
+      os.replace(tmp_path, cache_path)
+  finally:
+    if os.path.exists(tmp_path):
+      os.remove(tmp_path)
+  return parser
+
+def set_operation(op, all_, left, right):
+  """helper for p_setx. intersect binds tighter than union and except (like postgres), so it's pushed down the right of the tree.
+  the last select's order by / limit / offset belong to the whole SetOpX.
+  """
+  # todo: parenthesized selects, i.e. (select ..) union (select .. order by a limit 1)
+  for select in (left, right):
+    if getattr(select, 'lock', None):
+      raise SQLSyntaxError('lock_with_set_op', op)
+  if left.order or left.limit is not None or left.offset is not None:
+    raise SQLSyntaxError('order_before_set_op', op)
+  tail = right.order, right.limit, right.offset
+  right = copy.copy(right)
+  right.order = right.limit = right.offset = None
+  if op == 'intersect' and isinstance(left, SetOpX) and left.op != 'intersect':
+    return SetOpX(left.op, left.all, left.left, SetOpX(op, all_, left.right, right, None, None, None), *tail)
+  return SetOpX(op, all_, left, right, *tail)
+
+# note: the lexer and parser are built on first use rather than at import; generating the LALR tables is the slow part of startup
+@functools.lru_cache(maxsize=None)
+def get_lexer():
+  return ply.lex.lex(module=SqlGrammar())
+
+@functools.lru_cache(maxsize=None)
+def get_parser():
+  return build_parser(table_cache_path())
+
 def lex(string):
   "this is only used by tests"
-  safe_lexer = LEXER.clone() # reentrant? I can't tell, I hate implicit globals. do a threading test
+  safe_lexer = get_lexer().clone() # reentrant? I can't tell, I hate implicit globals. do a threading test
   safe_lexer.input(string)
   a = []
   while 1:
@@ -562,10 +733,85 @@ def lex(string):
       break
   return a
 
-YACC = ply.yacc.yacc(module=SqlGrammar(), debug=0, write_tables=0)
+INDEX_RE = re.compile(r'create\s+(unique\s+)?index\s+(if\s+not\s+exists\s+)?(?:(\w+)\s+)?on\s+(\w+)\s*(?:using\s+\w+\s*)?\(([^()]*)\)\s*$', re.I)
+def parse_index(string):
+  "create index isn't in the grammar; it gets matched with INDEX_RE instead. Anything fancier than a list of column names is an IndexX with table=None."
+  match = INDEX_RE.match(string.strip())
+  unique = bool(re.match(r'\s*create\s+unique', string, re.I))
+  if match:
+    cols = [col.strip() for col in match.group(5).split(',')]
+    if all(re.match(r'^[A-Za-z]\w*$', col) for col in cols):
+      return IndexX(string, unique, bool(match.group(2)), match.group(3), match.group(4), cols)
+  return IndexX(string, unique, False, None, None, None)
+
+SEQUENCE_RE = re.compile(r'(create|drop)\s+sequence\s+(if\s+(?:not\s+)?exists\s+)?(\w+)(.*)$', re.I | re.S)
+def parse_sequence(string):
+  "create / drop sequence also aren't in the grammar. create takes 'start [with] n' and 'increment [by] n'; other options are ignored."
+  match = SEQUENCE_RE.match(string.strip())
+  if not match:
+    raise SQLSyntaxError('bad_sequence_statement', string)
+  verb, exists, name, options = match.groups()
+  if verb.lower() == 'drop':
+    if not re.match(r'\s*(cascade|restrict)?\s*$', options, re.I):
+      raise SQLSyntaxError('bad_sequence_statement', string)
+    return DropSequenceX(bool(exists), name)
+  start = re.search(r'\bstart\s+(?:with\s+)?(-?\d+)', options, re.I)
+  increment = re.search(r'\bincrement\s+(?:by\s+)?(-?\d+)', options, re.I)
+  return CreateSequenceX(
+    bool(exists),
+    name,
+    int(start.group(1)) if start else None,
+    int(increment.group(1)) if increment else None,
+  )
+
+SAVEPOINT_RE = re.compile(r'(savepoint|rollback\s+to|release)(?:\s+savepoint)?\s+(\w+)\s*;?\s*$', re.I)
+def parse_savepoint(string):
+  "savepoint statements aren't in the grammar either"
+  match = SAVEPOINT_RE.match(string.strip())
+  if not match:
+    raise SQLSyntaxError('bad_savepoint_statement', string)
+  verb, name = match.groups()
+  return {'savepoint': SavepointX, 'release': ReleaseX}.get(verb.lower(), RollbackToX)(name)
+
 def parse(string):
   "return a BaseX tree for the string"
-  print(string)
-  if string.strip().lower().startswith('create index'):
-    return IndexX(string)
-  return YACC.parse(string, lexer=LEXER.clone())
+  if re.match(r'\s*create\s+(unique\s+)?index', string, re.I):
+    return parse_index(string)
+  if re.match(r'\s*(create|drop)\s+sequence\b', string, re.I):
+    return parse_sequence(string)
+  if re.match(r'\s*(savepoint|rollback\s+to|release)\b', string, re.I):
+    return parse_savepoint(string)
+  return get_parser().parse(string, lexer=get_lexer().clone())
+
+def sub_literal(val):
+  "wrap a %s parameter in the BaseX that replaces its SubLit"
+  # todo: does ArrayLit get us anything? tree traversal?
+  if isinstance(val, (str, int, float, type(None), dict)):
+    return Literal(val)
+  elif isinstance(val, (list, tuple)):
+    return ArrayLit(val)
+  else:
+    raise TypeError('unk_sub_type', type(val), val) # pragma: no cover
+
+class StatementTemplate:
+  """a parsed statement with the paths to its SubLit slots computed once.
+  warning: the tree in self.ex is shared by every caller that parses the same string (see parse_template). don't mutate it; use bind().
+  """
+  def __init__(self, ex):
+    self.ex = ex
+    self.slots = treepath.sub_slots(ex, lambda elt: elt is SubLit)
+
+  def bind(self, values):
+    "return a fresh tree with values subbed into the slots. only the nodes on the way to a slot are copied; the rest is shared with self.ex"
+    if len(self.slots) != len(values):
+      raise ValueError('len', len(self.slots), len(values))
+    ex = self.ex
+    for path, val in zip(self.slots, values):
+      ex = treepath.copy_path(ex, path, sub_literal(val))
+    return ex
+
+PARSE_CACHE_SIZE = 512
+@functools.lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse_template(string):
+  "cached version of parse() for statements that run over and over (i.e. from pg.Row). returns a StatementTemplate."
+  return StatementTemplate(parse(string))
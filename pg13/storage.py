@@ -0,0 +1,302 @@
+"snapshot files and the write-ahead log for pgmock databases (see pgmock.TablesDict.save, load and open)"
+
+import gc, mmap, os, pickle, shutil, struct, threading, zlib
+from . import table
+
+def table_spec(table_):
+  "a table's schema as plain data, for snapshots and the WAL. see spec_table"
+  return {
+    'name': table_.name,
+    'fields': table_.fields,
+    'pkey': table_.pkey,
+    'parent': table_.parent_table and table_.parent_table.name,
+    'serials': {col: seq.name for col, seq in table_.serials.items()},
+    'indexes': [(index.name, index.columns, index.unique) for index in table_.indexes.values()],
+  }
+
+def spec_table(spec, sequences):
+  "an empty table from table_spec's output, without its indexes or inheritance links. sequences is {name: table.Sequence}"
+  table_ = table.Table(spec['name'], spec['fields'], spec['pkey'])
+  table_.serials = {col: sequences[name] for col, name in spec['serials'].items()}
+  return table_
+
+def link_families(tables, parents):
+  "set parent_table / child_tables for {name: Table}. parents is {name: parent name or None}"
+  for table_ in tables.values():
+    table_.child_tables, table_.parent_table = [], None
+  for name, parent in parents.items():
+    if parent is not None:
+      tables[name].parent_table = tables[parent]
+      tables[parent].child_tables.append(tables[name])
+
+# snapshot file (see TablesDict.save): SNAPSHOT_MAGIC, then a SNAPSHOT_HEADER struct (version, length of the pickled header),
+#   the header, then one pickled list of rows per table at the offsets the header gives
+SNAPSHOT_MAGIC = b'pg13snap'
+SNAPSHOT_HEADER = struct.Struct('<II')
+SNAPSHOT_VERSION = 1
+
+class WriteAheadLog: # pylint: disable=too-many-instance-attributes
+  """append-only file of commits, for TablesDict.open. Records are pickles framed with their length and crc32,
+  so replay can tell where a record that was cut off by a crash starts, and stop there.
+  sync says when a commit is durable:
+    'always': commit waits for an fsync of its record. commits that arrive during an fsync share the next one (group commit)
+    'interval': commits don't wait; a background thread fsyncs every sync_interval seconds when there are new records.
+      an OS crash loses at most the commits of the last sync_interval seconds (plus the time an fsync takes)
+    'off': never fsync (records are still written through to the OS at commit, so a process crash doesn't lose them)
+  """
+  FRAME = struct.Struct('<II')
+  SYNC_MODES = ('always', 'interval', 'off')
+
+  def __init__(self, path, sync='always', sync_interval=0.05):
+    if sync not in self.SYNC_MODES:
+      raise ValueError('unk_sync_mode', sync)
+    self.path, self.sync, self.sync_interval = path, sync, sync_interval
+    self.file = open(path, 'ab') # pylint: disable=consider-using-with
+    self.cond = threading.Condition()
+    self.written = self.synced = 0 # record counts
+    self.syncing = False
+    self.closed = False
+    self.flusher = None
+    if sync == 'interval':
+      self.flusher = threading.Thread(target=self.flush_loop, name='pg13-wal-flusher', daemon=True)
+      self.flusher.start()
+
+  def append(self, record):
+    "write a record. called in commit order (under TablesDict.commit_lock). returns its number for sync_to"
+    blob = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+    with self.cond:
+      self.file.write(self.FRAME.pack(len(blob), zlib.crc32(blob)) + blob)
+      self.file.flush()
+      self.written += 1
+      return self.written
+
+  def sync_to(self, number):
+    "wait until record number is durable (according to self.sync)"
+    if self.sync == 'always':
+      self.fsync_to(number)
+
+  def flush_loop(self):
+    "the background thread for sync='interval'"
+    while True:
+      with self.cond:
+        self.cond.wait(self.sync_interval)
+        if self.closed:
+          return
+        number = self.written
+      self.fsync_to(number)
+
+  def fsync_to(self, number):
+    "fsync until record number is on disk. commits that arrive during an fsync share the next one"
+    with self.cond:
+      while self.synced < number:
+        if self.syncing:
+          self.cond.wait() # another commit's fsync. it may cover this record too
+          continue
+        self.syncing, target = True, self.written
+        self.cond.release()
+        try:
+          os.fsync(self.file.fileno())
+        finally:
+          self.cond.acquire()
+          self.syncing = False
+          self.cond.notify_all()
+        self.synced = max(self.synced, target)
+
+  def rotate(self, old_path):
+    "move the log to old_path (appending if it's there already, i.e. a checkpoint failed) and start an empty one"
+    with self.cond:
+      while self.syncing: # fsync_to works on the file without holding cond
+        self.cond.wait()
+      os.fsync(self.file.fileno())
+      self.file.close()
+      if os.path.exists(old_path):
+        with open(old_path, 'ab') as old, open(self.path, 'rb') as cur:
+          shutil.copyfileobj(cur, old)
+          old.flush()
+          os.fsync(old.fileno())
+        os.remove(self.path)
+      else:
+        os.replace(self.path, old_path)
+      self.file = open(self.path, 'ab') # pylint: disable=consider-using-with
+      self.synced = self.written
+
+  def close(self):
+    with self.cond:
+      self.closed = True
+      self.cond.notify_all()
+    if self.flusher is not None:
+      self.flusher.join()
+    with self.cond:
+      while self.syncing:
+        self.cond.wait()
+      os.fsync(self.file.fileno())
+      self.file.close()
+
+  @classmethod
+  def read(cls, path):
+    "yield the records in the file at path, stopping at the first incomplete or corrupt one"
+    with open(path, 'rb') as f:
+      data = f.read()
+    pos = 0
+    while pos + cls.FRAME.size <= len(data):
+      length, crc = cls.FRAME.unpack_from(data, pos)
+      blob = data[pos + cls.FRAME.size:pos + cls.FRAME.size + length]
+      if len(blob) < length or zlib.crc32(blob) != crc:
+        return
+      yield pickle.loads(blob)
+      pos += cls.FRAME.size + length
+
+def wal_changes(undo, ddl_tables, index_tables, committed):
+  """the tables part of a transaction's WAL record (see replay), from its undo log and the tables its DDL touched, once committed
+  ({name: Table}) includes its writes.
+  [(name, 'drop'), ...] for dropped tables, (name, 'table', table_spec, rows) for tables create / drop touched, and otherwise
+    (name, 'rows', removed, added): the original values of the rows it deleted or changed and the final values of the rows it
+    inserted or changed. A table's change doesn't depend on the rest of it, so this is right for merged commits too.
+  Tables in index_tables (create index) get their row changes like any other plus (name, 'indexes', [(name, columns, unique), ...]),
+    which replay builds the missing ones from, rather than a copy of every row.
+  """
+  changes = []
+  for name in ddl_tables:
+    if name in committed:
+      changes.append((name, 'table', table_spec(committed[name]), committed[name].rows))
+    else:
+      changes.append((name, 'drop'))
+  changes.extend((name, 'rows', removed, added) for name, (removed, added) in net_rows(undo, ddl_tables).items())
+  for name in index_tables - ddl_tables:
+    if name in committed:
+      changes.append((name, 'indexes', table_spec(committed[name])['indexes']))
+  return changes
+
+def net_rows(undo, ddl_tables):
+  "helper for wal_changes. {table name: (removed, added)} for the tables that weren't in ddl_tables"
+  rows = {} # {id(row): [table name, original values (None for inserted rows), row (None for deleted rows)]}
+  for entry in undo:
+    if entry.op == 'ddl' or entry.table.name in ddl_tables:
+      continue
+    if entry.op == 'insert':
+      for row in entry.changes:
+        rows[id(row)] = [entry.table.name, None, row]
+    elif entry.op == 'update':
+      for row, old in entry.changes:
+        rows.setdefault(id(row), [entry.table.name, old, row])
+    else:
+      for _, row in entry.changes:
+        rows.setdefault(id(row), [entry.table.name, list(row), row])[2] = None
+  net = {}
+  for name, original, row in rows.values():
+    removed, added = net.setdefault(name, ([], []))
+    if original is not None:
+      removed.append(original)
+    if row is not None:
+      added.append(list(row))
+  return net
+
+def replay(committed, sequences, record):
+  "apply a WAL record (see TablesDict.log_commit) to committed ({name: Table}) and sequences ({name: table.Sequence}). for open"
+  for name, state in record['sequences'].items():
+    if state is None:
+      sequences.pop(name, None)
+    else:
+      seq = sequences.get(name)
+      if seq is None:
+        seq = sequences[name] = table.Sequence(name, *state[:2])
+      seq.start, seq.increment, seq.value = state
+  parents = {name: table_.parent_table and table_.parent_table.name for name, table_ in committed.items()}
+  for change in record['tables']:
+    name, op = change[:2]
+    if op == 'drop':
+      committed.pop(name, None)
+      parents.pop(name, None)
+    elif op == 'table':
+      spec, rows = change[2:]
+      table_ = committed[name] = spec_table(spec, sequences)
+      table_.rows = rows
+      build_indexes(table_, spec['indexes'])
+      parents[name] = spec['parent']
+    elif op == 'indexes':
+      build_indexes(committed[name], change[2])
+    else:
+      committed[name].apply_changes(*change[2:])
+  if any(change[1] in ('drop', 'table') for change in record['tables']):
+    link_families(committed, parents)
+
+def build_indexes(table_, indexes):
+  "helper for replay. create the indexes in [(name, columns, unique), ...] that table_ doesn't have yet"
+  for name, columns, unique in indexes:
+    if name not in table_.indexes:
+      table_.create_index(name, columns, unique)
+
+def wal_paths(directory):
+  "snapshot, WAL and the WAL being checkpointed"
+  return os.path.join(directory, 'snapshot'), os.path.join(directory, 'wal'), os.path.join(directory, 'wal.old')
+
+def snapshot_state(committed, sequences):
+  """for TablesDict.save and checkpoint: (one pickle per table, sequence states); the caller holds the tables' locks.
+  Tables can change in place once the locks are released, so everything the snapshot needs from them is captured here.
+  """
+  blobs = [
+    pickle.dumps((table_.rows, table_.pkey_index.buckets, [index.buckets for index in table_.indexes.values()]), pickle.HIGHEST_PROTOCOL)
+    for table_ in committed.values()
+  ]
+  return blobs, [(seq.name, seq.start, seq.increment, seq.value) for seq in sequences.values()]
+
+def write_snapshot(path, committed, blobs, sequences):
+  """write a snapshot file (see read_snapshot) for committed ({name: Table}). see snapshot_state for blobs and sequences.
+  The header holds the schemas. Each table's rows and index buckets are pickled together (the buckets refer to the rows,
+    so loading doesn't rebuild the indexes), one pickle per table, which read_snapshot decodes straight out of the mapped file.
+  """
+  tables, offset = [], 0 # offsets are from the end of the header, so the header doesn't depend on its own length
+  for table_, blob in zip(committed.values(), blobs):
+    tables.append(dict(table_spec(table_), rows=(offset, len(blob))))
+    offset += len(blob)
+  header = {
+    'tables': tables,
+    'sequences': sequences,
+  }
+  header_blob = pickle.dumps(header, pickle.HIGHEST_PROTOCOL)
+  with open(path, 'wb') as f:
+    f.write(SNAPSHOT_MAGIC + SNAPSHOT_HEADER.pack(SNAPSHOT_VERSION, len(header_blob)))
+    f.write(header_blob)
+    for blob in blobs:
+      f.write(blob)
+    f.flush()
+    os.fsync(f.fileno())
+
+def read_snapshot(path):
+  """({name: Table}, {name: table.Sequence}) from a file written by write_snapshot. Tables and indexes are restored directly.
+  The file is memory-mapped and read-only, so loading a big snapshot doesn't read it into a bytes object first.
+  """
+  with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+    start = len(SNAPSHOT_MAGIC) + SNAPSHOT_HEADER.size
+    if mapped[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+      raise ValueError('not_a_snapshot', path)
+    version, header_len = SNAPSHOT_HEADER.unpack(mapped[len(SNAPSHOT_MAGIC):start])
+    if version != SNAPSHOT_VERSION:
+      raise ValueError('unk_snapshot_version', version)
+    with memoryview(mapped) as view:
+      header = pickle.loads(view[start:start + header_len])
+      sequences = {}
+      for name, seq_start, increment, value in header['sequences']:
+        seq = sequences[name] = table.Sequence(name, seq_start, increment)
+        seq.value = value
+      tables = {spec['name']: restore_table(spec, sequences, view[start + header_len:]) for spec in header['tables']}
+  link_families(tables, {spec['name']: spec['parent'] for spec in header['tables']})
+  return tables, sequences
+
+def restore_table(spec, sequences, body):
+  "helper for read_snapshot. body is the part of the file after the header, which spec['rows'] is an offset into"
+  table_ = spec_table(spec, sequences)
+  offset, length = spec['rows']
+  rows, pkey_buckets, buckets = load_rows(body[offset:offset + length])
+  table_.restore(rows, pkey_buckets, {name: (columns, unique, b) for (name, columns, unique), b in zip(spec['indexes'], buckets)})
+  return table_
+
+def load_rows(blob):
+  "helper for read_snapshot. unpickling millions of lists is mostly garbage collector passes; none of these can be garbage yet"
+  enabled = gc.isenabled()
+  gc.disable()
+  try:
+    return pickle.loads(blob)
+  finally:
+    if enabled:
+      gc.enable()
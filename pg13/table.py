@@ -1,7 +1,7 @@
 "table -- Table class"
 
-import collections
-from . import pg, threevl, sqparse2, sqex
+import collections, copy, sys, threading
+from . import pg, sqparse2, sqex, misc
 
 # errors
 class PgExecError(sqparse2.PgMockError):
@@ -36,8 +36,7 @@ def emergency_cast(colx, value):
 def field_default(colx, table_name, tables_dict):
   "takes sqparse2.ColX, Table"
   if colx.coltp.type.lower() == 'serial':
-    next_id = sqparse2.parse('select coalesce(max(%s),-1)+1 from %s' % (colx.name, table_name))
-    return sqex.run_select(next_id, tables_dict, Table)[0]
+    return tables_dict[table_name].serials[colx.name].nextval()
   elif colx.not_null:
     raise NotImplementedError('todo: not_null error')
   else:
@@ -50,14 +49,339 @@ def toliteral(probably_literal):
     return None
   return probably_literal.toliteral() if hasattr(probably_literal, 'toliteral') else probably_literal
 
-class Table:
+def value_size(val):
+  "rough size in bytes of a column value, counting the contents of arrays and json. shared objects (small ints, interned strings) are counted every time"
+  if isinstance(val, (list, tuple)):
+    return sys.getsizeof(val) + sum(value_size(item) for item in val)
+  elif isinstance(val, dict):
+    return sys.getsizeof(val) + sum(value_size(k) + value_size(v) for k, v in val.items())
+  return sys.getsizeof(val)
+
+POINTER_BYTES = 8 # a row's slot in the rows list or an index bucket
+INDEX_ENTRY_BYTES = 120 # an index key: the dict entry, the key tuple and the bucket list
+
+# op is 'insert', 'delete', 'update' or 'ddl'. changes is a list that the Table method appends to as it goes, so a statement that
+#   fails halfway can still be undone. see Table.undo and TablesDict.undo_to
+UndoEntry = collections.namedtuple('UndoEntry', 'op table changes')
+
+class Sequence:
+  """counter behind serial columns and create sequence.
+  Like in postgres, sequences aren't transactional: __deepcopy__ returns self so transaction copies share the counter,
+    and a rolled-back nextval stays used.
+  """
+  def __init__(self, name, start=1, increment=1):
+    self.name, self.start, self.increment = name, start, increment
+    self.value = None # last value handed out (or set with setval); None until the first nextval
+    self.lock = threading.Lock()
+
+  def __deepcopy__(self, memo):
+    return self
+
+  def copy(self):
+    "an independent sequence in the same state, for TablesDict.clone"
+    ret = Sequence(self.name, self.start, self.increment)
+    ret.value = self.value
+    return ret
+
+  def nextval(self):
+    with self.lock:
+      self.value = self.start if self.value is None else self.value + self.increment
+      return self.value
+
+  def currval(self):
+    "note: this is per-sequence, not per-session like postgres"
+    if self.value is None:
+      raise ValueError('currval_not_set', self.name)
+    return self.value
+
+  def setval(self, value, is_called=True):
+    "with is_called false, the next nextval returns value instead of value + increment"
+    with self.lock:
+      self.value = value if is_called else value - self.increment
+      return value
+
+  def advance(self, value):
+    "make sure nextval doesn't hand out value. for serial columns that get explicit values; the old max()+1 default allowed that."
+    if not isinstance(value, int) or self.increment < 0:
+      return
+    with self.lock:
+      if value >= (self.start if self.value is None else self.value + self.increment):
+        self.value = value
+
+class Index:
+  """hash index over some columns of a Table, for equality lookups. {key: [row, ...]}.
+  Rows with a null in an indexed column aren't stored (col = null is never true), unless nulls is set.
+  """
+  def __init__(self, name, columns, col_indexes, unique, nulls=False):
+    "columns is a list of names, col_indexes their positions in the table"
+    self.name, self.columns, self.col_indexes, self.unique, self.nulls = name, columns, col_indexes, unique, nulls
+    self.buckets = {}
+
+  def key(self, vals):
+    "vals is a value per indexed column. None if there's a null (and self.nulls isn't set)"
+    if not self.nulls and any(val is None for val in vals):
+      return None
+    return misc.hashable(vals)
+
+  def row_key(self, row):
+    return self.key([row[i] for i in self.col_indexes])
+
+  def reads(self, col_indexes):
+    "whether assigning to these columns (a set) changes a row's key"
+    return bool(col_indexes & set(self.col_indexes))
+
+  def add(self, row):
+    key = self.row_key(row)
+    if key is not None:
+      self.buckets.setdefault(key, []).append(row)
+
+  def remove(self, row):
+    "row has to be the same object that was added, with the same values in the indexed columns"
+    key = self.row_key(row)
+    if key is None:
+      return
+    bucket = self.buckets[key]
+    bucket.pop(next(i for i, item in enumerate(bucket) if item is row))
+    if not bucket:
+      del self.buckets[key]
+
+  def conflict(self, row):
+    "for unique indexes, the existing row with the same key as row (or None)"
+    key = self.row_key(row)
+    return None if key is None or key not in self.buckets else self.buckets[key][0]
+
+  def get(self, keys):
+    "keys is a list of value-lists (like the vals arg to key()); returns matching rows. duplicate keys are only looked up once"
+    rows = []
+    seen = set()
+    for vals in keys:
+      key = None if any(val is None for val in vals) else self.key(vals)
+      if key is not None and key not in seen:
+        seen.add(key)
+        rows.extend(self.buckets.get(key, ()))
+    return rows
+
+  def copy(self, new_rows):
+    "helper for Table.copy. new_rows is {id(old_row): new_row}"
+    ret = copy.copy(self)
+    ret.buckets = {key: [new_rows[id(row)] for row in bucket] for key, bucket in self.buckets.items()}
+    return ret
+
+  def rebuild(self, rows):
+    self.buckets = {}
+    for row in rows:
+      if self.unique and self.conflict(row) is not None:
+        raise IntegrityError('unique_index_violation', self.name, row)
+      self.add(row)
+
+class RowIndex(Index):
+  "Index keyed on the whole row, for dupe checks in tables without a pkey. Not unique (rows can be assigned directly) and never used for lookups."
+  def __init__(self, name):
+    super().__init__(name, None, (), False, nulls=True)
+
+  def row_key(self, row):
+    return self.key(row)
+
+  def reads(self, col_indexes):
+    return bool(col_indexes)
+
+class Table: # pylint: disable=too-many-instance-attributes
   def __init__(self, name, fields, pkey):
     "fields is a list of sqparse2.ColX"
     self.name, self.fields, self.pkey = name, fields, (pkey or [])
+    self.pkey_index = self.make_pkey_index()
+    self.indexes = {} # {name: Index}
+    self.serials = {} # {column_name: Sequence}, set up by TablesDict.create
+    self.log = None # the transaction's undo log (a list of UndoEntry) while a transaction owns this table
+    self.shared = False # True when other databases can see this object (see TablesDict.clone); writes have to copy it first
+    self._nbytes = 0 # rough size of the rows (see value_size), kept up to date by add_row / remove_rows / update / undo. None = not counted yet
     self.rows = []
     self.child_tables = [] # tables that inherit from this one
     self.parent_table = None # table this inherits from
 
+  def copy(self):
+    """copy for a transaction's first write to this table (see TablesDict.writable).
+    Rows are copied one level deep because update changes them in place; indexes are remapped onto the new rows.
+    fields, pkey and sequences are shared. The caller has to fix up parent_table and child_tables.
+    """
+    ret = copy.copy(self)
+    ret.detach_rows()
+    ret.serials = dict(self.serials)
+    ret.child_tables = list(self.child_tables)
+    ret.log = None
+    ret.shared = False
+    return ret
+
+  def detach_rows(self):
+    "helper for copy. replaces the rows (which copy.copy shares with the original) with copies, and remaps the indexes onto them"
+    new_rows = {id(row): list(row) for row in self._rows}
+    self._rows = [new_rows[id(row)] for row in self._rows]
+    self.pkey_index = self.pkey_index.copy(new_rows)
+    self.indexes = {name: index.copy(new_rows) for name, index in self.indexes.items()}
+
+  def merge(self, other, keys):
+    """copy of this table with other's versions of the rows whose pkey key is in keys (i.e. deleted if other doesn't have them).
+    For committing a transaction's row changes on top of another transaction's commit (see pgmock.TablesDict.publish).
+    """
+    ret = self.copy()
+    row_key = ret.pkey_index.row_key
+    ret.remove_rows([row for row in ret.rows if row_key(row) in keys])
+    for row in other.rows:
+      if row_key(row) in keys:
+        ret.add_row(list(row))
+    return ret
+
+  def record(self, op):
+    "start an UndoEntry if there's a log. returns the entry's changes list (a throwaway list if there's no log)"
+    changes = []
+    if self.log is not None:
+      self.log.append(UndoEntry(op, self, changes))
+    return changes
+
+  def undo(self, entry):
+    "reverse an UndoEntry. entries have to be undone newest-first, which is what makes the position bookkeeping simple"
+    if entry.op == 'insert':
+      # inserted rows are at the end of the list once everything after them has been undone
+      for row in entry.changes:
+        for index in self.all_indexes():
+          index.remove(row)
+        self.count_bytes(row, -1)
+      del self._rows[len(self._rows) - len(entry.changes):]
+    elif entry.op == 'delete':
+      rows, merged = iter(self._rows), []
+      for pos, row in entry.changes: # (position before the delete, row), ascending
+        while len(merged) < pos:
+          merged.append(next(rows))
+        merged.append(row)
+        for index in self.all_indexes():
+          index.add(row)
+        self.count_bytes(row, 1)
+      merged.extend(rows)
+      self._rows = merged
+    elif entry.op == 'update':
+      for row, old in reversed(entry.changes):
+        stale = [index for index in self.all_indexes() if index.row_key(row) != index.row_key(old)]
+        for index in stale:
+          index.remove(row)
+        self.count_bytes(row, -1)
+        row[:] = old
+        self.count_bytes(row, 1)
+        for index in stale:
+          index.add(row)
+    else:
+      raise ValueError('unk_undo_op', entry.op) # pragma: no cover
+
+  def make_pkey_index(self):
+    "helper for __init__. Null pkey values are indexed, so a second null pkey is a dupe like it always was here."
+    if self.pkey:
+      indexes = [i for i, f in enumerate(self.fields) if f.name in self.pkey]
+      if len(indexes) != len(self.pkey):
+        raise ValueError('bad pkey')
+      return Index(self.name + '_pkey', [self.fields[i].name for i in indexes], indexes, True, nulls=True)
+    return RowIndex(self.name + '_row')
+
+  def all_indexes(self):
+    return [self.pkey_index] + list(self.indexes.values())
+
+  @property
+  def rows(self):
+    return self._rows
+
+  @rows.setter
+  def rows(self, rows):
+    "note: this rebuilds the indexes. don't add or remove rows by mutating the list in place, use add_row / remove_rows"
+    self._rows = rows
+    self._nbytes = None
+    for index in self.all_indexes():
+      index.rebuild(rows)
+    self.advance_serials(rows)
+
+  def restore(self, rows, pkey_buckets, indexes):
+    """set rows and index contents that were saved together (see pgmock.TablesDict.save), without rebuilding the indexes.
+    indexes is {name: (columns, unique, buckets)}
+    """
+    self._rows = rows
+    self._nbytes = None # counted on first use, so loading stays fast
+    self.pkey_index.buckets = pkey_buckets
+    for name, (columns, unique, buckets) in indexes.items():
+      self.indexes[name] = Index(name, columns, [self.lookup(col).index for col in columns], unique)
+      self.indexes[name].buckets = buckets
+
+  def apply_changes(self, removed, added):
+    "replay a commit's row changes (see pgmock.Transaction.wal_changes). removed are the values of rows to take out, added rows to put in"
+    picked = {}
+    for value in removed:
+      for row in self.pkey_index.buckets.get(self.pkey_index.row_key(value), ()):
+        if id(row) not in picked:
+          picked[id(row)] = row
+          break
+    self.remove_rows(list(picked.values()))
+    for row in added:
+      self.add_row(row)
+    self.advance_serials(added)
+
+  @property
+  def nbytes(self):
+    "rough size of the rows (see value_size)"
+    if self._nbytes is None:
+      self._nbytes = sum(value_size(row) for row in self._rows)
+    return self._nbytes
+
+  def count_bytes(self, row, sign):
+    "helper for keeping nbytes up to date. sign is 1 for a row going in, -1 for one coming out"
+    if self._nbytes is not None:
+      self._nbytes += sign * value_size(row)
+
+  def memory_usage(self):
+    "rough size in bytes of the rows and indexes. cheap: the rows are counted as they change (see nbytes), indexes are estimated"
+    size = POINTER_BYTES * len(self._rows) + self.nbytes
+    return size + sum(INDEX_ENTRY_BYTES * len(index.buckets) + POINTER_BYTES * len(self._rows) for index in self.all_indexes())
+
+  def advance_serials(self, rows):
+    "see Sequence.advance"
+    for name, seq in self.serials.items():
+      col = self.lookup(name).index
+      for row in rows:
+        seq.advance(row[col])
+
+  def create_index(self, name, columns, unique):
+    index = Index(name, columns, [self.lookup(col).index for col in columns], unique)
+    index.rebuild(self.rows)
+    self.indexes[name] = index
+
+  def find_index(self, col_indexes):
+    "the best index for equality lookups on the given column positions (a set), or None"
+    candidates = [index for index in self.all_indexes() if index.col_indexes and set(index.col_indexes) <= col_indexes]
+    return max(candidates, key=lambda index: (index.unique, len(index.col_indexes)), default=None)
+
+  def add_row(self, row):
+    for index in self.all_indexes():
+      if index.unique and index.conflict(row) is not None:
+        raise pg.DupeInsert(row)
+    self.rows.append(row)
+    for index in self.all_indexes():
+      index.add(row)
+    self.count_bytes(row, 1)
+
+  def remove_rows(self, rows):
+    "rows have to be the row objects from self.rows"
+    if not rows:
+      return
+    for index in self.all_indexes():
+      for row in rows:
+        index.remove(row)
+    for row in rows:
+      self.count_bytes(row, -1)
+    removed = {id(row) for row in rows}
+    changes = self.record('delete')
+    kept = []
+    for pos, row in enumerate(self._rows):
+      if id(row) in removed:
+        changes.append((pos, row))
+      else:
+        kept.append(row)
+    self._rows = kept
+
   def get_column(self, name):
     col = next((f for f in self.fields if f.name == name), None)
     if col is None:
@@ -65,15 +389,9 @@ class Table:
     return col
 
   def pkey_get(self, row):
-    if len(self.pkey) > 0:
-      indexes = [i for i, f in enumerate(self.fields) if f.name in self.pkey]
-      if len(indexes) != len(self.pkey):
-        raise ValueError('bad pkey')
-      pkey_vals = list(map(row.__getitem__, indexes))
-      return next((r for r in self.rows if pkey_vals == list(map(r.__getitem__, indexes))), None)
-    else:
-      # warning: is this right? it's saying that if not given, the pkey is the whole row. test dupe inserts on a real DB.
-      return row if row in self.rows else None
+    "the existing row with the same pkey as row, or None"
+    # warning: is this right? if there's no pkey, it's saying the pkey is the whole row. test dupe inserts on a real DB.
+    return self.pkey_index.conflict(row)
 
   def fix_rowtypes(self, row):
     if len(row) != len(self.fields):
@@ -92,19 +410,22 @@ class Table:
     nix.resolve_aonly(tables_dict, Table)
     expanded_row = self.fix_rowtypes(expand_row(self.fields, fields, values) if fields else values)
     row = self.apply_defaults(expanded_row, tables_dict)
+    compiler = sqex.Compiler(nix, tables_dict, 0)
     # todo: check ColX.not_null here. figure out what to do about null pkey field
     for i, elt in enumerate(row):
       # todo: think about dependency model if one field relies on another. (what do I mean? 'insert into t1 (a,b) values (10,a+5)'? is that valid?)
-      row[i] = sqex.Evaluator(row, nix, tables_dict).eval(elt)
+      row[i] = compiler.compile(elt)(row)
     if self.pkey_get(row):
       raise pg.DupeInsert(row)
-    self.rows.append(row)
+    self.add_row(row)
+    self.record('insert').append(row)
+    self.advance_serials([row])
     if returning:
-      return sqex.Evaluator((row,), nix, tables_dict).eval(returning)
+      return compiler.compile(returning)(row)
     return None
 
   def match(self, where, tables, nix):
-    return [r for r in self.rows if not where or threevl.ThreeVL.test(sqex.Evaluator((r,), nix, tables).eval(where))]
+    return list(sqex.scan(self, sqex.and_terms([where] if where else []), nix, tables, 0))
 
   def lookup(self, name):
     if isinstance(name, sqparse2.NameX):
@@ -120,20 +441,39 @@ class Table:
     nix.resolve_aonly(tables_dict, Table)
     if not all(isinstance(x, sqparse2.AssignX) for x in setx):
       raise TypeError('not_xassign', list(map(type, setx)))
-    match_rows = self.match(where, tables_dict, nix) if where else self.rows
-    for row in match_rows:
-      for expr in setx:
-        row[self.lookup(expr.col).index] = sqex.Evaluator((row,), nix, tables_dict).eval(expr.expr)
+    compiler = sqex.Compiler(nix, tables_dict, 0)
+    assigns = [(self.lookup(expr.col).index, compiler.compile(expr.expr)) for expr in setx]
+    assigned = {index for index, _ in assigns}
+    stale = [index for index in self.all_indexes() if index.reads(assigned)]
+    changes = self.record('update')
+    for row in self.match(where, tables_dict, nix):
+      new_row = list(row)
+      for index, expr in assigns:
+        new_row[index] = expr(row)
+      self.replace_row(row, new_row, stale, changes)
     if returning:
       # todo: write a test for the empty case, make sure this doesn't crash. Should I set row to None at the top or is it not that simple?
       # pylint: disable=undefined-loop-variable
-      return sqex.Evaluator((row,), nix, tables_dict).eval(returning)
+      return compiler.compile(returning)(row)
     return None
 
+  def replace_row(self, row, new_row, stale, changes):
+    "helper for update. overwrites row in place with new_row's values. stale is the indexes whose keys the update can change"
+    for index in stale:
+      conflict = index.conflict(new_row) if index.unique else None
+      if conflict is not None and conflict is not row:
+        raise pg.DupeInsert(new_row)
+    for index in stale:
+      index.remove(row)
+    changes.append((row, list(row)))
+    self.count_bytes(row, -1)
+    row[:] = new_row
+    self.count_bytes(row, 1)
+    for index in stale:
+      index.add(row)
+
   def delete(self, where, tables_dict):
     # todo: what's the deal with nested selects in delete. does it get evaluated once to a scalar before running the delete?
-    # todo: this will crash with empty where clause
     nix = sqex.NameIndexer.ctor_name(self.name)
     nix.resolve_aonly(tables_dict, Table)
-    # todo: why 'not' below?
-    self.rows = [r for r in self.rows if not sqex.Evaluator((r,), nix, tables_dict).eval(where)]
+    self.remove_rows(self.match(where, tables_dict, nix))
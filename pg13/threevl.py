@@ -1,16 +1,38 @@
 "3-value logic (i.e. the way that boolean ops on nulls propagate up in the expression tree in SQL). doesn't rhyme with 'evil' but should."
 
+import operator
+
 class ThreeVL:
-  "Implementation of sql's 3VL. Warning: use == != for comparing python values, not for 3vl comparison. Caveat emptor."
+  """Implementation of sql's 3VL. Warning: use == != for comparing python values, not for 3vl comparison. Caveat emptor.
+  There are only three instances (TRUE, FALSE, UNKNOWN below); ThreeVL(value) returns one of them, so expressions don't allocate
+    and UNKNOWN can be tested with 'is'.
+  """
   # todo(awinter): is there any downside to using python True/False/None to make this work?
-  def __init__(self, value):
+  __slots__ = ('value',)
+  INSTANCES = {}
+
+  def __new__(cls, value):
+    try:
+      return cls.INSTANCES[value]
+    except (KeyError, TypeError):
+      pass
     if value not in ('t', 'f', 'u'):
       raise ValueError(value)
+    self = cls.INSTANCES[value] = super().__new__(cls)
     self.value = value
+    return self
+
+  def __reduce__(self):
+    "so pickle and copy return the shared instance"
+    return (ThreeVL, (self.value,))
 
   def __repr__(self):
     return "<3vl %s>" % self.value
 
+  def __hash__(self):
+    # consistent with __eq__: 't' and 'f' equal True and False
+    return hash(self.value == 't') if self.value != 'u' else hash(self.value)
+
   def __eq__(self, other):
     if not isinstance(other, (bool, ThreeVL)):
       return False
@@ -36,37 +58,44 @@ class ThreeVL:
     "this is 'not' but not is a keyword so it's 'nein'"
     if not isinstance(item, (bool, ThreeVL)):
       raise TypeError(type(item))
-    return not item if isinstance(item, bool) else ThreeVL(dict(t='f', f='t', u='u')[item.value])
+    return not item if isinstance(item, bool) else ThreeVL(NEGATIONS[item.value])
 
   @staticmethod
-  def andor(operator, left, right):
+  def andor(op, left, right):
     # todo(awinter): does sql cast values to bools? e.g. nonempty strings, int 0 vs 1
     # is this the right one? https://en.wikipedia.org/wiki/Three-valued_logic#Kleene_logic
-    if operator not in ('and', 'or'):
-      raise ValueError('unk_operator', operator)
+    if op not in ('and', 'or'):
+      raise ValueError('unk_operator', op)
     vals = left, right
     if not all(isinstance(item, (bool, ThreeVL)) for item in vals):
       raise TypeError(list(map(type, vals)))
-    if ThreeVL('u') in vals:
-      if operator == 'or' and True in vals:
+    if left is UNKNOWN or right is UNKNOWN:
+      other = right if left is UNKNOWN else left
+      if op == 'or' and other is not UNKNOWN and other:
         return True
-      return False if False in vals else ThreeVL('u')
-    left, right = list(map(bool, vals))
-    return (left and right) if operator == 'and' else (left or right)
+      return False if other is not UNKNOWN and not other else UNKNOWN
+    return (bool(left) and bool(right)) if op == 'and' else (bool(left) or bool(right))
 
   @staticmethod
-  def compare(operator, left, right):
+  def compare(op, left, right):
     "this could be replaced by overloading but I want == to return a bool for 'in' use"
     # todo(awinter): what about nested 3vl like "(a=b)=(c=d)". is that allowed by sql? It will choke here if there's a null involved.
+    if op not in COMPARISONS:
+      raise ValueError('unk operator in compare', op)
     if left is None or right is None:
-      return ThreeVL('u')
-    elif operator == '=':
-      return left == right
-    elif operator == '!=':
-      return left != right
-    elif operator == '>':
-      return left > right
-    elif operator == '<':
-      return left < right
-    else:
-      raise ValueError('unk operator in compare', operator)
+      return UNKNOWN
+    return COMPARISONS[op](left, right)
+
+  @staticmethod
+  def comparison(op):
+    "compare(op, ..) as a two-argument function, with the operator looked up once. this is what compiled expressions use"
+    if op not in COMPARISONS:
+      raise ValueError('unk operator in compare', op)
+    oper = COMPARISONS[op]
+    def compare(left, right):
+      return UNKNOWN if left is None or right is None else oper(left, right)
+    return compare
+
+NEGATIONS = {'t': 'f', 'f': 't', 'u': 'u'}
+COMPARISONS = {'=': operator.eq, '!=': operator.ne, '>': operator.gt, '<': operator.lt}
+TRUE, FALSE, UNKNOWN = ThreeVL('t'), ThreeVL('f'), ThreeVL('u')
@@ -4,6 +4,8 @@ paths can be used to get and set.
 todo: this probably exists somewhere else so use a public library instead of roll-your-own.
 """
 
+import copy
+
 class PathTree:
   "'tree path' is implemented here (i.e. square brackets for get-set)"
   def child(self, index):
@@ -71,3 +73,20 @@ def flatten_tree(test, enumerator, exp):
   returns [subexpression, ...].
   """
   return sum((flatten_tree(test, enumerator, subx) for subx in enumerator(exp)), []) if test(exp) else [exp]
+
+def copy_path(tree, path, item):
+  """return a copy of tree with tree[path] replaced by item. tree isn't modified.
+  Only the nodes along path (and the VARLEN lists they index into) are copied; everything else is shared with tree.
+  """
+  if not path:
+    return item
+  head, tail = path[0], path[1:]
+  ret = copy.copy(tree)
+  if isinstance(head, tuple):
+    attr, i = head
+    seq = list(getattr(tree, attr))
+    seq[i] = copy_path(seq[i], tail, item)
+    setattr(ret, attr, seq)
+  else:
+    setattr(ret, head, copy_path(getattr(tree, head), tail, item))
+  return ret
@@ -1,5 +1,6 @@
+import threading
 import pytest
-from pg13 import pgmock_dbapi2, sqparse2
+from pg13 import pgmock, pgmock_dbapi2, sqparse2
 
 def test_connection():
   with pgmock_dbapi2.connect() as a, a.cursor() as acur:
@@ -53,6 +54,296 @@ def test_iter():
     assert cur.fetchone() == [1,2]
     assert list(cur) == db.db['t1'].rows[1:]
 
+def test_streaming():
+  with pgmock_dbapi2.connect() as db, db.cursor() as cur:
+    cur.execute('create table t1 (a int, b int)')
+    db.db['t1'].rows = [[i,i] for i in range(10,-1,-1)] + [['x',-1]]
+    cur.execute('select a+1 from t1') # rows are computed as they're fetched; the last one fails
+    assert cur.fetchone() == [11] and cur.fetchmany(2) == [[10],[9]]
+    cur.arraysize = 3
+    assert cur.fetchmany() == [[8],[7],[6]]
+    with pytest.raises(TypeError): cur.fetchall()
+    cur.execute('select a from t1 where b>8')
+    assert cur.fetchone() == [10] and cur.fetchone() == [9] and cur.fetchone() is None
+    cur.execute('select a,b from t1 where b<2 and b>-1')
+    cur2 = db.cursor()
+    cur2.execute("update t1 set b=-1") # the open select read ahead first
+    assert cur.fetchall() == [[1,1],[0,0]]
+    cur.execute('select a from t1 where a=1 union all select a from t1') # union all streams
+    assert cur.fetchone() == [1] and cur.fetchmany(2) == [[10],[9]]
+  pool = pgmock_dbapi2.PgPoolMock()
+  pool.commit('create table t1 (a int primary key)')
+  pool.commit('create table t2 (a int)')
+  for i in range(5):
+    pool.commit('insert into t1 values (%s)',(i,))
+  reader = pgmock_dbapi2.connect(pool.db_id)
+  reader.autocommit = True
+  cur = reader.cursor()
+  cur.execute('select * from t1')
+  assert cur.fetchone() == [0] and len(pool.tables.streams) == 1
+  writer = pgmock_dbapi2.connect(pool.db_id)
+  writer.autocommit = True
+  t1 = pool.tables.committed['t1']
+  writer.cursor().execute('insert into t2 values (1)')
+  assert cur.stream.rows is not None # a write to another table leaves it alone
+  writer.cursor().execute('delete from t1 where a>0') # in place (no copy), after the select read ahead to keep its snapshot
+  assert pool.tables.committed['t1'] is t1 and cur.stream.rows is None
+  assert list(cur) == [[1],[2],[3],[4]] and not pool.tables.streams
+  cur.execute('select * from t1')
+  cur.close()
+  assert not pool.tables.streams and pool.select('select * from t1') == [[0]]
+  reader.close()
+  writer.close()
+
+def test_snapshot_reads():
+  "readers see the last commit and don't wait for an open writer"
+  assert pgmock_dbapi2.threadsafety == 3
+  with pgmock_dbapi2.connect() as a, a.cursor() as acur:
+    acur.execute('create table t1 (a int)')
+    acur.execute('insert into t1 values (1)')
+  writer = pgmock_dbapi2.connect(a.db_id)
+  writer.begin()
+  wcur = writer.cursor()
+  wcur.execute('insert into t1 values (2)')
+  wcur.execute('create table t2 (a int)')
+  results = []
+  def read():
+    with pgmock_dbapi2.connect(a.db_id) as b, b.cursor() as bcur:
+      bcur.execute('select * from t1')
+      results.append(bcur.fetchall())
+      results.append('t2' in b.db.committed)
+  thread = threading.Thread(target=read)
+  thread.start()
+  thread.join(5)
+  assert not thread.is_alive()
+  assert results == [[[1]], False]
+  writer.commit()
+  with pgmock_dbapi2.connect(a.db_id) as b, b.cursor() as bcur:
+    bcur.execute('select * from t1')
+    assert bcur.fetchall() == [[1],[2]]
+    bcur.execute('select * from t2')
+
+def test_threaded_writers():
+  "writers in different threads commit rows with different pkeys; nothing is lost"
+  with pgmock_dbapi2.connect() as a, a.cursor() as acur:
+    acur.execute('create table t1 (a int, b int, primary key (a,b))')
+  shared = pgmock_dbapi2.connect(a.db_id)
+  shared.autocommit = True
+  errors = []
+  def work(i):
+    try:
+      for j in range(20):
+        with pgmock_dbapi2.connect(a.db_id) as con, con.cursor() as cur:
+          cur.execute('insert into t1 values (%s,%s)',(i,j))
+          cur.execute('select b from t1 where a=%s',(i,))
+          assert cur.fetchall() == [[k] for k in range(j+1)]
+        shared.cursor().execute('insert into t1 values (%s,%s)',(-1-i,j)) # autocommit connection shared between threads
+    except Exception as err: # pylint: disable=broad-except
+      errors.append(err)
+  threads = [threading.Thread(target=work, args=(i,)) for i in range(4)]
+  for thread in threads: thread.start()
+  for thread in threads: thread.join(30)
+  assert errors == []
+  with pgmock_dbapi2.connect(a.db_id) as b, b.cursor() as bcur:
+    bcur.execute('select * from t1')
+    assert len(bcur.fetchall()) == 160
+
+def test_concurrent_writers():
+  "open transactions write at the same time. different rows merge at commit, the same row fails the second commit"
+  with pgmock_dbapi2.connect() as a, a.cursor() as acur:
+    acur.execute('create table t1 (a int primary key, b int)')
+    acur.execute('create table t2 (a int)')
+    for i in range(3):
+      acur.execute('insert into t1 values (%s,0)',(i,))
+  b, c = pgmock_dbapi2.connect(a.db_id), pgmock_dbapi2.connect(a.db_id)
+  bcur, ccur = b.cursor(), c.cursor()
+  bcur.execute('update t1 set b=1 where a=0')
+  ccur.execute('update t1 set b=2 where a=1')
+  ccur.execute('insert into t1 values (3,2)')
+  bcur.execute('delete from t1 where a=2')
+  c.commit()
+  b.commit()
+  acur = a.cursor()
+  acur.execute('select * from t1')
+  assert sorted(acur.fetchall()) == [[0,1],[1,2],[3,2]]
+  # same row: the second writer waits for the first. its first write starts over after the wait, a later one fails the commit
+  for retries in (True, False):
+    if not retries:
+      ccur.execute('update t1 set b=0 where a=1')
+    bcur.execute('update t1 set b=10 where a=0')
+    thread = threading.Thread(target=ccur.execute, args=('update t1 set b=b+1 where a=0',))
+    thread.start()
+    thread.join(0.1)
+    assert thread.is_alive()
+    b.commit()
+    thread.join(5)
+    if retries:
+      c.commit()
+    else:
+      with pytest.raises(pgmock.SerializationError):
+        c.commit()
+      assert not c.transaction_open
+    acur.execute('select b from t1 where a=0')
+    assert acur.fetchall() == [[11 if retries else 10]]
+  # no pkey: conflicts are per table
+  bcur.execute('insert into t2 values (1)')
+  ccur.execute('insert into t2 values (2)')
+  c.commit()
+  with pytest.raises(pgmock.SerializationError):
+    b.commit()
+  # the failed transaction can be retried
+  bcur.execute('insert into t2 values (1)')
+  b.commit()
+  acur.execute('select * from t2')
+  assert acur.fetchall() == [[2],[1]]
+
+def test_isolation_levels():
+  with pgmock_dbapi2.connect() as a, a.cursor() as acur:
+    acur.execute('create table t1 (a int primary key, b int)')
+    acur.execute('create table t2 (a int primary key)')
+    acur.execute('insert into t1 values (1,1)')
+  a.autocommit = True
+  acur = a.cursor()
+  b = pgmock_dbapi2.connect(a.db_id)
+  bcur = b.cursor()
+  bcur.execute('select b from t1')
+  acur.execute('update t1 set b=2')
+  bcur.execute('select b from t1')
+  assert bcur.fetchall() == [[2]] # read committed
+  b.commit()
+  b.isolation_level = 'repeatable read'
+  bcur.execute('select b from t1')
+  acur.execute('update t1 set b=3')
+  bcur.execute('select b from t1')
+  assert bcur.fetchall() == [[2]]
+  bcur.execute('insert into t2 values (1)')
+  b.commit() # t2 doesn't conflict with anything
+  # serializable: a commit to a table the transaction read fails it
+  b.isolation_level = 'serializable'
+  bcur.execute('select b from t1')
+  acur.execute('update t1 set b=4')
+  bcur.execute('insert into t2 values (2)')
+  with pytest.raises(pgmock.SerializationError):
+    b.commit()
+  acur.execute('select * from t2')
+  assert acur.fetchall() == [[1]]
+  with pytest.raises(ValueError):
+    a.db.trans_start('x', 'read uncommitted')
+
+def test_select_for_update():
+  with pgmock_dbapi2.connect() as a, a.cursor() as acur:
+    acur.execute('create table t1 (a int primary key, b int)')
+    acur.execute('insert into t1 values (0,0)')
+    acur.execute('insert into t1 values (1,0)')
+  b, c = pgmock_dbapi2.connect(a.db_id), pgmock_dbapi2.connect(a.db_id)
+  bcur, ccur = b.cursor(), c.cursor()
+  def run(cur, *args, fetch=True):
+    "execute in a thread, return (thread, results)"
+    results = []
+    thread = threading.Thread(target=lambda: results.append(cur.execute(*args) or (cur.fetchall() if fetch else None)))
+    thread.start()
+    thread.join(0.1)
+    return thread, results
+  bcur.execute('select * from t1 where a=0 for update')
+  assert bcur.fetchall() == [[0,0]]
+  thread, results = run(ccur, 'select b from t1 where a=%s for update', (0,))
+  assert thread.is_alive()
+  ccur2 = pgmock_dbapi2.connect(a.db_id).cursor()
+  ccur2.execute('select b from t1 where a=1 for update') # other rows aren't locked
+  ccur2.connection.rollback()
+  bcur.execute('update t1 set b=5 where a=0')
+  b.commit()
+  thread.join(5)
+  assert results == [[[5]]] # the waiter sees the commit it waited for
+  c.rollback()
+  # share locks don't block each other, but they block writers
+  bcur.execute('select * from t1 for share')
+  ccur.execute('select * from t1 for share')
+  thread, results = run(ccur, 'update t1 set b=6 where a=1', fetch=False)
+  assert thread.is_alive()
+  b.rollback()
+  thread.join(5)
+  c.commit()
+  # deadlock
+  bcur.execute('select * from t1 where a=0 for update')
+  ccur.execute('select * from t1 where a=1 for update')
+  thread, results = run(ccur, 'select * from t1 where a=0 for update')
+  with pytest.raises(pgmock.DeadlockDetected):
+    bcur.execute('update t1 set b=7 where a=1')
+  b.rollback()
+  thread.join(5)
+  assert results == [[[0,5]]]
+  # timeout
+  a.db.lock_timeout = 0.05
+  with pytest.raises(pgmock.LockNotAvailable):
+    bcur.execute('select * from t1 where a=1 for update')
+  c.rollback()
+  bcur.execute('select * from t1 where a=1 for update')
+  assert bcur.fetchall() == [[1,6]]
+  b.rollback()
+  assert not a.db.locks.holders
+
+def test_table_locks():
+  "an autocommit write locks the tables it changes in place, not the db"
+  with pgmock_dbapi2.connect() as a, a.cursor() as acur:
+    acur.execute('create table t1 (a int)')
+    acur.execute('create table t2 (a int)')
+    acur.execute('insert into t2 values (1)')
+  db = a.db
+  with db.lock_tables([], ['t1']):
+    results = []
+    thread = threading.Thread(target=lambda: results.append(db.apply_sql(sqparse2.parse('select * from t2'), (), None)))
+    thread.start()
+    thread.join(5)
+    assert results == [[[1]]]
+    thread = threading.Thread(target=db.apply_sql, args=(sqparse2.parse('select * from t1'), (), None))
+    thread.start()
+    thread.join(0.1)
+    assert thread.is_alive()
+  thread.join(5)
+  assert not thread.is_alive()
+
+def test_clone_db():
+  with pgmock_dbapi2.connect() as a, a.cursor() as acur:
+    acur.execute('create table t1 (a serial primary key, b int)')
+    acur.execute('create table t2 (a int, b int)')
+    acur.execute('create table t3 (a int, b int) inherits (t2)')
+    acur.execute('create index t3_b on t3 (b)')
+    acur.execute('create sequence s1')
+    for i in range(3):
+      acur.execute('insert into t1 (b) values (%s)',(i,))
+      acur.execute('insert into t3 values (%s,%s)',(i,i))
+  template = a.db
+  clone_id = pgmock_dbapi2.add_db(a.db_id)
+  clone = pgmock_dbapi2.DATABASES[clone_id]
+  assert all(clone.committed[name] is template.committed[name] for name in template.committed) # nothing copied yet
+  with pgmock_dbapi2.connect(clone_id) as b, b.cursor() as bcur:
+    bcur.execute('select * from t3 where b=1')
+    assert bcur.fetchall() == [[1,1]]
+    bcur.execute('insert into t1 (b) values (10)')
+    bcur.execute('select nextval(%s)',('s1',))
+  bcur = pgmock_dbapi2.connect(clone_id).cursor()
+  bcur.connection.autocommit = True
+  bcur.execute('update t3 set b=20 where a=0') # autocommit writes copy shared tables too
+  bcur.execute('delete from t1 where b=0')
+  bcur.execute('select * from t1')
+  assert bcur.fetchall() == [[1,1],[2,2],[3,10]]
+  bcur.execute('select b from t3 where a=0')
+  assert bcur.fetchall() == [[20]]
+  acur = a.cursor()
+  acur.execute('select * from t1')
+  assert acur.fetchall() == [[0,0],[1,1],[2,2]]
+  acur.execute('select b from t3 where a=0')
+  assert acur.fetchall() == [[0]]
+  acur.execute('select nextval(%s)',('s1',)) # sequences aren't shared
+  assert acur.fetchall() == [[1]]
+  acur.execute('insert into t1 (b) values (3)')
+  acur.execute('select a from t1 where b=3')
+  assert acur.fetchall() == [[3]]
+  a.commit()
+  bcur.execute('select a from t1 where b=10')
+  assert bcur.fetchall() == [[3]]
+
 @pytest.mark.xfail
 def test_count_after_fetch():
   # todo: look at spec; what's supposed to happen here
@@ -65,3 +356,53 @@ def test_cursor_description_select():
 @pytest.mark.xfail
 def test_cursor_description_nonselect():
   raise NotImplementedError
+
+def test_open_db(tmp_path):
+  db_id = pgmock_dbapi2.open_db(str(tmp_path))
+  with pgmock_dbapi2.connect(db_id) as con:
+    con.cursor().execute('create table t1 (a int)')
+    con.cursor().execute('insert into t1 values (1)')
+  pgmock_dbapi2.DATABASES[db_id].close()
+  with pgmock_dbapi2.connect(pgmock_dbapi2.open_db(str(tmp_path))) as con:
+    cur = con.cursor()
+    cur.execute('select * from t1')
+    assert cur.fetchall() == [[1]]
+
+def test_load_db_failure(tmp_path):
+  "a load that fails doesn't leave an empty database registered"
+  before, next_id = dict(pgmock_dbapi2.DATABASES), pgmock_dbapi2.NEXT_DB_ID
+  with pytest.raises(FileNotFoundError): pgmock_dbapi2.load_db(str(tmp_path / 'nonexistent'))
+  with pytest.raises(ValueError): pgmock_dbapi2.open_db(str(tmp_path), sync='sometimes')
+  assert pgmock_dbapi2.DATABASES == before and pgmock_dbapi2.NEXT_DB_ID == next_id
+
+def test_db_lifecycle():
+  con = pgmock_dbapi2.connect()
+  db_id = con.db_id
+  con2 = pgmock_dbapi2.connect(db_id)
+  con.close()
+  assert db_id in pgmock_dbapi2.DATABASES # con2 still has it
+  con2.close()
+  assert db_id not in pgmock_dbapi2.DATABASES
+  with pytest.raises(pgmock_dbapi2.OperationalError): pgmock_dbapi2.connect(db_id)
+  pool = pgmock_dbapi2.PgPoolMock()
+  db_id = pool.db_id
+  pool.commit('create table t1 (a int)')
+  pool.commit('insert into t1 values (%s)',('x'*1000,))
+  report = pgmock_dbapi2.memory_report()[db_id]
+  assert report['holders'] == 1 and report['tables']['t1'][0] == 1 and report['bytes'] > 1000
+  del pool
+  assert db_id not in pgmock_dbapi2.DATABASES
+  db_id = pgmock_dbapi2.add_db() # explicit: stays until drop_db / evict_idle
+  con = pgmock_dbapi2.connect(db_id)
+  con.close()
+  assert db_id in pgmock_dbapi2.DATABASES
+  con = pgmock_dbapi2.connect(db_id)
+  assert db_id not in pgmock_dbapi2.evict_idle(0) # held
+  with pytest.raises(pgmock_dbapi2.OperationalError): pgmock_dbapi2.drop_db(db_id)
+  con.close()
+  assert db_id in pgmock_dbapi2.evict_idle(0)
+  assert db_id not in pgmock_dbapi2.DATABASES
+  pgmock_dbapi2.drop_db(db_id) # no-op
+  con = pgmock_dbapi2.connect()
+  with pgmock_dbapi2.DB_LOCK: con.__del__() # gc can run this while the thread is inside add_db / acquire_db
+  assert con.closed
@@ -1,5 +1,5 @@
-import pytest
-from pg13 import pgmock, sqparse2, pg, sqex, pgmock_dbapi2, table
+import os, time, pytest
+from pg13 import pgmock, sqparse2, pg, sqex, pgmock_dbapi2, rowops, storage, table, threevl
 
 def prep(create_stmt):
   "helper for table setup"
@@ -36,6 +36,43 @@ def test_insert_dupe():
   runsql("insert into t1 values (1,2,3)")
   with pytest.raises(pg.DupeInsert): runsql("insert into t1 values (1,2,4)")
 
+def test_pkey_index():
+  "pkey dupe checks go through Table.pkey_index; it has to follow update, delete and rollback"
+  ppm = pgmock_dbapi2.PgPoolMock()
+  with ppm.withcur() as cursor:
+    cursor.execute('create table t1 (a int, b int, c int, primary key (a,b))')
+    for i in range(3): cursor.execute('insert into t1 values (%s,0,0)',(i,))
+    cursor.execute('update t1 set a=5 where a=0')
+    cursor.execute('insert into t1 values (0,0,1)') # old pkey is free after update
+    with pytest.raises(pg.DupeInsert): cursor.execute('insert into t1 values (5,0,1)')
+    with pytest.raises(pg.DupeInsert): cursor.execute('update t1 set a=1 where a=2')
+    cursor.execute('delete from t1 where a=1')
+    cursor.execute('insert into t1 values (1,0,1)')
+  class IgnorableError(Exception): pass
+  try:
+    with ppm.withcur() as cursor:
+      cursor.execute('delete from t1 where a=5')
+      cursor.execute('insert into t1 values (6,0,0)')
+      raise IgnorableError
+  except IgnorableError: pass
+  with ppm.withcur() as cursor:
+    with pytest.raises(pg.DupeInsert): cursor.execute('insert into t1 values (5,0,1)')
+    cursor.execute('insert into t1 values (6,0,0)')
+  t1 = ppm.tables['t1']
+  assert sorted(t1.pkey_index.buckets)==[(0,0),(1,0),(2,0),(5,0),(6,0)]
+  assert all(t1.pkey_index.conflict(row) is row for row in t1.rows)
+
+def test_pkey_index_nopkey():
+  "without a pkey the whole row is the key"
+  tables,runsql=prep('create table t1 (a int, b jsonb)')
+  runsql('insert into t1 values (1,%s)',({'x':[1]},))
+  with pytest.raises(pg.DupeInsert): runsql('insert into t1 values (1,%s)',({'x':[1]},))
+  runsql('update t1 set a=2')
+  runsql('insert into t1 values (1,%s)',({'x':[1]},))
+  tables['t1'].rows=[[3,None],[3,None]] # direct assignment can have dupes
+  runsql('delete from t1')
+  runsql('insert into t1 values (3,null)')
+
 def test_insert_sub():
   tables,runsql=prep("create table t1 (a int, b int, c int, primary key (a,b))")
   runsql("insert into t1 values (1,2,%s)",(3,))
@@ -95,6 +132,45 @@ def test_select_coalesce():
   for i in range(2): runsql("insert into t1 (a,b,c) values (%s,2,3)",(i,))
   assert [[1],[1]]==runsql("select coalesce(null,1) from t1")
 
+def test_short_circuit():
+  "and / or / coalesce / case don't evaluate what they don't need; a+1 and 'x'+1 would raise here"
+  tables,runsql=prep("create table t1 (a int, b int)")
+  tables['t1'].rows=[[None,1],[1,2]]
+  assert [[None],[1]]==runsql("select a from t1 where a is null or a+1>1")
+  assert [[1]]==runsql("select a from t1 where a is not null and a+1>1")
+  assert [[1],[1]]==runsql("select coalesce(a,null,b) from t1 where b=1 or b=2") and [[1]]==runsql("select coalesce(null,b,'x'+1) from t1 where b=1")
+  assert [[0],[2]]==runsql("select case when a is null then 0 when a+1>0 then 2 end from t1")
+  with pytest.raises(TypeError): runsql("select a from t1 where a is null and a+1>1")
+
+def test_in_list():
+  "in / not in probe a set; like postgres, a null on either side makes a miss null rather than false"
+  tables,runsql=prep("create table t1 (a int, b int)")
+  tables['t1'].rows=[[1,2],[2,3],[None,4],[3,None]]
+  assert [[1],[3]]==runsql("select a from t1 where a in (1,3)") and [[2]]==runsql("select a from t1 where a not in (1,3)")
+  assert [[1]]==runsql("select a from t1 where a in (1,null)") and []==runsql("select a from t1 where a not in (1,null)")
+  assert [[1],[2]]==runsql("select a from t1 where a in %s",((1,2),))
+  assert [[2],[3]]==runsql("select a from t1 where (a,b) not in ((1,2),(2,4))")
+  assert [True,True,threevl.UNKNOWN,False]==[row[0] for row in runsql("select a in (1,2) from t1")]
+
+def test_in_subquery_exists():
+  tables,runsql=prep("create table t1 (a int, b int)")
+  runsql("create table t2 (c int, d int)")
+  tables['t1'].rows=[[1,2],[2,3],[None,4],[3,None]]
+  tables['t2'].rows=[[1,2],[3,5],[None,4]]
+  assert [[1],[3]]==runsql("select a from t1 where a in (select c from t2)") and []==runsql("select a from t1 where a not in (select c from t2)")
+  assert [[1],[2],[3]]==runsql("select a from t1 where a in (select c from t2 union select 2 from t2)")
+  assert [[1]]==runsql("select a from t1 where (a,b) in (select c,d from t2)")
+  assert 4==len(runsql("select a from t1 where exists (select * from t2 where c=3)")) and 4==len(runsql("select a from t1 where not exists (select * from t2 where c=4)"))
+  # correlated: the subquery runs once for a set of its c values
+  assert [[1],[3]]==runsql("select a from t1 where exists (select * from t2 where c=a)")
+  assert [[2],[None]]==runsql("select a from t1 where not exists (select * from t2 where t2.c=t1.a)")
+  assert [[3]]==runsql("select a from t1 where exists (select * from t2 where c=a and d>2)")
+  assert [[1]]==runsql("select a from t1 where b in (select d from t2 where c=a)")
+  with pytest.raises(NotImplementedError): runsql("select a from t1 where exists (select * from t2 where c>a)")
+  runsql("delete from t1 where a in (select c from t2)")
+  runsql("update t1 set b=0 where not exists (select * from t2 where d=t1.b)")
+  assert [[2,0],[None,4]]==tables['t1'].rows
+
 def test_insert_select():
   tables,runsql=prep("create table t1 (a int, b int, c int)")
   runsql("insert into t1 (a,b,c) values (1,2,3)")
@@ -191,6 +267,18 @@ def test_select_order():
   print('tso',rows)
   assert rows==sorted(rows)
 
+def test_select_order_multi():
+  tables,runsql=prep('create table t1 (a int, b text)')
+  tables['t1'].rows=[[2,'x'],[None,'y'],[1,None],[2,'a'],[None,None],[3,'y']]
+  # postgres: nulls sort after values, so they're last for asc and first for desc unless nulls first / last says otherwise
+  assert [[1,None],[2,'x'],[2,'a'],[3,'y'],[None,'y'],[None,None]]==runsql('select * from t1 order by a')
+  assert [[None,'y'],[None,None],[3,'y'],[2,'x'],[2,'a'],[1,None]]==runsql('select * from t1 order by a desc')
+  assert [[3,'y'],[2,'x'],[2,'a'],[1,None],[None,'y'],[None,None]]==runsql('select * from t1 order by a desc nulls last')
+  assert [[1,None],[None,None],[3,'y'],[None,'y'],[2,'x'],[2,'a']]==runsql('select * from t1 order by b desc, a')
+  assert [[None,None],[None,'y'],[3,'y'],[2,'a'],[2,'x'],[1,None]]==runsql('select * from t1 order by a desc, b asc nulls first')
+  assert [[None,'y'],[None,None],[3,'y']]==runsql('select * from t1 order by a desc, b limit 3')
+  assert [[None,2],['y',2]]==runsql('select b,count(*) from t1 group by b order by count(*) desc, b desc limit 2')
+
 def setup_join_test():
   tables,runsql=prep('create table t1 (a int,b int)')
   runsql('create table t2 (c int, d int)')
@@ -269,7 +357,6 @@ def test_call_as():
   assert [[0],[1]]==runsql('select coalesce(a,0) as c from t1')
   assert [[0],[1]]==runsql('select c from (select coalesce(a,0) as c from t1) as sub')
 
-@pytest.mark.xfail # delete without a where clause is broken
 def test_delete():
   tables,runsql=prep('create table t1 (a int, b int)')
   tables['t1'].rows=[[0,1],[1,1],[2,0],[2,1]]
@@ -297,6 +384,50 @@ def test_groupby():
   assert [[0,2,1],[1,2,3]]==runsql('select a,count(a),min(b) from t1 group by a')
   assert [[0,2],[1,2]]==runsql('select a,count(*) from t1 group by a')
 
+def test_groupby_aggregates():
+  tables,runsql=prep('create table t1 (a int, b int, c text, d boolean)')
+  assert [0]==runsql('select count(*) from t1') and [None]==runsql('select sum(b) from t1')
+  tables['t1'].rows=[[0,1,'x',True],[0,2,'y',False],[1,3,None,True],[1,None,'z',True],[2,5,'w',None]]
+  assert [[0,2,2,3,1.5],[1,1,2,3,3.0],[2,1,1,5,5.0]]==runsql('select a,count(b),count(*),sum(b),avg(b) from t1 group by a')
+  assert [[0,False,True,[1,2],'x,y'],[1,True,True,[3,None],'z'],[2,None,None,[5],'w']]==runsql("select a,bool_and(d),bool_or(d),array_agg(b),string_agg(c,',') from t1 group by a")
+  # group on a column other than the first, on several keys, and with having / order by / limit on the groups
+  assert [[True,3],[False,1],[None,1]]==runsql('select d,count(*) from t1 group by d')
+  assert [[0,'x',1],[0,'y',1],[1,None,1],[1,'z',1],[2,'w',1]]==runsql('select a,c,count(*) from t1 group by a,c')
+  assert [[2,5],[0,3]]==runsql('select a,sum(b) from t1 group by a having sum(b)>2 order by -sum(b) limit 2')
+  assert [[1,0]]==runsql('select a,max(b)-min(b) from t1 group by a having count(*)>1 offset 1') and []==runsql('select count(*) from t1 having count(*)>10')
+  with pytest.raises(ValueError): runsql('select a,b from t1 group by a')
+  with pytest.raises(sqparse2.SQLSyntaxError): runsql('select sum(a) from t1 group by max(a)')
+  with pytest.raises(sqparse2.SQLSyntaxError): runsql('select max(count(a)) from t1')
+
+def test_distinct():
+  tables,runsql=prep('create table t1 (a int, b int[])')
+  tables['t1'].rows=[[1,[1]],[1,[1]],[2,[1,2]],[None,None],[None,None],[2,[1,2]]]
+  assert [[1],[2],[None]]==runsql('select distinct a from t1') and 6==len(runsql('select all a from t1'))
+  assert [[1,[1]],[2,[1,2]],[None,None]]==runsql('select distinct a,b from t1') # arrays are hashed by value
+  assert [[None],[2]]==runsql('select distinct a from t1 order by a desc limit 2') and [[1],[2]]==runsql('select distinct unnest(b) from t1 where b is not null')
+  assert [2,4,6]==runsql('select count(distinct a),count(a),count(*) from t1')
+  assert [[1,1,[[1]]],[2,1,[[1,2]]],[None,0,[None]]]==runsql('select a,count(distinct b),array_agg(distinct b) from t1 where a is not null or b is null group by a')
+  with pytest.raises(sqparse2.SQLSyntaxError): runsql('select coalesce(distinct a,1) from t1')
+
+def test_set_operations():
+  tables,runsql=prep('create table t1 (a int, b int)')
+  runsql('create table t2 (c int, d int)')
+  tables['t1'].rows=[[1,2],[1,2],[2,3],[None,4],[None,4]]
+  tables['t2'].rows=[[1,2],[3,3],[3,3],[None,4]]
+  assert [[1],[2],[None],[3]]==runsql('select a from t1 union select c from t2')
+  assert [[1],[1],[2],[None],[None],[1],[3],[3],[None]]==runsql('select a from t1 union all select c from t2')
+  # nulls are equal to each other here, unlike in =
+  assert [[1,2],[None,4]]==runsql('select a,b from t1 intersect select c,d from t2')
+  assert [[1,2],[None,4]]==runsql('select * from t1 intersect all select * from t2')
+  assert [[2,3]]==runsql('select a,b from t1 except select c,d from t2')
+  assert [[1,2],[2,3],[None,4]]==runsql('select a,b from t1 except all select c,d from t2')
+  # intersect binds tighter than union; order by / limit apply to the whole thing and name output columns
+  assert [[None],[1],[2]]==runsql('select a from t1 union select c from t2 intersect select a from t1 order by a nulls first')
+  assert [[3],[2]]==runsql('select a as x from t1 union select c from t2 order by x desc nulls last limit 2')
+  assert [[5],[4]]==runsql('select count(*) from t1 union all select count(*) from t2')
+  assert [[1,2],[1,2]]==runsql('select * from t1 where a=(select c from t2 intersect select 1 from t1)')
+  with pytest.raises(sqex.ColumnNameError): runsql('select a from t1 union select c from t2 order by c')
+
 def test_textsearch():
   tables,runsql=prep('create table t1 (a int, b text)')
   tables['t1'].rows=[[0,'one two three okay'],[1,'four five six okay']]
@@ -312,6 +443,53 @@ def test_serial():
     runsql('insert into t1 (b) values (%s)',(i,))
   assert tables['t1'].rows == [[0,0],[1,1],[2,2]]
   # warning: what's supposed to happen when a value is passed for serial?
+  runsql('delete from t1 where a=2')
+  runsql('insert into t1 (b) values (3)')
+  assert tables['t1'].rows[-1] == [3,3] # serials aren't reused after delete
+  runsql('insert into t1 values (10,4)') # explicit values push the sequence forward
+  runsql('insert into t1 (b) values (5)')
+  tables['t1'].rows = tables['t1'].rows + [[20,6]]
+  runsql('insert into t1 (b) values (7)')
+  assert [row[0] for row in tables['t1'].rows] == [0,1,3,10,11,20,21]
+  assert [[21]]==runsql("select currval('t1_a_seq')")
+
+def test_sequence():
+  ppm = pgmock_dbapi2.PgPoolMock()
+  with ppm.withcur() as cursor:
+    cursor.execute('create sequence s1')
+    cursor.execute('create sequence if not exists s1')
+    with pytest.raises(ValueError): cursor.execute('create sequence s1')
+    cursor.execute('create sequence s2 start with 10 increment by 5')
+    with pytest.raises(ValueError): cursor.execute("select currval('s1')")
+    cursor.execute("select nextval('s1'), nextval('s2')")
+    assert cursor.fetchall() == [[1,10]]
+    cursor.execute("select nextval('s2'), currval('s2')")
+    assert cursor.fetchall() == [[15,15]]
+    cursor.execute("select setval('s1', 7)")
+    cursor.execute("select nextval('s1')")
+    assert cursor.fetchall() == [[8]]
+    cursor.execute("select setval('s1', 20, false)")
+    cursor.execute("select nextval('s1')")
+    assert cursor.fetchall() == [[20]]
+    cursor.execute('create table t1 (a serial, b int)')
+    assert sorted(ppm.tables.sequences) == ['s1','s2','t1_a_seq']
+  class IgnorableError(Exception): pass
+  try:
+    with ppm.withcur() as cursor:
+      cursor.execute('drop sequence s1')
+      cursor.execute('drop table t1')
+      cursor.execute('create sequence s3')
+      cursor.execute("select nextval('s2')")
+      raise IgnorableError
+  except IgnorableError: pass
+  with ppm.withcur() as cursor:
+    assert sorted(ppm.tables.sequences) == ['s1','s2','t1_a_seq'] # create and drop roll back
+    cursor.execute("select nextval('s2')")
+    assert cursor.fetchall() == [[25]] # nextval doesn't
+    cursor.execute('drop table t1')
+    cursor.execute('drop sequence if exists s3')
+    with pytest.raises(KeyError): cursor.execute('drop sequence s3')
+    with pytest.raises(KeyError): cursor.execute("select nextval('t1_a_seq')")
 
 def test_cast():
   tables,runsql=prep('create table t1 (a int, b text)')
@@ -364,6 +542,69 @@ def test_transaction_basics():
   except IgnorableError: pass
   assert len(ppm.tables['t1'].rows) == 1
 
+def test_transaction_copy_on_write():
+  "a transaction only copies the tables it writes to (and their inheritance family)"
+  ppm = pgmock_dbapi2.PgPoolMock()
+  with ppm.withcur() as cursor:
+    for stmt in ('create table t1 (a int primary key, b int)', 'create table t2 (a int)', 'create table t2a inherits (t2)', 'create table t3 (a int)'):
+      cursor.execute(stmt)
+    cursor.execute('insert into t1 values (1,1)')
+    cursor.execute('insert into t2a values (1)')
+  db = ppm.tables
+  committed = db.committed
+  with ppm.withcur() as cursor:
+    cursor.execute('select * from t1 where a=1')
+    assert all(db[name] is committed[name] for name in committed)
+    cursor.execute('update t1 set b=2 where a=1')
+    cursor.execute('insert into t2 values (2)')
+    assert db['t3'] is committed['t3']
+    assert all(db[name] is not committed[name] for name in ('t1','t2','t2a'))
+    assert db['t2'].child_tables == [db['t2a']] and db['t2a'].parent_table is db['t2']
+    assert committed['t1'].rows == [[1,1]] and committed['t2'].rows == [] # committed level doesn't see the writes
+    with pytest.raises(pg.DupeInsert): cursor.execute('insert into t1 values (1,3)') # copied pkey index points at the copied rows
+    cursor.execute('delete from t1 where a=1')
+    assert db['t1'].rows == [] and committed['t1'].rows == [[1,1]]
+  assert db['t1'].rows == [] and db['t2'].rows == [[2]]
+
+def test_savepoint():
+  ppm = pgmock_dbapi2.PgPoolMock()
+  with ppm.withcur() as cursor:
+    cursor.execute('create table t1 (a int primary key, b int)')
+    for i in range(5): cursor.execute('insert into t1 values (%s,%s)',(i,i))
+  with ppm.withcur() as cursor:
+    cursor.execute('savepoint s1')
+    cursor.execute('delete from t1 where a in (1,3)')
+    cursor.execute('update t1 set b=b+10 where a>0')
+    cursor.execute('insert into t1 values (1,-1)')
+    cursor.execute('savepoint s2')
+    cursor.execute('create table t2 (a int)')
+    cursor.execute('create index on t1 (b)')
+    cursor.execute('insert into t2 values (1)')
+    cursor.execute('rollback to savepoint s2')
+    assert 't2' not in ppm.tables and ppm.tables['t1'].indexes == {}
+    assert ppm.tables['t1'].rows == [[0,0],[2,12],[4,14],[1,-1]]
+    cursor.execute('rollback to s1')
+    assert ppm.tables['t1'].rows == [[i,i] for i in range(5)] # order is restored too
+    assert [[3,3]] == (cursor.execute('select * from t1 where a=3') or cursor.fetchall()) # pkey index is restored
+    with pytest.raises(pg.DupeInsert): cursor.execute('insert into t1 values (3,0)')
+    cursor.execute('rollback to s1') # s1 survives a rollback to it
+    with pytest.raises(KeyError): cursor.execute('rollback to s2') # later savepoints don't
+    cursor.execute('update t1 set b=-1 where a=0')
+    cursor.execute('release savepoint s1')
+    with pytest.raises(KeyError): cursor.execute('rollback to s1')
+  assert ppm.tables['t1'].rows[0] == [0,-1]
+  with pytest.raises(RuntimeError): ppm.tables.apply_sql(sqparse2.parse('savepoint s1'),(),None)
+
+def test_failed_statement_undo():
+  "a statement that fails partway through a transaction is undone"
+  ppm = pgmock_dbapi2.PgPoolMock()
+  with ppm.withcur() as cursor:
+    cursor.execute('create table t1 (a int primary key, b int)')
+    for i in (0,1,2,5): cursor.execute('insert into t1 values (%s,0)',(i,))
+    with pytest.raises(pg.DupeInsert): cursor.execute('update t1 set a=a+3') # fails on the third row
+    assert ppm.tables['t1'].rows == [[0,0],[1,0],[2,0],[5,0]]
+    assert sorted(ppm.tables['t1'].pkey_index.buckets) == [(0,),(1,),(2,),(5,)]
+
 def test_create_nexists():
   # 1. create if not exists, table exists
   ppm = pgmock_dbapi2.PgPoolMock()
@@ -403,6 +644,22 @@ def test_create_inherit():
     cursor.execute('create table t1a inherits (t1)')
     assert ppm.tables['t1'].child_tables == [ppm.tables['t1a']]
     assert ppm.tables['t1a'].parent_table == ppm.tables['t1']
+    cursor.execute('create table t1b inherits (t1)')
+    assert ppm.tables['t1'].child_tables == [ppm.tables['t1a'], ppm.tables['t1b']]
+    assert ppm.tables['t1a'].parent_table is ppm.tables['t1']
+
+def test_inherit_pkey():
+  "child tables get their own pkey index"
+  tables,runsql=prep('create table t1 (a int primary key, b int)')
+  runsql('create table t1a inherits (t1)')
+  runsql('insert into t1 values (1,0)')
+  runsql('insert into t1a values (1,0)')
+  with pytest.raises(pg.DupeInsert): runsql('insert into t1a values (1,1)')
+  runsql('create table t1b inherits (t1)') # copies t1; its pkey index has to stay in sync with the copied rows
+  with pytest.raises(pg.DupeInsert): runsql('insert into t1 values (1,1)')
+  runsql('delete from t1')
+  runsql('insert into t1 values (1,1)')
+  assert tables['t1a'].rows==[[1,0]]
 
 def test_drop_inherit():
   ppm = pgmock_dbapi2.PgPoolMock()
@@ -447,3 +704,289 @@ def test_alias_product():
    2 |  0 |  2 |  0 |  2
   (4 rows)
   """
+
+def test_apply_template():
+  "StatementTemplate is reusable: apply_sql doesn't write into the shared tree"
+  tables,runsql=prep('create table t1 (a int, b int)')
+  runsql('create table t2 (a int, b int)')
+  tables['t2'].rows=[[0,1],[6,2]]
+  template=sqparse2.parse_template('insert into t1 values (%s,(select b from t2 where a=%s))')
+  tables.apply_sql(template,(1,0),None)
+  tables.apply_sql(template,(2,6),None)
+  assert tables['t1'].rows==[[1,1],[2,2]]
+  assert isinstance(template.ex.values[1],sqparse2.SelectX)
+
+def test_hash_join():
+  tables,runsql = setup_join_test()
+  assert [[3,4,2,5]]==runsql('select * from t1 join t2 on a=c+1 and b=d-1')
+  tables['t1'].rows=[[1,2],[3,4],[None,5],[1,6]]
+  tables['t2'].rows=[[1,3],[2,5],[None,5],[1,7]]
+  expected=[[1,2,1,3],[1,2,1,7],[1,6,1,3],[1,6,1,7]]
+  assert expected==runsql('select * from t1 join t2 on a=c')
+  assert expected==runsql('select * from t1 join t2 on c=a') # reversed sides
+  assert [[1,2,1,3],[1,6,1,3]]==runsql('select * from t1,t2 where a=c and d=3 and b>a')
+  # build side flips when the left side is smaller; order stays nested-loop order
+  tables['t2'].rows=tables['t2'].rows*3
+  assert [r1+r2 for r1 in tables['t1'].rows for r2 in tables['t2'].rows if r1[0] is not None and r1[0]==r2[0]]==runsql('select * from t1 join t2 on a=c')
+
+def test_hash_join_unhashable():
+  tables,runsql=prep('create table t1 (a int, b jsonb)')
+  runsql('create table t2 (c int, d jsonb)')
+  tables['t1'].rows=[[1,{'x':1}],[2,{'x':2}]]
+  tables['t2'].rows=[[1,{'x':2}]]
+  assert [[2,{'x':2},1,{'x':2}]]==runsql('select * from t1 join t2 on b=d')
+
+def test_create_index():
+  tables,runsql=prep('create table t1 (a int, b int, c text)')
+  tables['t1'].rows=[[0,1,'x'],[1,1,'y'],[2,0,'z']]
+  runsql('create index on t1 (b)')
+  runsql('create index if not exists t1_b_idx on t1 (b)')
+  with pytest.raises(ValueError): runsql('create index t1_b_idx on t1 (a)')
+  runsql('create index t1_expr on t1 (lower(c))') # accepted, not built
+  assert ['t1_b_idx']==list(tables['t1'].indexes)
+  index=tables['t1'].indexes['t1_b_idx']
+  assert [[0,'x'],[1,'y']]==runsql('select a,c from t1 where b=1')
+  assert [[2]]==runsql('select a from t1 where 0=b')
+  assert [[0],[1],[2]]==sorted(runsql('select a from t1 where b in (0,1)'))
+  assert [[1]]==runsql('select a from t1 where b=1 and a>0')
+  assert []==runsql('select a from t1 where b=1 and b=0')
+  # maintained by insert/update/delete and by assigning rows
+  runsql('insert into t1 values (3,0,%s)',('w',))
+  runsql('update t1 set b=2 where a=0')
+  runsql('delete from t1 where a=2')
+  assert [[3]]==runsql('select a from t1 where b=0')
+  assert [[0]]==runsql('select a from t1 where b=2')
+  tables['t1'].rows=[[5,5,'q']]
+  assert [[5]]==runsql('select a from t1 where b=5')
+  assert sum(len(bucket) for bucket in index.buckets.values())==1
+
+def test_create_index_unique():
+  tables,runsql=prep('create table t1 (a int, b int, c int)')
+  runsql('insert into t1 values (0,1,0)')
+  runsql('create unique index t1_ab on t1 (a,b)')
+  with pytest.raises(pg.DupeInsert): runsql('insert into t1 values (0,1,1)')
+  runsql('insert into t1 values (0,null,0)')
+  runsql('insert into t1 values (0,null,1)') # nulls don't conflict
+  runsql('insert into t1 values (1,1,0)')
+  with pytest.raises(pg.DupeInsert): runsql('update t1 set a=0 where a=1')
+  runsql('update t1 set b=1 where a=0 and b=1') # a row doesn't conflict with itself
+  assert [[0,1,0]]==runsql('select * from t1 where a=0 and b=1')
+  with pytest.raises(table.IntegrityError): runsql('create unique index t1_a on t1 (a)')
+  assert ['t1_ab']==list(tables['t1'].indexes)
+
+def test_index_scan(monkeypatch):
+  "select and update use the index instead of scanning the table"
+  tables,runsql=prep('create table t1 (a int, b int)')
+  tables['t1'].rows=[[i,i%10] for i in range(100)]
+  runsql('create index on t1 (b)')
+  seen=[]
+  real_filter=rowops.filter_rows
+  def spy(rows,preds):
+    seen.append(len(rows))
+    return real_filter(rows,preds)
+  monkeypatch.setattr(rowops,'filter_rows',spy)
+  assert 10==len(runsql('select * from t1 where b=3'))
+  runsql('update t1 set a=-1 where b=4')
+  assert max(seen)==10
+  assert 10==len(runsql('select * from t1 where a<0'))
+  assert 100 in seen
+  # nextval() isn't a lookup key; it runs once per row (and matches each of the first rows), not once more to plan
+  runsql('create table t2 (a int primary key)')
+  runsql('create sequence s1')
+  tables['t2'].rows=[[1],[2],[3]]
+  assert [[1],[2],[3]]==runsql("select a from t2 where a=nextval('s1')") and [[4]]==runsql("select nextval('s1')")
+
+def test_snapshot(tmp_path):
+  tables,runsql=prep('create table t1 (a serial primary key, b text, c int[])')
+  runsql('create table t2 (a int, b int)')
+  runsql('create table t3 (a int, b int) inherits (t2)')
+  runsql('create index t1_b on t1 (b)')
+  runsql('create sequence s1 start with 5')
+  runsql("select nextval('s1')")
+  for i in range(3):
+    runsql('insert into t1 (b,c) values (%s,%s)',(str(i),[i,i]))
+    runsql('insert into t3 values (%s,%s)',(i,None))
+  path = str(tmp_path / 'db.snap')
+  tables.save(path)
+  loaded = pgmock.TablesDict.load(path)
+  def runsql2(stmt,vals=()): return loaded.apply_sql(sqparse2.parse(stmt),vals,None)
+  assert runsql2('select * from t1') == runsql('select * from t1')
+  assert runsql2('select * from t3') == [[0,None],[1,None],[2,None]]
+  assert loaded['t3'].parent_table is loaded['t2'] and loaded['t2'].child_tables == [loaded['t3']]
+  assert loaded['t1'].find_index({1}).name == 't1_b'
+  with pytest.raises(pg.DupeInsert): runsql2("insert into t1 values (1,'x',null)")
+  runsql2("insert into t1 (b) values ('3')")
+  assert runsql2("select a from t1 where b='3'") == [[3]]
+  assert runsql2("select nextval('s1')") == [[6]]
+  assert len(tables['t1'].rows) == 3 # independent of the original
+  with open(path, 'r+b') as f:
+    f.write(b'x')
+  with pytest.raises(ValueError): pgmock.TablesDict.load(path)
+
+def test_wal(tmp_path):
+  path = str(tmp_path / 'db')
+  def opened(**kwargs):
+    tables = pgmock.TablesDict.open(path, **kwargs)
+    return tables, lambda stmt,vals=(),lockref=None: tables.apply_sql(sqparse2.parse(stmt),vals,lockref)
+  tables,runsql=opened()
+  runsql('create table t1 (a serial primary key, b text)')
+  runsql('create table t2 (a int, b int)')
+  runsql('create table t3 (a int, b int) inherits (t2)')
+  runsql('create sequence s1 start with 5')
+  runsql("select nextval('s1')")
+  for i in range(3):
+    runsql('insert into t1 (b) values (%s)',(str(i),))
+    runsql('insert into t3 values (%s,%s)',(i,i))
+  runsql("update t1 set b='x' where a=2")
+  runsql('delete from t3 where a=0')
+  lockref = object()
+  tables.trans_start(lockref)
+  runsql("insert into t1 (b) values ('y')",(),lockref)
+  runsql("update t1 set b='z' where a=3",(),lockref)
+  runsql('delete from t1 where a=1',(),lockref)
+  runsql('create table t4 (a int)',(),lockref)
+  runsql('insert into t4 values (1)',(),lockref)
+  tables.trans_commit(lockref)
+  tables.trans_start(lockref)
+  runsql('insert into t4 values (2)',(),lockref)
+  tables.trans_rollback(lockref)
+  expected = {name:runsql('select * from '+name) for name in ('t1','t3','t4')}
+  tables.close()
+  assert os.path.getsize(os.path.join(path,'wal'))
+  tables,runsql=opened()
+  assert {name:runsql('select * from '+name) for name in ('t1','t3','t4')} == expected
+  assert expected['t1'] == [[0,'0'],[2,'x'],[3,'z']]
+  assert tables['t3'].parent_table is tables['t2']
+  assert runsql("insert into t1 (b) values ('w') returning a") == [[4]]
+  assert runsql("select nextval('s1')") == [[6]]
+  runsql('drop table t4')
+  tables.close()
+  with open(os.path.join(path,'wal'),'ab') as f: f.write(b'\x10\x00\x00\x00torn') # a commit cut off by a crash
+  tables,runsql=opened(sync='interval',checkpoint_every=2)
+  assert 't4' not in tables and len(tables['t1'].rows) == 4
+  assert os.path.getsize(os.path.join(path,'wal')) == 0 # replayed into the snapshot
+  runsql("insert into t1 (b) values ('v')")
+  runsql("insert into t1 (b) values ('u')") # checkpoint
+  assert os.path.getsize(os.path.join(path,'wal')) == 0 and not os.path.exists(os.path.join(path,'wal.old'))
+  runsql("insert into t1 (b) values ('t')")
+  tables.close()
+  tables,runsql=opened(sync='off')
+  assert [row[1] for row in runsql('select * from t1')][-3:] == ['v','u','t']
+  tables.close()
+  tables,runsql=opened(sync='interval',sync_interval=0.01)
+  runsql("insert into t1 (b) values ('s')")
+  for _ in range(500):
+    if tables.wal.synced == tables.wal.written: break
+    time.sleep(0.01)
+  assert tables.wal.synced == tables.wal.written == 1 # the flusher thread fsynced it; no later commit needed
+  flusher = tables.wal.flusher
+  tables.close()
+  assert not flusher.is_alive()
+  with pytest.raises(ValueError): pgmock.TablesDict.open(path, sync='sometimes')
+
+def test_wal_create_index(tmp_path):
+  "create index logs the index, not the table's rows, and replay builds it"
+  path = str(tmp_path)
+  tables = pgmock.TablesDict.open(path)
+  def runsql(stmt,vals=(),lockref=None): return tables.apply_sql(sqparse2.parse(stmt),vals,lockref)
+  runsql('create table t1 (a int primary key, b int)')
+  for i in range(3000):
+    runsql('insert into t1 values (%s,%s)',(i,i%7))
+  size = os.path.getsize(os.path.join(path,'wal'))
+  runsql('create index on t1 (b)')
+  assert os.path.getsize(os.path.join(path,'wal')) - size < 200
+  lockref = object()
+  tables.trans_start(lockref)
+  runsql('insert into t1 values (3000,8)',(),lockref)
+  runsql('create unique index t1_ab on t1 (a, b)',(),lockref)
+  tables.trans_commit(lockref)
+  records = list(storage.WriteAheadLog.read(os.path.join(path,'wal')))
+  assert records[-2]['tables'] == [('t1','indexes',[('t1_b_idx',['b'],False)])]
+  assert records[-1]['tables'] == [('t1','rows',[],[[3000,8]]),('t1','indexes',[('t1_b_idx',['b'],False),('t1_ab',['a','b'],True)])]
+  tables.close()
+  tables = pgmock.TablesDict.open(path)
+  assert sorted(tables['t1'].indexes) == ['t1_ab','t1_b_idx']
+  assert len(tables['t1'].indexes['t1_b_idx'].buckets[(1,)]) == 429
+  assert runsql('select a from t1 where b=8') == [[3000]]
+  tables.close()
+
+def test_checkpoint_race(tmp_path, monkeypatch):
+  "a commit that lands between the WAL rotating and the snapshot being taken ends up in exactly one of them"
+  import threading
+  tables = pgmock.TablesDict.open(str(tmp_path))
+  def runsql(stmt,vals=()): return tables.apply_sql(sqparse2.parse(stmt),vals,None)
+  runsql('create table t1 (a int primary key)')
+  runsql('create table t2 (a int)')
+  real_rotate, writers = storage.WriteAheadLog.rotate, []
+  def rotate(self, old_path):
+    real_rotate(self, old_path)
+    writers.append(threading.Thread(target=lambda: (runsql('insert into t1 values (1)'), runsql('insert into t2 values (1)'))))
+    writers[0].start()
+    writers[0].join(0.2) # without the fix, both inserts finish here
+  monkeypatch.setattr(storage.WriteAheadLog, 'rotate', rotate)
+  tables.checkpoint()
+  writers[0].join()
+  tables.close()
+  tables = pgmock.TablesDict.open(str(tmp_path))
+  assert [[1]]==runsql('select * from t1') and [[1]]==runsql('select * from t2')
+  tables.close()
+
+def test_memory_accounting():
+  tables,runsql=prep('create table t1 (a int primary key, b text, c int[])')
+  def counted(name): return sum(table.value_size(row) for row in tables[name].rows)
+  for i in range(10):
+    runsql('insert into t1 values (%s,%s,%s)',(i,'x'*i,[i]*i))
+  runsql("update t1 set b='y'*a where a<5")
+  runsql('delete from t1 where a>7')
+  assert tables['t1'].nbytes == counted('t1')
+  lockref = object()
+  tables.trans_start(lockref)
+  tables.apply_sql(sqparse2.parse("update t1 set b='long'*100"),(),lockref)
+  tables.apply_sql(sqparse2.parse('delete from t1 where a=1'),(),lockref)
+  tables.trans_rollback(lockref)
+  assert tables['t1'].nbytes == counted('t1') and len(tables['t1'].rows) == 8
+  runsql('create table t2 (a int)')
+  assert runsql('select table_name,row_count from pg13_memory_usage') == [['t1',8],['t2',0]]
+  assert runsql("select bytes from pg13_memory_usage where table_name='t1'") == [[tables['t1'].memory_usage()]]
+  assert tables.memory_usage()['t1'] == (8, tables['t1'].memory_usage())
+  used = sum(size for _, size in tables.memory_usage().values())
+  tables.memory_hard_limit = used + 100000
+  with pytest.raises(pgmock.MemoryLimitExceeded): runsql('insert into t1 values (100,%s,null)',('x'*200000,))
+  assert len(tables['t1'].rows) == 8 # undone
+  with pytest.raises(pgmock.MemoryLimitExceeded): runsql("update t1 set b='z'*200000 where a=2")
+  assert runsql('select b from t1 where a=2') == [['yy']]
+  runsql('create table t3 (b int)')
+  for i in range(100):
+    runsql('insert into t2 values (%s)',(i,))
+    runsql('insert into t3 values (%s)',(i,))
+  with pytest.raises(pgmock.MemoryLimitExceeded): runsql('select * from t1, t2, t3') # cartesian product
+  assert len(runsql('select * from t2, t3 where a=b')) == 100
+  runsql('delete from t2 where a<50') # shrinking is fine over the limit too
+  tables.memory_hard_limit, tables.memory_soft_limit = None, 0
+  with pytest.warns(pgmock.MemoryLimitWarning): runsql('insert into t2 values (1)')
+
+def test_limit_offset(monkeypatch):
+  tables,runsql=prep('create table t1 (a int, b int)')
+  tables['t1'].rows=[[i,(i*7)%10] for i in range(10)]+[['x',None]]
+  assert runsql('select a+1 from t1 limit 3')==[[1],[2],[3]] # stops before the bad row
+  assert runsql('select a from t1 limit 2 offset 8')==[[8],[9]]
+  assert runsql('select a from t1 where b<5 limit %s offset %s',(2,1))==[[2],[3]]
+  assert runsql('select a from t1 limit 0')==[]
+  assert len(runsql('select a from t1 limit null'))==11
+  with pytest.raises(ValueError): runsql('select a from t1 limit -1')
+  with pytest.raises(TypeError): runsql("select a from t1 offset 'x'")
+  tables['t1'].rows.pop()
+  heaps=[]
+  real_nsmallest=sqex.heapq.nsmallest
+  def spy(n, rows, key):
+    heaps.append(n)
+    return real_nsmallest(n, rows, key=key)
+  monkeypatch.setattr(sqex.heapq,'nsmallest',spy)
+  assert runsql('select a,b from t1 order by b limit 3 offset 1')==[[3,1],[6,2],[9,3]]
+  assert heaps==[4]
+  assert runsql('select a,b from t1 order by b offset 8')==[[4,8],[7,9]]
+  assert heaps==[4] # no limit, so a full sort
+  assert runsql('select max(a) from t1 limit 1')==[9] and runsql('select max(a) from t1 offset 1')==[]
+  runsql('create table t2 (a int, b int)')
+  tables['t2'].rows=[[i%3,i] for i in range(9)]
+  assert runsql('select a,count(b) from t2 group by a limit 2 offset 1')==[[1,3],[2,3]]
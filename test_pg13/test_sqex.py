@@ -1,5 +1,5 @@
 import pytest
-from pg13 import sqex, pgmock, sqparse2, treepath
+from pg13 import aggregates, sqex, pgmock, rowops, sqparse2, treepath
 
 def test_sub_arraylit():
   from pg13.sqparse2 import ArrayLit,Literal,SubLit
@@ -33,7 +33,7 @@ def test_sub_stmt():
   xins[p2] = Literal('b')
   assert xins.values==[Literal('a'), Literal('b')]
   x2 = sqparse2.parse('coalesce(max(col),0)')
-  assert sqex.contains(x2,sqex.consumes_rows) # checking that sub_slots can descend into CallX.args
+  assert sqex.contains(x2,aggregates.consumes_rows) # checking that sub_slots can descend into CallX.args
 
 def test_sub_recurse():
   exp = sqparse2.parse('select a + b + c + d from t1')
@@ -75,3 +75,39 @@ def test_eliminateseqchildren():
   assert [()]==transform('a')
   assert [()]==transform('a.*')
   assert []==transform('*')
+
+def test_compiler():
+  from .test_pgmock import prep
+  tables,runsql=prep('create table t1 (a int, b int)')
+  runsql('create table t2 (a int, c int)')
+  nix = sqex.NameIndexer.ctor_fromlist(['t1','t2'])
+  nix.resolve_aonly(tables,pgmock.table.Table)
+  compiler = sqex.Compiler(nix,tables)
+  f = compiler.compile(sqparse2.parse('t1.a + c'))
+  assert f(([1,2],[3,4])) == 5
+  assert compiler.compile(sqparse2.parse('b != c'))(([1,2],[3,4]))
+  assert compiler.compile(sqparse2.parse('max(b)'))([([1,2],[3,4]),([1,5],[3,4])]) == 5
+  # single-table mode takes a bare row
+  single = sqex.Compiler(nix,tables,1).compile(sqparse2.parse('case when c = 4 then t2.a else 0 end'))
+  assert single([3,4]) == 3 and single([3,5]) == 0
+  with pytest.raises(ValueError): sqex.Compiler(nix,tables,1).compile(sqparse2.parse('b'))
+
+def test_select_rows_pushdown(monkeypatch):
+  from .test_pgmock import prep
+  tables,runsql=prep('create table t1 (a int, b int)')
+  runsql('create table t2 (c int, d int)')
+  tables['t1'].rows=[[i,i%2] for i in range(10)]
+  tables['t2'].rows=[[i,i%5] for i in range(10)]
+  sizes=[]
+  real_hash_join=rowops.hash_join
+  def spy(partials, rows, left_key, right_key):
+    partials=list(partials) # streamed
+    sizes.append((len(partials),len(rows)))
+    return real_hash_join(partials, rows, left_key, right_key)
+  monkeypatch.setattr(rowops,'hash_join',spy)
+  ex=sqparse2.parse('select * from t1 join t2 on a=c where b=1 and d<2 and a+c>5')
+  nix,where=sqex.decompose_select(ex)
+  nix.resolve_aonly(tables,pgmock.table.Table)
+  assert [([5,1],[5,0])]==sqex.select_rows(nix,tables,where)
+  assert sizes[-1]==(5,4) # single-table terms ran before the join
+  assert []==sqex.select_rows(nix,tables,where+[sqparse2.parse('1=0')])
@@ -1,4 +1,4 @@
-import pytest
+import os, pytest
 from pg13 import sqparse2
 import ply.lex
 
@@ -77,6 +77,34 @@ def test_parse_select():
     NameX('a'),
     None,None,None
   )
+  groupx=sqparse2.parse('select a,b,count(*) from t1 group by a,b having count(*)>1')
+  assert groupx.group==CommaX([NameX('a'),NameX('b')]) and groupx.having.op==OpX('>')
+
+def test_parse_order():
+  from pg13.sqparse2 import SortX,NameX
+  assert sqparse2.parse('select * from t1 order by a, b desc, c nulls first, d desc nulls last').order==[
+    SortX(NameX('a'),False,False), SortX(NameX('b'),True,True), SortX(NameX('c'),False,True), SortX(NameX('d'),True,False)
+  ]
+  with pytest.raises(sqparse2.SQLSyntaxError): sqparse2.parse('select * from t1 order by a nulls')
+
+def test_parse_set_operations():
+  from pg13.sqparse2 import SetOpX,SortX,NameX,Literal,CallX,CommaX
+  ex=sqparse2.parse('select a from t1 union all select b from t2 intersect select c from t3 except select d from t4 order by a desc limit 2')
+  assert isinstance(ex,SetOpX) and (ex.op,ex.all,ex.order,ex.limit)==('except',False,[SortX(NameX('a'),True,True)],Literal(2))
+  assert (ex.left.op,ex.left.all,ex.left.right.op)==('union',True,'intersect') and ex.cols==ex.left.left.cols
+  assert ex.right.order is None and ex.right.limit is None
+  assert sqparse2.parse('select distinct a from t1').distinct and not sqparse2.parse('select all a from t1').distinct
+  assert sqparse2.parse('select count(distinct a) from t1').cols.children[0]==CallX('count',CommaX([NameX('a')]),True)
+  with pytest.raises(sqparse2.SQLSyntaxError): sqparse2.parse('select a from t1 order by a union select b from t2')
+
+def test_parse_exists_in():
+  from pg13.sqparse2 import ExistsX,SetOpX,UnX,BinX,OpX,NameX,Literal
+  where=sqparse2.parse('select * from t1 where not exists (select * from t2 where b=a) and a=1').where
+  assert where.op==OpX('and') and where.left.op==OpX('not') and isinstance(where.left.val,ExistsX) and where.right==BinX(OpX('='),NameX('a'),Literal(1))
+  assert isinstance(sqparse2.parse('select * from t1 where exists (select a from t2 union select b from t3)').where.select,SetOpX)
+  where=sqparse2.parse('select * from t1 where x=1 and a not in (1,2)').where
+  assert where.right.op==OpX('not in') and where.right.left==NameX('a')
+  with pytest.raises(sqparse2.SQLSyntaxError): sqparse2.parse('select a from t1 for update union select b from t2')
 
 @pytest.mark.xfail
 def test_operator_order():
@@ -106,3 +134,52 @@ def test_drop():
   assert DropX(False,'t1',False) == sqparse2.parse('drop table t1')
   assert DropX(False,'t1',True) == sqparse2.parse('drop table t1 cascade')
   assert DropX(True,'t1',False) == sqparse2.parse('drop table if exists t1')
+
+def test_parse_template():
+  from pg13.sqparse2 import Literal,ArrayLit,SubLit
+  template = sqparse2.parse_template('select a+%s from t1 where x=%s')
+  assert template is sqparse2.parse_template('select a+%s from t1 where x=%s')
+  assert len(template.slots) == 2
+  xsel = template.bind((10,[1,2]))
+  assert xsel.cols.children[0].right==Literal(10) and xsel.where.right==ArrayLit((1,2))
+  # the template is untouched, and the parts of the tree without slots are shared
+  assert template.ex.cols.children[0].right is SubLit and template.ex.where.right is SubLit
+  assert xsel.tables is template.ex.tables
+  assert template.bind((11,[])).cols.children[0].right==Literal(11)
+  with pytest.raises(ValueError): template.bind((1,))
+
+def test_parser_table_cache(tmpdir):
+  path = str(tmpdir.join('tables.pickle'))
+  expected = sqparse2.parse('select a from t1 where b=1')
+  sqparse2.build_parser(path) # generates the tables and writes the cache file
+  assert os.path.exists(path) and not [f for f in os.listdir(str(tmpdir)) if f.endswith('.tmp')]
+  cached = sqparse2.build_parser(path) # loads from the cache file
+  assert cached.parse('select a from t1 where b=1', lexer=sqparse2.get_lexer().clone()) == expected
+  assert sqparse2.grammar_hash() == sqparse2.grammar_hash()
+
+def test_parse_index():
+  ex=sqparse2.parse('create unique index if not exists t1_ab on t1 using btree (a, b)')
+  assert (True,True,'t1_ab','t1',['a','b'])==(ex.unique,ex.nexists,ex.name,ex.table,ex.cols)
+  ex=sqparse2.parse('CREATE INDEX ON t1 (a)')
+  assert (False,False,None,'t1',['a'])==(ex.unique,ex.nexists,ex.name,ex.table,ex.cols)
+  assert sqparse2.parse('create index on t1 (lower(a))').table is None
+
+def test_parse_sequence():
+  assert sqparse2.parse('create sequence if not exists s1 start 3 increment by 2 no cycle')==sqparse2.CreateSequenceX(True,'s1',3,2)
+  assert sqparse2.parse('CREATE SEQUENCE s1')==sqparse2.CreateSequenceX(False,'s1',None,None)
+  assert sqparse2.parse('drop sequence if exists s1')==sqparse2.DropSequenceX(True,'s1')
+  with pytest.raises(sqparse2.SQLSyntaxError): sqparse2.parse('drop sequence s1 s2')
+
+def test_parse_select_lock():
+  assert sqparse2.parse('select * from t1 where a=1 for update').lock == 'update'
+  assert sqparse2.parse('select * from t1 FOR SHARE').lock == 'share'
+  assert sqparse2.parse('select * from t1').lock is None
+  with pytest.raises(sqparse2.SQLSyntaxError):
+    sqparse2.parse('select * from t1 for lunch')
+
+def test_parse_savepoint():
+  assert sqparse2.parse('savepoint s1')==sqparse2.SavepointX('s1')
+  assert sqparse2.parse('ROLLBACK TO SAVEPOINT s1')==sqparse2.RollbackToX('s1')
+  assert sqparse2.parse('rollback to s1')==sqparse2.RollbackToX('s1')
+  assert sqparse2.parse('release s1')==sqparse2.ReleaseX('s1')
+  assert sqparse2.parse('rollback')==sqparse2.RollbackX()
@@ -61,3 +61,12 @@ def test_3vl_compare():
   ]
   for result,args in COMPS:
     assert result==ThreeVL.compare(*args),(result,args)
+
+def test_3vl_singletons():
+  import pickle, copy
+  from pg13.threevl import ThreeVL, TRUE, FALSE, UNKNOWN
+  assert ThreeVL('u') is UNKNOWN and ThreeVL.nein(ThreeVL('t')) is FALSE and ThreeVL.nein(FALSE) is TRUE
+  assert ThreeVL.compare('=',None,1) is UNKNOWN and ThreeVL.comparison('<')(1,None) is UNKNOWN and ThreeVL.comparison('<')(1,2) is True
+  assert pickle.loads(pickle.dumps(UNKNOWN)) is UNKNOWN and copy.deepcopy([TRUE])[0] is TRUE
+  assert len({TRUE,True,UNKNOWN,ThreeVL('u')})==2
+  with pytest.raises(ValueError): ThreeVL.comparison('~')
@@ -19,3 +19,10 @@ def test_set():
   assert pt[('b',0),'a'] == 8
   assert pt[('b',1),] == 7
   assert pt[('a',)] == 6
+
+def test_copy_path():
+  pt = PT(1, [PT(2, 3), PT(4, 5)])
+  pt2 = treepath.copy_path(pt, (('b',0),'a'), 8)
+  assert pt2[('b',0),'a'] == 8
+  assert pt[('b',0),'a'] == 2
+  assert pt2.b[1] is pt.b[1]